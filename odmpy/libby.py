@@ -15,18 +15,25 @@
 # You should have received a copy of the GNU General Public License
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
+import functools
+import hashlib
 import json
 import logging
 import re
 import sys
+import threading
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from enum import Enum
+from http import HTTPStatus
 from pathlib import Path
-from typing import Optional, NamedTuple, Dict, List, Tuple
+from typing import Optional, NamedTuple, Dict, List, Tuple, Callable, Iterator
 from typing import OrderedDict as OrderedDictType
 from urllib import request
-from urllib.parse import urljoin
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse
 
 
 if sys.version_info >= (3, 8):
@@ -34,9 +41,15 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import TypedDict
 import requests
-from requests.adapters import HTTPAdapter, Retry
 
-from .libby_errors import ClientConnectionError, ClientTimeoutError, ErrorHandler
+from .libby_errors import (
+    ClientConnectionError,
+    ClientError,
+    ClientTimeoutError,
+    ErrorHandler,
+)
+from .transport import new_session
+from .utils import log_response_body
 
 #
 # Client for the Libby web API, and helper functions to make sense
@@ -118,6 +131,7 @@ DOWNLOADABLE_FORMATS = (
     LibbyFormats.EBookPDFOpen,
     LibbyFormats.MagazineOverDrive,
 )
+LOAN_FILE_CHUNK_SIZE = 64 * 1024
 
 
 def parse_part_path(title: str, part_path: str) -> ChapterMarker:
@@ -254,8 +268,18 @@ class LibbyClient(object):
         max_retries: int = 0,
         timeout: int = 10,
         logger: Optional[logging.Logger] = None,
+        sync_cache_ttl: int = 0,
         **kwargs,
     ) -> None:
+        """
+        :param settings_folder: Folder to persist the identity settings in
+        :param identity_token: Use this token instead of the saved identity
+        :param max_retries:
+        :param timeout:
+        :param logger:
+        :param sync_cache_ttl: Seconds to reuse a sync state saved in settings_folder, 0 to disable
+        :param kwargs:
+        """
         if not logger:
             logger = logging.getLogger(__name__)
         self.logger = logger
@@ -283,15 +307,131 @@ class LibbyClient(object):
             with self.identity_settings_file.open("w", encoding="utf-8") as f:
                 json.dump(self.identity, f)
 
+        # the sync state is kept in memory until a mutating call and,
+        # if sync_cache_ttl is set, on disk for reuse across runs
+        self.sync_cache_ttl = sync_cache_ttl
+        self.sync_cache_file = (
+            self.settings_folder.joinpath("sync.json") if self.settings_folder else None
+        )
+        self._synced_state: Optional[Dict] = None
+        self._sync_lock = threading.Lock()
+
+        # the cookies set by prepare_loan() are kept per loan download base
+        # for reuse across runs
+        self.cookies_file = (
+            self.settings_folder.joinpath("cookies.json")
+            if self.settings_folder
+            else None
+        )
+        self.saved_cookies: Dict[str, List[Dict]] = {}
+        self._cookies_lock = threading.Lock()
+        if self.cookies_file and self.cookies_file.exists():
+            try:
+                with self.cookies_file.open("r", encoding="utf-8") as f:
+                    self.saved_cookies = json.load(f)
+            except (OSError, ValueError) as err:
+                self.logger.debug("Unable to load cookies: %s", err)
+
         self.max_retries = max_retries
-        libby_session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=max_retries, backoff_factor=0.1))
-        for prefix in ("http://", "https://"):
-            libby_session.mount(prefix, adapter)
-        self.libby_session = libby_session
+        self.libby_session = self.new_session()
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
         self.api_base = "https://sentry-read.svc.overdrive.com/"
 
+    def new_session(self) -> requests.Session:
+        """
+        Create a session with the client's retry settings on the shared
+        connection pools. Loans prepared
+        concurrently each use their own session so that the auth cookies
+        set by `prepare_loan()` do not overwrite one another.
+
+        :return:
+        """
+        return new_session(self.max_retries)
+
+    def _load_loan_cookies(self, session: requests.Session, download_base: str) -> bool:
+        """
+        Set the unexpired cookies saved for a loan on the session.
+
+        :param session:
+        :param download_base:
+        :return: True if there were saved cookies
+        """
+        now = time.time()
+        with self._cookies_lock:
+            saved = [
+                c
+                for c in self.saved_cookies.get(download_base, [])
+                if c.get("expires") and c["expires"] > now
+            ]
+        for c in saved:
+            session.cookies.set_cookie(
+                requests.cookies.create_cookie(
+                    name=c["name"],
+                    value=c["value"],
+                    domain=c["domain"],
+                    path=c["path"],
+                    expires=c["expires"],
+                    secure=c["secure"],
+                )
+            )
+        return bool(saved)
+
+    def _drop_loan_cookies(self, session: requests.Session, download_base: str) -> None:
+        """
+        Discard the cookies saved for a loan, from the session and the saved file.
+
+        :param session:
+        :param download_base:
+        :return:
+        """
+        with self._cookies_lock:
+            saved = self.saved_cookies.pop(download_base, [])
+        for c in saved:
+            try:
+                session.cookies.clear(c["domain"], c["path"], c["name"])
+            except KeyError:
+                pass
+        self._save_loan_cookies(session, download_base)
+
+    def _save_loan_cookies(self, session: requests.Session, download_base: str) -> None:
+        """
+        Persist the cookies set for a loan. Session cookies, i.e. without
+        an expiry, are only valid for the session they were set on.
+
+        :param session:
+        :param download_base:
+        :return:
+        """
+        # the loan cookies are set for the loan's own host only
+        host = urlparse(download_base).hostname
+        now = time.time()
+        with self._cookies_lock:
+            self.saved_cookies[download_base] = [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "expires": cookie.expires,
+                    "secure": cookie.secure,
+                }
+                for cookie in session.cookies
+                if cookie.domain == host and cookie.expires and not cookie.is_expired()
+            ]
+            # drop the loans that no longer have a valid cookie
+            self.saved_cookies = {
+                k: v
+                for k, v in self.saved_cookies.items()
+                if any(c["expires"] > now for c in v)
+            }
+            if not self.cookies_file:
+                return
+            try:
+                with self.cookies_file.open("w", encoding="utf-8") as f:
+                    json.dump(self.saved_cookies, f)
+            except OSError as err:
+                self.logger.debug("Unable to save cookies: %s", err)
+
     @staticmethod
     def is_valid_sync_code(code: str) -> bool:
         return code.isdigit() and len(code) == 8
@@ -321,6 +461,7 @@ class LibbyClient(object):
         session: Optional[requests.sessions.Session] = None,
         return_res: bool = False,
         allow_redirects: bool = True,
+        stream: bool = False,
     ):
         endpoint_url = urljoin(self.api_base, endpoint)
         if not method:
@@ -351,8 +492,10 @@ class LibbyClient(object):
                 session.prepare_request(req),
                 timeout=self.timeout,
                 allow_redirects=allow_redirects,
+                stream=stream,
             )
-            self.logger.debug("body: %s", res.text)
+            if not stream:
+                log_response_body(self.logger, res)
 
             res.raise_for_status()
             if return_res:
@@ -389,6 +532,11 @@ class LibbyClient(object):
         if self.identity_settings_file and self.identity_settings_file.exists():
             self.identity_settings_file.unlink()
         self.identity = {}
+        with self._cookies_lock:
+            self.saved_cookies = {}
+            if self.cookies_file and self.cookies_file.exists():
+                self.cookies_file.unlink()
+        self.invalidate_sync_cache()
 
     def has_chip(self) -> bool:
         """
@@ -426,6 +574,7 @@ class LibbyClient(object):
         if auto_save:
             # persist to settings
             self.save_settings(res)
+        self.invalidate_sync_cache()
         return res
 
     def get_token(self) -> Optional[str]:
@@ -446,16 +595,93 @@ class LibbyClient(object):
         if auto_save:
             # persist to settings
             self.save_settings({"__libby_sync_code": code})
+        self.invalidate_sync_cache()
         return res
 
-    def sync(self) -> Dict:
+    def _sync_cache_key(self) -> str:
+        # ties the cached state to the identity it was synced for
+        return hashlib.sha256((self.get_token() or "").encode("utf-8")).hexdigest()
+
+    def _load_sync_cache(self) -> Optional[Dict]:
+        """
+        Load a saved sync state that is still within the TTL.
+
+        :return:
+        """
+        if not (
+            self.sync_cache_ttl > 0
+            and self.sync_cache_file
+            and self.sync_cache_file.exists()
+        ):
+            return None
+        try:
+            with self.sync_cache_file.open("r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as err:
+            self.logger.debug("Unable to read sync cache: %s", err)
+            return None
+        if cached.get("key") != self._sync_cache_key():
+            return None
+        if not 0 <= time.time() - cached.get("timestamp", 0) <= self.sync_cache_ttl:
+            return None
+        state: Optional[Dict] = cached.get("state")
+        return state
+
+    def _save_sync_cache(self, state: Dict) -> None:
+        """
+        Save the sync state for reuse within the TTL.
+
+        :param state:
+        :return:
+        """
+        if not (self.sync_cache_ttl > 0 and self.sync_cache_file):
+            return
+        try:
+            with self.sync_cache_file.open("w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "key": self._sync_cache_key(),
+                        "timestamp": time.time(),
+                        "state": state,
+                    },
+                    f,
+                )
+        except OSError as err:
+            self.logger.debug("Unable to write sync cache: %s", err)
+
+    def invalidate_sync_cache(self) -> None:
+        """
+        Discard the cached sync state so that the next `sync()` fetches it again.
+
+        :return:
+        """
+        with self._sync_lock:
+            self._synced_state = None
+            if self.sync_cache_file and self.sync_cache_file.exists():
+                self.sync_cache_file.unlink()
+
+    def sync(self, refresh: bool = False) -> Dict:
         """
         Get the user account state, which includes loans, holds, etc.
 
+        The state is reused until a call that changes it, e.g. `borrow_title()`,
+        and is also saved to the settings folder for `sync_cache_ttl` seconds.
+
+        :param refresh: Ignore any cached state
         :return:
         """
-        res: Dict = self.make_request("chip/sync")
-        return res
+        with self._sync_lock:
+            if not refresh:
+                if self._synced_state is not None:
+                    return self._synced_state
+                cached_state = self._load_sync_cache()
+                if cached_state is not None:
+                    self._synced_state = cached_state
+                    return cached_state
+            res: Dict = self.make_request("chip/sync")
+            self._synced_state = res
+            self._save_sync_cache(res)
+            return res
 
     def auth_form(self, website_id) -> Dict:
         """
@@ -484,6 +710,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"auth/link/{website_id}", json_data=data, method="POST"
         )
+        self.invalidate_sync_cache()
         return res
 
     def update_card_name(self, card_id: str, card_name: str) -> Dict:
@@ -497,6 +724,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}", params={"card_name": card_name}, method="PUT"
         )
+        self.invalidate_sync_cache()
         return res
 
     def is_logged_in(self) -> bool:
@@ -707,6 +935,8 @@ class LibbyClient(object):
             f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
             return_res=True,
         )
+        # fulfilling locks the loan into the format
+        self.invalidate_sync_cache()
         return res
 
     @staticmethod
@@ -781,6 +1011,119 @@ class LibbyClient(object):
         )
         return res.content
 
+    @contextmanager
+    def _open_loan_file(
+        self, loan_id: str, card_id: str, format_id: str, offset: int = 0
+    ) -> Iterator[Tuple[Iterator[bytes], bool, int]]:
+        """
+        Opens a stream of the loan file contents.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :param offset: Request the contents from this byte onwards
+        :return: The content chunks, if the contents start from `offset`,
+            and the total file size (0 if unknown)
+        """
+        headers = self.default_headers()
+        headers["Accept"] = "*/*"
+        range_headers = {"Range": f"bytes={offset}-"} if offset else {}
+        endpoint = f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}"
+
+        if format_id in (LibbyFormats.EBookEPubOpen, LibbyFormats.EBookPDFOpen):
+            res_redirect: requests.Response = self.make_request(
+                endpoint, headers=headers, return_res=True, allow_redirects=False
+            )
+            # refer to _urlretrieve() for why requests is not used here
+            opener = request.build_opener()
+            open_res = opener.open(
+                request.Request(
+                    res_redirect.headers["Location"],
+                    headers={**headers, **range_headers},
+                ),
+                timeout=self.timeout,
+            )
+            try:
+                is_resumed = bool(offset) and open_res.getcode() == 206
+                yield (
+                    iter(functools.partial(open_res.read, LOAN_FILE_CHUNK_SIZE), b""),
+                    is_resumed,
+                    int(open_res.headers.get("Content-Length") or 0)
+                    + (offset if is_resumed else 0),
+                )
+            finally:
+                open_res.close()
+            return
+
+        res: requests.Response = self.make_request(
+            endpoint,
+            headers={**headers, **range_headers},
+            return_res=True,
+            stream=True,
+        )
+        try:
+            is_resumed = bool(offset) and res.status_code == 206
+            yield (
+                res.iter_content(LOAN_FILE_CHUNK_SIZE),
+                is_resumed,
+                int(res.headers.get("Content-Length") or 0)
+                + (offset if is_resumed else 0),
+            )
+        finally:
+            res.close()
+
+    def fulfill_loan_file_to(
+        self,
+        loan_id: str,
+        card_id: str,
+        format_id: str,
+        file_path: Path,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Path:
+        """
+        Streams the loan file contents (see `fulfill_loan_file()`) to a file
+        without holding the whole file in memory.
+        An interrupted download is kept as a .part file and resumed with a Range request.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :param file_path:
+        :param progress: Called with the bytes written so far and the total size (0 if unknown)
+        :return:
+        """
+        if format_id not in DOWNLOADABLE_FORMATS:
+            raise ValueError(f"Unsupported format_id: {format_id}")
+
+        part_file_path = file_path.with_name(f"{file_path.name}.part")
+        offset = part_file_path.stat().st_size if part_file_path.exists() else 0
+        try:
+            with self._open_loan_file(loan_id, card_id, format_id, offset) as (
+                chunks,
+                is_resumed,
+                total,
+            ):
+                written = offset if is_resumed else 0
+                with part_file_path.open("ab" if is_resumed else "wb") as f:
+                    if progress:
+                        progress(written, total)
+                    for chunk in chunks:
+                        f.write(chunk)
+                        written += len(chunk)
+                        if progress:
+                            progress(written, total)
+        except (ClientError, HTTPError) as err:
+            status = err.http_status if isinstance(err, ClientError) else err.code
+            if not (offset and status == 416):
+                raise
+            # the partial file cannot be resumed, start over
+            part_file_path.unlink()
+            return self.fulfill_loan_file_to(
+                loan_id, card_id, format_id, file_path, progress
+            )
+        part_file_path.replace(file_path)
+        return file_path
+
     def open_loan(self, loan_type: str, card_id: str, title_id: str) -> Dict:
         """
         Gets the meta urls needed to fulfill a loan.
@@ -795,11 +1138,14 @@ class LibbyClient(object):
         )
         return res
 
-    def prepare_loan(self, loan: Dict) -> Tuple[str, Dict]:
+    def prepare_loan(
+        self, loan: Dict, session: Optional[requests.Session] = None
+    ) -> Tuple[str, Dict]:
         """
         Pre-requisite step for processing a loan.
 
         :param loan:
+        :param session: Session to set the needed cookie on. Defaults to `libby_session`.
         :return:
         """
         loan_type = "book"
@@ -812,6 +1158,26 @@ class LibbyClient(object):
         meta = self.open_loan(loan_type, card_id, title_id)
         download_base: str = meta["urls"]["web"]
 
+        session = session or self.libby_session
+        if self._load_loan_cookies(session, download_base):
+            # still have the loan's cookie from an earlier run
+            self._handle_rejected_loan_cookies(session, download_base, meta)
+            return download_base, meta
+
+        self._loan_cookie_handshake(session, download_base, meta)
+        return download_base, meta
+
+    def _loan_cookie_handshake(
+        self, session: requests.Session, download_base: str, meta: Dict
+    ) -> None:
+        """
+        Do the request that sets the cookie needed to download a loan.
+
+        :param session:
+        :param download_base:
+        :param meta: From `open_loan()`
+        :return:
+        """
         # Sets a needed cookie
         web_url = download_base + "?" + meta["message"]
         _ = self.make_request(
@@ -819,36 +1185,95 @@ class LibbyClient(object):
             headers={"Accept": "*/*"},
             method="HEAD",
             authenticated=False,
+            session=session,
             return_res=True,
         )
-        return download_base, meta
+        self._save_loan_cookies(session, download_base)
+
+    def _handle_rejected_loan_cookies(
+        self, session: requests.Session, download_base: str, meta: Dict
+    ) -> None:
+        """
+        Redo the cookie handshake once if the server rejects the saved cookies,
+        for example after the loan was returned and borrowed again, and
+        resend the rejected requests with the new cookies.
+
+        :param session: Session with the saved cookies
+        :param download_base:
+        :param meta: From `open_loan()`
+        :return:
+        """
+        host = urlparse(download_base).hostname
+        with self._cookies_lock:
+            saved_cookies = [
+                f'{c["name"]}={c["value"]}'
+                for c in self.saved_cookies.get(download_base, [])
+            ]
+        lock = threading.Lock()
+        is_renewed = [False]
+
+        def handle_rejected(res: requests.Response, **kwargs) -> requests.Response:
+            if (
+                res.status_code not in (HTTPStatus.UNAUTHORIZED, HTTPStatus.FORBIDDEN)
+                or urlparse(res.url).hostname != host
+            ):
+                return res
+            cookie_header = res.request.headers.get("Cookie", "")
+            if not any(c in cookie_header.split("; ") for c in saved_cookies):
+                # not sent with the saved cookies
+                return res
+            with lock:
+                if not is_renewed[0]:
+                    self.logger.debug(
+                        "Saved cookies rejected for %s, renewing", download_base
+                    )
+                    self._drop_loan_cookies(session, download_base)
+                    self._loan_cookie_handshake(session, download_base, meta)
+                    is_renewed[0] = True
+            # resend with the new cookies
+            res.close()
+            retry_req = res.request.copy()
+            retry_req.headers.pop("Cookie", None)
+            retry_req.prepare_cookies(session.cookies)
+            retry_res = res.connection.send(retry_req, **kwargs)
+            retry_res.history.append(res)
+            retry_res.request = retry_req
+            return retry_res
+
+        session.hooks["response"].append(handle_rejected)
 
     def process_audiobook(
-        self, loan: Dict
+        self, loan: Dict, session: Optional[requests.Session] = None
     ) -> Tuple[Dict, OrderedDictType[str, PartMeta]]:
         """
         Returns the data needed to download an audiobook.
 
         :param loan:
+        :param session: Session to set the needed cookie on. Defaults to `libby_session`.
         :return:
         """
-        download_base, meta = self.prepare_loan(loan)
+        download_base, meta = self.prepare_loan(loan, session=session)
         # contains nav/toc and spine
-        openbook = self.make_request(meta["urls"]["openbook"])
+        openbook = self.make_request(meta["urls"]["openbook"], session=session)
         toc = parse_toc(download_base, openbook["nav"]["toc"], openbook["spine"])
         return openbook, toc
 
-    def process_ebook(self, loan: Dict) -> Tuple[str, Dict, List[Dict]]:
+    def process_ebook(
+        self, loan: Dict, session: Optional[requests.Session] = None
+    ) -> Tuple[str, Dict, List[Dict]]:
         """
         Returns the data needed to download an ebook directly.
 
         :param loan:
+        :param session: Session to set the needed cookie on. Defaults to `libby_session`.
         :return:
         """
-        download_base, meta = self.prepare_loan(loan)
+        download_base, meta = self.prepare_loan(loan, session=session)
         # contains nav/toc and spine, manifest
-        openbook = self.make_request(meta["urls"]["openbook"])
-        rosters: List[Dict] = self.make_request(meta["urls"]["rosters"])
+        openbook = self.make_request(meta["urls"]["openbook"], session=session)
+        rosters: List[Dict] = self.make_request(
+            meta["urls"]["rosters"], session=session
+        )
         return download_base, openbook, rosters
 
     def return_title(self, title_id: str, card_id: str) -> None:
@@ -862,6 +1287,7 @@ class LibbyClient(object):
         self.make_request(
             f"card/{card_id}/loan/{title_id}", method="DELETE", return_res=True
         )
+        self.invalidate_sync_cache()
 
     def return_loan(self, loan: Dict) -> None:
         """
@@ -894,6 +1320,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}/loan/{title_id}", json_data=data, method="POST"
         )
+        self.invalidate_sync_cache()
         return res
 
     def borrow_hold(self, hold: Dict) -> Dict:
@@ -927,6 +1354,7 @@ class LibbyClient(object):
         res: Dict = self.make_request(
             f"card/{card_id}/loan/{title_id}", json_data=data, method="PUT"
         )
+        self.invalidate_sync_cache()
         return res
 
     def renew_loan(self, loan: Dict) -> Dict:
@@ -951,4 +1379,5 @@ class LibbyClient(object):
             json_data={"days_to_suspend": 0, "email_address": ""},
             method="POST",
         )
+        self.invalidate_sync_cache()
         return res
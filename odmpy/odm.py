@@ -22,12 +22,18 @@ import json
 import logging
 import os
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from http.client import HTTPConnection
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, NamedTuple
+from typing import OrderedDict as OrderedDictType
 
+import requests
 from termcolor import colored
+from tqdm import tqdm
 
 from .cli_utils import (
     OdmpyCommands,
@@ -37,7 +43,7 @@ from .cli_utils import (
     DEFAULT_FORMAT_FIELDS,
 )
 from .errors import LibbyNotConfiguredError, OdmpyRuntimeError
-from .libby import LibbyClient, LibbyFormats
+from .libby import LibbyClient, LibbyFormats, PartMeta
 from .libby_errors import ClientBadRequestError, ClientError
 from .overdrive import OverDriveClient
 from .processing import (
@@ -47,12 +53,15 @@ from .processing import (
     process_ebook_loan,
 )
 from .processing.shared import (
+    LoanScheduler,
     generate_names,
     generate_cover,
     get_best_cover_url,
     init_session,
+    init_overdrive_client,
     extract_authors_from_openbook,
 )
+from .transport import DEFAULT_POOL_MAXSIZE, configure_transport
 from .utils import slugify, plural_or_singular_noun as ps
 
 #
@@ -73,6 +82,8 @@ __version__ = "0.8.1"  # also update ../setup.py
 TAGS_ENDPOINT = "https://api.github.com/repos/ping/odmpy/tags"
 REPOSITORY_URL = "https://github.com/ping/odmpy"
 OLD_SETTINGS_FOLDER_DEFAULT = Path("./odmpy_settings")
+MEDIA_BULK_BATCH_SIZE = 25
+PREPARE_LOANS_AHEAD = 2
 
 
 def check_version(timeout: int, max_retries: int) -> None:
@@ -99,6 +110,17 @@ def add_common_libby_arguments(parser_libby: argparse.ArgumentParser) -> None:
         metavar="SETTINGS_FOLDER",
         help="Settings folder to store odmpy required settings, e.g. Libby authentication.",
     )
+    parser_libby.add_argument(
+        "--synccachettl",
+        dest="sync_cache_ttl",
+        type=positive_int,
+        default=0,
+        metavar="SECONDS",
+        help=(
+            "Reuse the Libby account state saved in the settings folder for this many seconds "
+            "instead of fetching it again. Disabled by default."
+        ),
+    )
     parser_libby.add_argument(
         "--ebooks",
         dest="include_ebooks",
@@ -177,6 +199,40 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         default="aac",
         help="Audio codec of merged m4b file. (requires ffmpeg; using libfdk_aac requires ffmpeg compiled with libfdk_aac support). For audiobooks. Has no effect if mergeformat is not set to m4b.",
     )
+    parser_dl.add_argument(
+        "--mergeengine",
+        dest="merge_engine",
+        choices=["native", "ffmpeg"],
+        default="ffmpeg",
+        help=(
+            'How mp3 parts are merged. "native" joins the mp3 frames in-process and\n'
+            'falls back to ffmpeg if the parts cannot be joined that way. Default "ffmpeg".\n'
+            "For audiobooks. Has no effect if mergeformat is not set to mp3."
+        ),
+    )
+    parser_dl.add_argument(
+        "--directm4b",
+        dest="direct_m4b",
+        action="store_true",
+        help=(
+            "Encode the parts straight into the merged m4b in a single ffmpeg pass,\n"
+            "without writing an intermediate merged mp3. For audiobooks.\n"
+            "Has no effect if mergeformat is not set to m4b."
+        ),
+    )
+    parser_dl.add_argument(
+        "--mergejobs",
+        dest="merge_jobs",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help=(
+            "Number of ffmpeg encoders to run concurrently when creating the m4b.\n"
+            "The audio is split at part or chapter boundaries, encoded in segments\n"
+            "and joined gaplessly. Default 1. For audiobooks.\n"
+            "Has no effect if mergeformat is not set to m4b."
+        ),
+    )
     parser_dl.add_argument(
         "-k",
         "--keepcover",
@@ -268,6 +324,61 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         choices=[3, 4],
         help="ID3 v2 version. 3 = v2.3, 4 = v2.4",
     )
+    parser_dl.add_argument(
+        "--parallel",
+        dest="parallel_downloads",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help="Number of audiobook parts to download concurrently. Default 1.",
+    )
+    parser_dl.add_argument(
+        "--segments",
+        dest="download_segments",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help=(
+            "Download each large audiobook part as N concurrent byte ranges.\n"
+            "Default 1 (disabled). See also --segmentminsize."
+        ),
+    )
+    parser_dl.add_argument(
+        "--segmentminsize",
+        dest="segment_min_size_mb",
+        type=positive_int,
+        default=50,
+        metavar="MB",
+        help="Minimum part size in MB before it is downloaded in segments. Default 50.",
+    )
+    if parser_dl.prog == "odmpy libby":
+        parser_dl.add_argument(
+            "--assetjobs",
+            dest="asset_jobs",
+            type=positive_int,
+            default=8,
+            metavar="N",
+            help="Number of ebook/magazine assets to download concurrently. Default 8.",
+        )
+    parser_dl.add_argument(
+        "--streamremux",
+        dest="stream_remux",
+        action="store_true",
+        help=(
+            "Pipe audiobook part downloads directly into ffmpeg for remuxing\n"
+            "instead of saving a temporary .part file first.\n"
+            "Downloads interrupted in this mode cannot be resumed."
+        ),
+    )
+    parser_dl.add_argument(
+        "--alwaysremux",
+        dest="always_remux",
+        action="store_true",
+        help=(
+            "Always remux downloaded audiobook parts with ffmpeg instead of\n"
+            "first trying to repair the mp3 headers in place."
+        ),
+    )
     parser_dl.add_argument(
         "--opf",
         dest="generate_opf",
@@ -336,8 +447,92 @@ def extract_bundled_contents(
                 )
 
 
-def extract_loan_file(
+class PreparedLoan(NamedTuple):
+    """
+    Results of the setup requests for a loan downloaded directly from Libby
+    """
+
+    session: requests.Session
+    openbook: Dict
+    toc: OrderedDictType[str, PartMeta]  # audiobooks
+    rosters: List[Dict]  # ebooks, magazines
+
+
+def get_loan_file_format(
+    libby_client: LibbyClient, selected_loan: Dict, args: argparse.Namespace
+) -> str:
+    """
+    Get the format that a loan file will be extracted as.
+
+    :param libby_client:
+    :param selected_loan:
+    :param args:
+    :return:
+    """
+    format_id = libby_client.get_loan_format(selected_loan)
+    if (
+        args.libby_direct
+        and libby_client.has_format(selected_loan, LibbyFormats.EBookOverdrive)
+        and not (
+            # don't do direct downloads for PDF loans because these turn out badly
+            libby_client.has_format(selected_loan, LibbyFormats.EBookPDFAdobe)
+            or libby_client.has_format(selected_loan, LibbyFormats.EBookPDFOpen)
+        )
+    ):
+        format_id = LibbyFormats.EBookOverdrive
+    return format_id
+
+
+def prepare_loan(
     libby_client: LibbyClient, selected_loan: Dict, args: argparse.Namespace
+) -> Optional[PreparedLoan]:
+    """
+    Do the setup requests (open, cookie, openbook, rosters) for a loan that
+    is downloaded directly from Libby. Each loan gets its own session so that
+    loans can be prepared concurrently.
+
+    :param libby_client:
+    :param selected_loan:
+    :param args:
+    :return: None if the loan is not downloaded directly
+    """
+    if libby_client.is_downloadable_audiobook_loan(selected_loan):
+        if not args.libby_direct:
+            return None
+        session = libby_client.new_session()
+        try:
+            openbook, toc = libby_client.process_audiobook(
+                selected_loan, session=session
+            )
+        except Exception:
+            session.close()
+            raise
+        return PreparedLoan(session, openbook, toc, [])
+
+    try:
+        format_id = get_loan_file_format(libby_client, selected_loan, args)
+    except ValueError:
+        # reported when the loan file is extracted
+        return None
+    if format_id not in (LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive):
+        return None
+    session = libby_client.new_session()
+    try:
+        _, openbook, rosters = libby_client.process_ebook(
+            selected_loan, session=session
+        )
+    except Exception:
+        session.close()
+        raise
+    return PreparedLoan(session, openbook, OrderedDict(), rosters)
+
+
+def extract_loan_file(
+    libby_client: LibbyClient,
+    selected_loan: Dict,
+    args: argparse.Namespace,
+    media_info: Optional[Dict] = None,
+    prepared_loan: Optional[PreparedLoan] = None,
 ) -> Optional[Path]:
     """
     Extracts the ODM / ACSM / EPUB(open) file
@@ -345,10 +540,12 @@ def extract_loan_file(
     :param libby_client:
     :param selected_loan:
     :param args:
+    :param media_info: Prefetched OverDrive media record for the loan
+    :param prepared_loan: From `prepare_loan()`
     :return: The path to the ODM file
     """
     try:
-        format_id = LibbyClient.get_loan_format(selected_loan)
+        format_id = get_loan_file_format(libby_client, selected_loan, args)
     except ValueError as err:
         err_msg = str(err)
         if "kindle" in str(err):
@@ -365,23 +562,16 @@ def extract_loan_file(
     loan_file_path = Path(
         args.download_dir, f"{slugify(file_name, allow_unicode=True)}.{file_ext}"
     )
-    if (
-        args.libby_direct
-        and libby_client.has_format(selected_loan, LibbyFormats.EBookOverdrive)
-        and not (
-            # don't do direct downloads for PDF loans because these turn out badly
-            libby_client.has_format(selected_loan, LibbyFormats.EBookPDFAdobe)
-            or libby_client.has_format(selected_loan, LibbyFormats.EBookPDFOpen)
-        )
-    ):
-        format_id = LibbyFormats.EBookOverdrive
 
     openbook: Dict = {}
     rosters: List[Dict] = []
     # pre-extract openbook first so that we can use it to create the book folder
     # with the creator names (needed to place the cover.jpg download)
     if format_id in (LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive):
-        _, openbook, rosters = libby_client.process_ebook(selected_loan)
+        if prepared_loan:
+            openbook, rosters = prepared_loan.openbook, prepared_loan.rosters
+        else:
+            _, openbook, rosters = libby_client.process_ebook(selected_loan)
 
     cover_path = None
     if format_id in (
@@ -447,20 +637,37 @@ def extract_loan_file(
                 libby_client=libby_client,
                 args=args,
                 logger=logger,
+                media_info=media_info,
+                session=prepared_loan.session if prepared_loan else None,
             )
         else:
             # formats: odm, acsm, open-epub, open-pdf
             try:
-                odm_res_content = libby_client.fulfill_loan_file(
-                    selected_loan["id"], selected_loan["cardId"], format_id
-                )
-                with loan_file_path.open("wb") as f:
-                    f.write(odm_res_content)
-                    logger.info(
-                        'Downloaded %s to "%s"',
-                        file_ext,
-                        colored(str(loan_file_path), "magenta"),
+                with tqdm(
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    desc=f"Downloading {file_ext}",
+                    disable=args.hide_progress,
+                    leave=False,
+                ) as progress_bar:
+
+                    def update_progress(written: int, total: int) -> None:
+                        progress_bar.total = total or None
+                        progress_bar.update(written - progress_bar.n)
+
+                    libby_client.fulfill_loan_file_to(
+                        selected_loan["id"],
+                        selected_loan["cardId"],
+                        format_id,
+                        loan_file_path,
+                        progress=update_progress,
                     )
+                logger.info(
+                    'Downloaded %s to "%s"',
+                    file_ext,
+                    colored(str(loan_file_path), "magenta"),
+                )
             except ClientError as ce:
                 if ce.http_status == 400 and libby_client.is_downloadable_ebook_loan(
                     selected_loan
@@ -488,6 +695,175 @@ def extract_loan_file(
     return loan_file_path
 
 
+def prefetch_media(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    selected_loans: List[Dict],
+    args: argparse.Namespace,
+) -> Dict[str, Dict]:
+    """
+    Fetch the OverDrive media records needed for the selected loans in batches
+    instead of one request per loan.
+
+    :param libby_client:
+    :param overdrive_client:
+    :param selected_loans:
+    :param args:
+    :return: Media records by title id
+    """
+    title_ids = [
+        loan["id"]
+        for loan in selected_loans
+        # audiobooks only need it for the opf
+        if args.generate_opf or not libby_client.is_downloadable_audiobook_loan(loan)
+    ]
+    media_infos: Dict[str, Dict] = {}
+    for i in range(0, len(title_ids), MEDIA_BULK_BATCH_SIZE):
+        batch = title_ids[i : i + MEDIA_BULK_BATCH_SIZE]
+        try:
+            for media_info in overdrive_client.media_bulk(batch):
+                if media_info.get("id"):
+                    media_infos[str(media_info["id"])] = media_info
+        except Exception as err:  # pylint: disable=broad-except
+            # not critical, the processors will fetch what is missing
+            logger.warning("Unable to prefetch media: %s", err)
+    return media_infos
+
+
+def download_loans(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    selected_loans: List[Dict],
+    cards: List[Dict],
+    args: argparse.Namespace,
+) -> None:
+    """
+    Download the selected loans. With --netjobs/--cpujobs, loans are downloaded
+    concurrently so that one loan can download while another is being merged.
+    The setup requests for the next loans are done while the current loans
+    are being downloaded.
+
+    :param libby_client:
+    :param overdrive_client:
+    :param selected_loans:
+    :param cards:
+    :param args:
+    :return:
+    """
+    scheduler = LoanScheduler(
+        network_jobs=args.network_jobs or 1, cpu_jobs=args.cpu_jobs or 1
+    )
+    media_infos = prefetch_media(libby_client, overdrive_client, selected_loans, args)
+    # only a few loans are prepared ahead so that their cookies are still
+    # fresh when they are downloaded
+    prepared_loans: Dict[int, "Future[Optional[PreparedLoan]]"] = {}
+    prepared_loans_lock = threading.Lock()
+    next_loan_to_prepare = [0]
+    executor = ThreadPoolExecutor(
+        max_workers=(args.network_jobs or 1) + PREPARE_LOANS_AHEAD
+    )
+
+    def take_prepared_loan(loan_index: int) -> "Future[Optional[PreparedLoan]]":
+        with prepared_loans_lock:
+            while next_loan_to_prepare[0] <= min(
+                loan_index + PREPARE_LOANS_AHEAD, len(selected_loans) - 1
+            ):
+                prepared_loans[next_loan_to_prepare[0]] = executor.submit(
+                    prepare_loan,
+                    libby_client,
+                    selected_loans[next_loan_to_prepare[0]],
+                    args,
+                )
+                next_loan_to_prepare[0] += 1
+            return prepared_loans.pop(loan_index)
+
+    def download_loan(loan_index: int) -> None:
+        selected_loan = selected_loans[loan_index]
+        logger.info(
+            'Opening %s "%s"...',
+            selected_loan.get("type", {}).get("id"),
+            colored(selected_loan["title"], "blue"),
+        )
+        with scheduler.network():
+            prepared_loan = take_prepared_loan(loan_index).result()
+        try:
+            download_prepared_loan(selected_loan, prepared_loan)
+        finally:
+            if prepared_loan:
+                prepared_loan.session.close()
+
+    def download_prepared_loan(
+        selected_loan: Dict, prepared_loan: Optional[PreparedLoan]
+    ) -> None:
+        if libby_client.is_downloadable_audiobook_loan(selected_loan):
+            if prepared_loan:
+                process_audiobook_loan(
+                    selected_loan,
+                    prepared_loan.openbook,
+                    prepared_loan.toc,
+                    prepared_loan.session,
+                    args,
+                    logger,
+                    scheduler=scheduler,
+                    media_info=media_infos.get(selected_loan["id"]),
+                )
+            else:
+                with scheduler.network():
+                    odm_file = extract_loan_file(libby_client, selected_loan, args)
+                process_odm(
+                    odm_file,
+                    selected_loan,
+                    args,
+                    logger,
+                    cleanup_odm_license=not args.keepodm,
+                    scheduler=scheduler,
+                    media_info=media_infos.get(selected_loan["id"]),
+                )
+            with scheduler.network():
+                extract_bundled_contents(
+                    libby_client,
+                    overdrive_client,
+                    selected_loan,
+                    cards,
+                    args,
+                )
+        elif libby_client.is_downloadable_ebook_loan(
+            selected_loan
+        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
+            with scheduler.network():
+                extract_loan_file(
+                    libby_client,
+                    selected_loan,
+                    args,
+                    media_info=media_infos.get(selected_loan["id"]),
+                    prepared_loan=prepared_loan,
+                )
+
+    try:
+        if args.network_jobs or args.cpu_jobs:
+            scheduler.run(download_loan, range(len(selected_loans)))
+            return
+
+        for loan_index in range(len(selected_loans)):
+            download_loan(loan_index)
+    finally:
+        # loans prepared ahead are not downloaded if an earlier loan has failed
+        with prepared_loans_lock:
+            unused_loans = list(prepared_loans.values())
+            prepared_loans.clear()
+        for prepared_loan_future in unused_loans:
+            prepared_loan_future.cancel()
+        executor.shutdown(wait=True)
+        for prepared_loan_future in unused_loans:
+            if (
+                not prepared_loan_future.cancelled()
+                and not prepared_loan_future.exception()
+            ):
+                unused_loan = prepared_loan_future.result()
+                if unused_loan:
+                    unused_loan.session.close()
+
+
 def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None:
     """
 
@@ -606,6 +982,28 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
             "If the loan with the ID does not exist, it will be skipped."
         ),
     )
+    parser_libby.add_argument(
+        "--netjobs",
+        dest="network_jobs",
+        type=positive_int,
+        metavar="N",
+        help=(
+            "Number of selected loans to download at the same time.\n"
+            "Setting this or --cpujobs lets the next loan start downloading\n"
+            "while the previous one is still being merged/converted."
+        ),
+    )
+    parser_libby.add_argument(
+        "--cpujobs",
+        dest="cpu_jobs",
+        type=positive_int,
+        metavar="N",
+        help=(
+            "Number of selected loans to merge/convert at the same time.\n"
+            "Setting this or --netjobs lets the next loan start downloading\n"
+            "while the previous one is still being merged/converted."
+        ),
+    )
     parser_libby.add_argument(
         "--exportloans",
         dest=OdmpyNoninteractiveOptions.ExportLoans,
@@ -729,6 +1127,17 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         logging.WARNING if logger.level == logging.DEBUG else logging.ERROR
     )
 
+    # size the shared connection pools for the concurrent downloads so that
+    # the connections to the same host are kept alive and reused
+    configure_transport(
+        pool_maxsize=max(
+            DEFAULT_POOL_MAXSIZE,
+            getattr(args, "parallel_downloads", 1)
+            * getattr(args, "download_segments", 1)
+            * (getattr(args, "network_jobs", None) or 1),
+        )
+    )
+
     if not args.dont_check_version:
         check_version(args.timeout, args.retries)
 
@@ -747,6 +1156,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         )
         time.sleep(3)
 
+    overdrive_client: Optional[OverDriveClient] = None
     try:
         # Libby-based commands
         if args.command_name in (
@@ -767,6 +1177,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     max_retries=args.retries,
                     timeout=args.timeout,
                     logger=logger,
+                    sync_cache_ttl=args.sync_cache_ttl,
                 )
             else:
                 libby_client = LibbyClient(
@@ -774,13 +1185,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                     max_retries=args.retries,
                     timeout=args.timeout,
                     logger=logger,
+                    sync_cache_ttl=args.sync_cache_ttl,
                 )
 
-            overdrive_client = OverDriveClient(
-                user_agent=libby_client.user_agent,
-                timeout=args.timeout,
-                retry=args.retries,
-            )
+            overdrive_client = init_overdrive_client(args)
 
             if args.command_name == OdmpyCommands.Libby and args.reset_settings:
                 libby_client.clear_settings()
@@ -939,68 +1347,9 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
                 selected_loans: List[Dict] = [
                     libby_loans[j - 1] for j in selected_loans_indices
                 ]
-                if args.libby_direct:
-                    for selected_loan in selected_loans:
-                        logger.info(
-                            'Opening %s "%s"...',
-                            selected_loan.get("type", {}).get("id"),
-                            colored(selected_loan["title"], "blue"),
-                        )
-                        if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                            openbook, toc = libby_client.process_audiobook(
-                                selected_loan
-                            )
-                            process_audiobook_loan(
-                                selected_loan,
-                                openbook,
-                                toc,
-                                libby_client.libby_session,
-                                args,
-                                logger,
-                            )
-                            extract_bundled_contents(
-                                libby_client,
-                                overdrive_client,
-                                selected_loan,
-                                cards,
-                                args,
-                            )
-                            continue
-                        elif libby_client.is_downloadable_ebook_loan(
-                            selected_loan
-                        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
-                            continue
-                    return
-
-                for selected_loan in selected_loans:
-                    logger.info(
-                        'Opening %s "%s"...',
-                        selected_loan.get("type", {}).get("id"),
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
-                            selected_loan,
-                            args,
-                            logger,
-                            cleanup_odm_license=not args.keepodm,
-                        )
-                        extract_bundled_contents(
-                            libby_client,
-                            overdrive_client,
-                            selected_loan,
-                            cards,
-                            args,
-                        )
-
-                    elif libby_client.is_downloadable_ebook_loan(
-                        selected_loan
-                    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
-                        continue
-
+                download_loans(
+                    libby_client, overdrive_client, selected_loans, cards, args
+                )
                 return  # non-interactive libby downloads
 
             # Interactive mode
@@ -1163,70 +1512,13 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
 
             if args.command_name == OdmpyCommands.Libby:
                 # do downloads
-                if args.libby_direct:
-                    for c in loan_choices:
-                        selected_loan = libby_loans[int(c) - 1]
-                        logger.info(
-                            'Opening %s "%s"...',
-                            selected_loan.get("type", {}).get("id"),
-                            colored(selected_loan["title"], "blue"),
-                        )
-                        if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                            openbook, toc = libby_client.process_audiobook(
-                                selected_loan
-                            )
-                            process_audiobook_loan(
-                                selected_loan,
-                                openbook,
-                                toc,
-                                libby_client.libby_session,
-                                args,
-                                logger,
-                            )
-                            extract_bundled_contents(
-                                libby_client,
-                                overdrive_client,
-                                selected_loan,
-                                cards,
-                                args,
-                            )
-                            continue
-                        elif libby_client.is_downloadable_ebook_loan(
-                            selected_loan
-                        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
-                            continue
-
-                    return
-
-                for c in loan_choices:
-                    selected_loan = libby_loans[int(c) - 1]
-                    logger.info(
-                        'Opening %s "%s"...',
-                        selected_loan.get("type", {}).get("id"),
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
-                            selected_loan,
-                            args,
-                            logger,
-                            cleanup_odm_license=not args.keepodm,
-                        )
-                        extract_bundled_contents(
-                            libby_client,
-                            overdrive_client,
-                            selected_loan,
-                            cards,
-                            args,
-                        )
-                        continue
-                    elif libby_client.is_downloadable_ebook_loan(
-                        selected_loan
-                    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
-                        continue
+                download_loans(
+                    libby_client,
+                    overdrive_client,
+                    [libby_loans[int(c) - 1] for c in loan_choices],
+                    cards,
+                    args,
+                )
                 return
 
             return  # end libby commands
@@ -1267,5 +1559,9 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         logger.exception(colored("An unexpected error has occurred", "red"))
         raise
 
+    finally:
+        if overdrive_client:
+            overdrive_client.close()
+
     # we shouldn't get this error
     logger.error("Unknown command: %s", colored(args.command_name, "red"))
@@ -16,12 +16,20 @@
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import email.utils
+import json
 import logging
-from typing import Optional, Dict, List
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, List, NamedTuple, Union
 from urllib.parse import urljoin
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
+
+from .transport import new_session
+from .utils import log_response_body
 
 #
 # Basic skeletal client for the OverDrive Thunder API
@@ -34,6 +42,164 @@ USER_AGENT = (
 SITE_URL = "https://libbyapp.com"
 THUNDER_API_URL = "https://thunder.api.overdrive.com/v2/"
 CLIENT_ID = "dewey"
+CACHE_MAX_SIZE = 20 * 1024 * 1024
+
+
+class CachedResponse(NamedTuple):
+    body: str
+    content_type: str
+    etag: str
+    last_modified: str
+    expires: float
+
+
+class ResponseCache(object):
+    """
+    A small SQLite-backed HTTP cache for GET responses.
+
+    Responses are kept according to their Cache-Control/Expires headers and
+    revalidated with their ETag/Last-Modified validators once stale. The least
+    recently used entries are evicted when the total size exceeds `max_size`.
+    """
+
+    def __init__(self, cache_file: Union[str, Path], max_size: int = CACHE_MAX_SIZE):
+        """
+        :param cache_file: Path to the SQLite database
+        :param max_size: Maximum total size of the cached bodies in bytes
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(cache_file), timeout=10, check_same_thread=False
+        )
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "url TEXT PRIMARY KEY, body TEXT NOT NULL, content_type TEXT NOT NULL, "
+                "etag TEXT NOT NULL, last_modified TEXT NOT NULL, expires REAL NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def freshness_lifetime(headers) -> Optional[float]:
+        """
+        Seconds that a response stays fresh, or None if it must not be stored.
+
+        :param headers: Response headers
+        :return:
+        """
+        directives: Dict[str, str] = {}
+        for directive in headers.get("cache-control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip('"')
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return 0
+        if "max-age" in directives:
+            try:
+                return max(
+                    0, int(directives["max-age"]) - int(headers.get("age", "0") or 0)
+                )
+            except ValueError:
+                return 0
+        if headers.get("expires"):
+            try:
+                expires = email.utils.parsedate_to_datetime(headers["expires"])
+                return max(0, expires.timestamp() - time.time())
+            except (TypeError, ValueError):
+                return 0
+        return 0
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """
+        Get a cached response.
+
+        :param url:
+        :return:
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT body, content_type, etag, last_modified, expires "
+                "FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), url)
+            )
+        return CachedResponse(*row)
+
+    def put(self, url: str, res: requests.Response) -> None:
+        """
+        Store a response if its headers allow it.
+
+        :param url:
+        :param res:
+        :return:
+        """
+        lifetime = self.freshness_lifetime(res.headers)
+        etag = res.headers.get("etag", "")
+        last_modified = res.headers.get("last-modified", "")
+        if lifetime is None or not (lifetime or etag or last_modified):
+            # uncacheable, or stale with no way to revalidate
+            return
+        body = res.text
+        size = len(body.encode("utf-8"))
+        if size > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    body,
+                    res.headers.get("content-type", ""),
+                    etag,
+                    last_modified,
+                    now + lifetime,
+                    size,
+                    now,
+                ),
+            )
+            self._evict()
+
+    def refresh(self, url: str, res: requests.Response) -> None:
+        """
+        Extend the freshness of a cached response after a 304 Not Modified.
+
+        :param url:
+        :param res:
+        :return:
+        """
+        lifetime = self.freshness_lifetime(res.headers)
+        with self._lock, self._conn:
+            if lifetime is None:
+                self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                return
+            self._conn.execute(
+                "UPDATE responses SET expires = ? WHERE url = ?",
+                (time.time() + lifetime, url),
+            )
+
+    def _evict(self) -> None:
+        # keep the most recently used entries that fit within max_size
+        total_size = 0
+        evicted = []
+        for url, size in self._conn.execute(
+            "SELECT url, size FROM responses ORDER BY accessed DESC"
+        ):
+            total_size += size
+            if total_size > self.max_size:
+                evicted.append((url,))
+        if evicted:
+            self._conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+
+    def close(self) -> None:
+        self._conn.close()
 
 
 class OverDriveClient(object):
@@ -49,18 +215,44 @@ class OverDriveClient(object):
             - user_agent: User Agent string for requests
             - timeout: The timeout interval for a network request. Default 15 (seconds).
             - retries: The number of times to retry a network request on failure. Default 0.
+            - cache_file: Path to an SQLite database to cache responses in. Default None (no caching).
+            - cache_max_size: Maximum size of the cache in bytes.
         """
         self.logger = logging.getLogger(__name__)
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
         self.timeout = int(kwargs.pop("timeout", 15))
         self.retries = int(kwargs.pop("retry", 0))
 
-        session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=self.retries, backoff_factor=0.1))
-        # noinspection HttpUrlsUsage
-        for prefix in ("http://", "https://"):
-            session.mount(prefix, adapter)
-        self.session = kwargs.pop("session", None) or session
+        session = kwargs.pop("session", None)
+        # a session that was passed in is left for its owner to close
+        self._owns_session = session is None
+        self.session = session or new_session(self.retries)
+        cache_file = kwargs.pop("cache_file", None)
+        self.cache: Optional[ResponseCache] = (
+            ResponseCache(
+                cache_file, max_size=kwargs.pop("cache_max_size", CACHE_MAX_SIZE)
+            )
+            if cache_file
+            else None
+        )
+
+    def close(self) -> None:
+        """
+        Close the response cache, and the session if it was created by the client.
+
+        :return:
+        """
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self) -> "OverDriveClient":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
 
     def default_headers(self) -> Dict:
         """
@@ -120,13 +312,34 @@ class OverDriveClient(object):
             params=params,
             data=data,
         )
-        res = self.session.send(self.session.prepare_request(req), timeout=self.timeout)
-        self.logger.debug("body: %s", res.text)
+        prepared_req = self.session.prepare_request(req)
+        cache = self.cache if method == "GET" else None
+        cached = cache.get(prepared_req.url or "") if cache else None
+        if cached:
+            if cached.expires > time.time():
+                return self._decode(cached.content_type, cached.body)
+            # stale, revalidate
+            if cached.etag:
+                prepared_req.headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                prepared_req.headers["If-Modified-Since"] = cached.last_modified
+
+        res = self.session.send(prepared_req, timeout=self.timeout)
+        if cache and cached and res.status_code == 304:
+            cache.refresh(prepared_req.url or "", res)
+            return self._decode(cached.content_type, cached.body)
+        log_response_body(self.logger, res)
         res.raise_for_status()
+        if cache:
+            cache.put(prepared_req.url or "", res)
+
+        return self._decode(res.headers.get("content-type", ""), res.text)
 
-        if res.headers.get("content-type", "").startswith("application/json"):
-            return res.json()
-        return res.text
+    @staticmethod
+    def _decode(content_type: str, body: str):
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        return body
 
     def media(self, title_id: str, **kwargs) -> Dict:
         """
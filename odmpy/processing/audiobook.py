@@ -20,7 +20,7 @@ import argparse
 import datetime
 import json
 import logging
-import shutil
+from functools import partial
 from typing import Optional, Any, Dict, List
 from typing import OrderedDict as OrderedDictType
 
@@ -29,22 +29,33 @@ import requests
 from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
 from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
 
 from .shared import (
+    init_overdrive_client,
+    download_part,
+    can_stream_remux,
+    stream_remux_part,
+    run_pipeline,
+    remux_workers,
+    PipelineStage,
+    ProgressPositions,
+    LoanScheduler,
     generate_names,
     write_tags,
     generate_cover,
     remux_mp3,
     merge_into_mp3,
     convert_to_m4b,
+    merge_into_m4b,
+    m4b_metadata_tags,
     create_opf,
     get_best_cover_url,
     extract_isbn,
 )
 from ..errors import OdmpyRuntimeError
 from ..libby import USER_AGENT, merge_toc, PartMeta, LibbyFormats
-from ..overdrive import OverDriveClient
+from ..retries import RetryPolicy
+from ..transport import disable_retries
 from ..utils import slugify, plural_or_singular_noun as ps
 
 
@@ -60,6 +71,8 @@ def process_audiobook_loan(
     session: requests.Session,
     args: argparse.Namespace,
     logger: logging.Logger,
+    scheduler: Optional[LoanScheduler] = None,
+    media_info: Optional[Dict] = None,
 ) -> None:
     """
     Download the audiobook loan directly via Libby without the use of
@@ -71,8 +84,11 @@ def process_audiobook_loan(
     :param session: From `LibbyClient.libby_session` because it contains a needed auth cookie
     :param args:
     :param logger:
+    :param scheduler: shared by the loans being downloaded together
+    :param media_info: Prefetched OverDrive media record for the loan
     :return:
     """
+    scheduler = scheduler or LoanScheduler()
 
     ffmpeg_loglevel = "info" if logger.level == logging.DEBUG else "fatal"
     id3v2_version = ID3_DEFAULT_VERSION
@@ -191,9 +207,17 @@ def process_audiobook_loan(
     )
 
     keep_cover = args.always_keep_cover
-    file_tracks = []
-    audio_bitrate = 0
-    for p in download_parts:
+    progress_positions = ProgressPositions(args.parallel_downloads)
+    retry_policy = RetryPolicy(max_retries=args.retries, logger=logger)
+    # part downloads are retried by the policy only
+    disable_retries(session)
+
+    # Parts go through download -> remux -> tag as a pipeline so that the
+    # next part is downloading while the previous one is remuxed and tagged.
+    # Stages run on their own threads, so they should only touch the part
+    # passed in and not any state shared across parts.
+
+    def download_stage(p: PartMeta) -> Dict[str, Any]:
         part_number = p["spine-position"] + 1
         part_filename = book_folder.joinpath(
             f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
@@ -201,143 +225,192 @@ def process_audiobook_loan(
         part_tmp_filename = part_filename.with_suffix(".part")
         part_file_size = p["file-length"]
         part_download_url = p["url"]
+        part: Dict[str, Any] = {
+            "file": part_filename,
+            "number": part_number,
+            "chapters": p["chapters"],
+            "is_new": False,
+            "is_remuxed": False,
+            "bitrate": None,
+            "id3_error": False,
+        }
 
         if part_filename.exists():
             logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
-        else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": USER_AGENT,
-                        "Range": f"bytes={already_downloaded_len}-"
-                        if already_downloaded_len
-                        else None,
-                    },
-                    timeout=args.timeout,
-                    stream=True,
-                )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
-                remux_mp3(
-                    part_tmp_filename=part_tmp_filename,
-                    part_filename=part_filename,
-                    ffmpeg_loglevel=ffmpeg_loglevel,
-                    logger=logger,
-                )
+            return part
+
+        def fetch_part() -> None:
+            # a retry resumes from the partial download, if any
+            with progress_positions.acquire() as progress_position:
+                if can_stream_remux(args, part_tmp_filename, part_file_size):
+                    stream_remux_part(
+                        session=session,
+                        part_download_url=part_download_url,
+                        headers={"User-Agent": USER_AGENT},
+                        part_filename=part_filename,
+                        part_file_size=part_file_size,
+                        desc=f"Part {part_number:2d}",
+                        timeout=args.timeout,
+                        hide_progress=args.hide_progress,
+                        ffmpeg_loglevel=ffmpeg_loglevel,
+                        logger=logger,
+                        progress_position=progress_position,
+                    )
+                    part["is_remuxed"] = True
+                else:
+                    download_part(
+                        session=session,
+                        part_download_url=part_download_url,
+                        headers={"User-Agent": USER_AGENT},
+                        part_tmp_filename=part_tmp_filename,
+                        part_file_size=part_file_size,
+                        desc=f"Part {part_number:2d}",
+                        timeout=args.timeout,
+                        hide_progress=args.hide_progress,
+                        progress_position=progress_position,
+                        segments=args.download_segments,
+                        segment_min_size=args.segment_min_size_mb * 1024 * 1024,
+                    )
 
-            except HTTPError as he:
-                logger.error(f"HTTPError: {str(he)}")
-                logger.debug(he.response.content)
-                raise OdmpyRuntimeError("HTTP Error while downloading part file.")
-
-            except ConnectionError as ce:
-                logger.error(f"ConnectionError: {str(ce)}")
-                raise OdmpyRuntimeError("Connection Error while downloading part file.")
-
-            # Save id3 info only on new download, ref #42
-            # This also makes handling of part files consistent with merged files
-            try:
-                # Fill id3 info for mp3 part
-                audiofile = eyed3.load(part_filename)
-                variable_bitrate, audio_bitrate = audiofile.info.bit_rate
-                if variable_bitrate:
-                    # don't use vbr
-                    audio_bitrate = 0
-                write_tags(
-                    audiofile=audiofile,
-                    title=title,
-                    sub_title=sub_title,
-                    authors=authors,
-                    narrators=narrators,
-                    publisher=publisher,
-                    description=description,
-                    cover_bytes=cover_bytes,
-                    genres=subjects,
-                    languages=languages,
-                    published_date=publish_date,
-                    series=series,
-                    part_number=part_number,
-                    total_parts=len(download_parts),
-                    overdrive_id=overdrive_media_id,
-                    isbn=extract_isbn(
-                        loan.get("formats", []), [LibbyFormats.AudioBookMP3]
-                    ),
-                    always_overwrite=args.overwrite_tags,
-                    delimiter=args.tag_delimiter,
-                )
-                audiofile.tag.save(version=id3v2_version)
+        try:
+            retry_policy.call(fetch_part, part_download_url)
+        except HTTPError as he:
+            logger.error(f"HTTPError: {str(he)}")
+            logger.debug(he.response.content)
+            raise OdmpyRuntimeError("HTTP Error while downloading part file.")
+
+        except ConnectionError as ce:
+            logger.error(f"ConnectionError: {str(ce)}")
+            raise OdmpyRuntimeError("Connection Error while downloading part file.")
+
+        part["is_new"] = True
+        return part
+
+    def remux_stage(part: Dict[str, Any]) -> Dict[str, Any]:
+        if part["is_new"] and not part["is_remuxed"]:
+            # try to remux file to remove mp3 lame tag errors
+            remux_mp3(
+                part_tmp_filename=part["file"].with_suffix(".part"),
+                part_filename=part["file"],
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                logger=logger,
+                always_remux=args.always_remux,
+            )
+        return part
 
-                if (
-                    args.add_chapters
-                    and not args.merge_output
-                    and (args.overwrite_tags or not audiofile.tag.table_of_contents)
-                ):
-                    if args.overwrite_tags and audiofile.tag.table_of_contents:
-                        # Clear existing toc to prevent "There may only be one top-level table of contents.
-                        # Toc 'b'toc'' is current top-level." error
-                        for f in list(audiofile.tag.table_of_contents):
-                            audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-                    toc = audiofile.tag.table_of_contents.set(
-                        "toc".encode("ascii"),
-                        toplevel=True,
-                        ordered=True,
-                        child_ids=[],
-                        description="Table of Contents",
-                    )
-                    chapter_marks = p["chapters"]
-                    for i, m in enumerate(chapter_marks):
-                        title_frameset = eyed3.id3.frames.FrameSet()
-                        title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                        chap = audiofile.tag.chapters.set(
-                            f"ch{i:02d}".encode("ascii"),
-                            times=(
-                                round(m.start_second * 1000),
-                                round(m.end_second * 1000),
-                            ),
-                            sub_frames=title_frameset,
-                        )
-                        toc.child_ids.append(chap.element_id)
-                        start_time = datetime.timedelta(seconds=m.start_second)
-                        end_time = datetime.timedelta(seconds=m.end_second)
-                        logger.debug(
-                            'Added chap tag => %s: %s-%s "%s" to "%s"',
-                            colored(f"ch{i:02d}", "cyan"),
-                            start_time,
-                            end_time,
-                            colored(m.title, "cyan"),
-                            colored(str(part_filename), "blue"),
-                        )
-                    audiofile.tag.save(version=id3v2_version)
+    def tag_stage(part: Dict[str, Any]) -> Dict[str, Any]:
+        if not part["is_new"]:
+            return part
 
-            except Exception as e:  # pylint: disable=broad-except
-                logger.warning(
-                    "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+        part_filename = part["file"]
+        part_number = part["number"]
+        # Save id3 info only on new download, ref #42
+        # This also makes handling of part files consistent with merged files
+        try:
+            # Fill id3 info for mp3 part
+            audiofile = eyed3.load(part_filename)
+            variable_bitrate, part_bitrate = audiofile.info.bit_rate
+            if variable_bitrate:
+                # don't use vbr
+                part_bitrate = 0
+            part["bitrate"] = part_bitrate
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=publish_date,
+                series=series,
+                part_number=part_number,
+                total_parts=len(download_parts),
+                overdrive_id=overdrive_media_id,
+                isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
+            audiofile.tag.save(version=id3v2_version)
+
+            if (
+                args.add_chapters
+                and not args.merge_output
+                and (args.overwrite_tags or not audiofile.tag.table_of_contents)
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
                 )
-                keep_cover = True
+                chapter_marks = part["chapters"]
+                for i, m in enumerate(chapter_marks):
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
+                    chap = audiofile.tag.chapters.set(
+                        f"ch{i:02d}".encode("ascii"),
+                        times=(
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
+                        ),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(seconds=m.start_second)
+                    end_time = datetime.timedelta(seconds=m.end_second)
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(f"ch{i:02d}", "cyan"),
+                        start_time,
+                        end_time,
+                        colored(m.title, "cyan"),
+                        colored(str(part_filename), "blue"),
+                    )
+                audiofile.tag.save(version=id3v2_version)
 
-            logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(
+                "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+            )
+            part["id3_error"] = True
 
-        file_tracks.append({"file": part_filename})
+        logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
+        return part
+
+    file_tracks = []
+    audio_bitrate = 0
+    # results are in spine order regardless of which part finished first
+    part_results = run_pipeline(
+        download_parts,
+        [
+            # only the downloads take up the loan's network slot
+            PipelineStage(
+                download_stage,
+                workers=args.parallel_downloads,
+                slot=partial(scheduler.network, progress_positions),
+            ),
+            PipelineStage(remux_stage, workers=remux_workers(args.parallel_downloads)),
+            # eyed3 is pure python so more threads would not help
+            PipelineStage(tag_stage, workers=1),
+        ],
+    )
+    for part_result in part_results:
+        if part_result["bitrate"] is not None:
+            audio_bitrate = part_result["bitrate"]
+        if part_result["id3_error"]:
+            keep_cover = True
+        file_tracks.append({"file": part_result["file"]})
 
     debug_meta["file_tracks"] = [{"file": str(ft["file"])} for ft in file_tracks]
     if args.merge_output:
@@ -349,105 +422,157 @@ def process_audiobook_loan(
             ),
         )
 
-        merge_into_mp3(
-            book_filename=book_filename,
-            file_tracks=file_tracks,
-            audio_bitrate=audio_bitrate,
-            ffmpeg_loglevel=ffmpeg_loglevel,
-            hide_progress=args.hide_progress,
-            logger=logger,
-        )
-
-        audiofile = eyed3.load(book_filename)
-        write_tags(
-            audiofile=audiofile,
-            title=title,
-            sub_title=sub_title,
-            authors=authors,
-            narrators=narrators,
-            publisher=publisher,
-            description=description,
-            cover_bytes=cover_bytes,
-            genres=subjects,
-            languages=languages,
-            published_date=publish_date,
-            series=series,
-            part_number=0,
-            total_parts=0,
-            overdrive_id=overdrive_media_id,
-            isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
-            always_overwrite=args.overwrite_tags,
-            delimiter=args.tag_delimiter,
-        )
-
-        if args.add_chapters and (
-            args.overwrite_tags or not audiofile.tag.table_of_contents
-        ):
-            if args.overwrite_tags and audiofile.tag.table_of_contents:
-                # Clear existing toc to prevent "There may only be one top-level table of contents.
-                # Toc 'b'toc'' is current top-level." error
-                for f in list(audiofile.tag.table_of_contents):
-                    audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-            toc = audiofile.tag.table_of_contents.set(
-                "toc".encode("ascii"),
-                toplevel=True,
-                ordered=True,
-                child_ids=[],
-                description="Table of Contents",
-            )
-            merged_markers = merge_toc(parsed_toc)
+        if args.merge_format == "m4b" and args.direct_m4b:
+            merged_markers = merge_toc(parsed_toc) if args.add_chapters else []
             debug_meta["merged_markers"] = [
                 {"title": m.title, "start": m.start_second, "end": m.end_second}
                 for m in merged_markers
             ]
-
-            for i, m in enumerate(merged_markers):
-                title_frameset = eyed3.id3.frames.FrameSet()
-                title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                chap = audiofile.tag.chapters.set(
-                    f"ch{i}".encode("ascii"),
-                    times=(round(m.start_second * 1000), round(m.end_second * 1000)),
-                    sub_frames=title_frameset,
+            with scheduler.cpu():
+                merge_into_m4b(
+                    book_m4b_filename=book_m4b_filename,
+                    file_tracks=file_tracks,
+                    tags=m4b_metadata_tags(
+                        title=title,
+                        authors=authors,
+                        narrators=narrators,
+                        publisher=publisher,
+                        description=description,
+                        genres=subjects,
+                        languages=languages,
+                        published_date=publish_date,
+                        series=series,
+                        delimiter=args.tag_delimiter,
+                    ),
+                    chapters=[
+                        (
+                            m.title,
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
+                        )
+                        for m in merged_markers
+                    ],
+                    cover_filename=cover_filename,
+                    merge_codec=args.merge_codec,
+                    audio_bitrate=audio_bitrate,
+                    ffmpeg_loglevel=ffmpeg_loglevel,
+                    hide_progress=args.hide_progress,
+                    logger=logger,
+                    jobs=args.merge_jobs,
                 )
-                toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(seconds=m.start_second)
-                end_time = datetime.timedelta(seconds=m.end_second)
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(f"ch{i}", "cyan"),
-                    start_time,
-                    end_time,
-                    colored(m.title, "cyan"),
-                    colored(str(book_filename), "blue"),
+        else:
+            with scheduler.cpu():
+                merge_into_mp3(
+                    book_filename=book_filename,
+                    file_tracks=file_tracks,
+                    audio_bitrate=audio_bitrate,
+                    ffmpeg_loglevel=ffmpeg_loglevel,
+                    hide_progress=args.hide_progress,
+                    logger=logger,
+                    # native merging is only used for mp3 output
+                    merge_engine=args.merge_engine
+                    if args.merge_format == "mp3"
+                    else "ffmpeg",
                 )
 
-        audiofile.tag.save(version=id3v2_version)
+            audiofile = eyed3.load(book_filename)
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=publish_date,
+                series=series,
+                part_number=0,
+                total_parts=0,
+                overdrive_id=overdrive_media_id,
+                isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
 
-        if args.merge_format == "mp3":
-            logger.info(
-                'Merged files into "%s"',
-                colored(
-                    str(
-                        book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
+            if args.add_chapters and (
+                args.overwrite_tags or not audiofile.tag.table_of_contents
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
+                )
+                merged_markers = merge_toc(parsed_toc)
+                debug_meta["merged_markers"] = [
+                    {"title": m.title, "start": m.start_second, "end": m.end_second}
+                    for m in merged_markers
+                ]
+
+                for i, m in enumerate(merged_markers):
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
+                    chap = audiofile.tag.chapters.set(
+                        f"ch{i}".encode("ascii"),
+                        times=(
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
+                        ),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(seconds=m.start_second)
+                    end_time = datetime.timedelta(seconds=m.end_second)
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(f"ch{i}", "cyan"),
+                        start_time,
+                        end_time,
+                        colored(m.title, "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
+
+            audiofile.tag.save(version=id3v2_version)
+
+            if args.merge_format == "mp3":
+                logger.info(
+                    'Merged files into "%s"',
+                    colored(
+                        str(
+                            book_filename
+                            if args.merge_format == "mp3"
+                            else book_m4b_filename
+                        ),
+                        "magenta",
                     ),
-                    "magenta",
-                ),
-            )
+                )
 
-        if args.merge_format == "m4b":
-            convert_to_m4b(
-                book_filename=book_filename,
-                book_m4b_filename=book_m4b_filename,
-                cover_filename=cover_filename,
-                merge_codec=args.merge_codec,
-                audio_bitrate=audio_bitrate,
-                ffmpeg_loglevel=ffmpeg_loglevel,
-                hide_progress=args.hide_progress,
-                logger=logger,
-            )
+            if args.merge_format == "m4b":
+                with scheduler.cpu():
+                    convert_to_m4b(
+                        book_filename=book_filename,
+                        book_m4b_filename=book_m4b_filename,
+                        cover_filename=cover_filename,
+                        merge_codec=args.merge_codec,
+                        audio_bitrate=audio_bitrate,
+                        ffmpeg_loglevel=ffmpeg_loglevel,
+                        hide_progress=args.hide_progress,
+                        logger=logger,
+                        jobs=args.merge_jobs,
+                        split_points_ms=[
+                            round(m.start_second * 1000) for m in merge_toc(parsed_toc)
+                        ],
+                    )
 
         if not args.keep_mp3:
             for file_track in file_tracks:
@@ -470,10 +595,9 @@ def process_audiobook_loan(
                 f"{slugify(title, allow_unicode=True)}.opf"
             )
         if not opf_file_path.exists():
-            od_client = OverDriveClient(
-                user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
-            )
-            media_info = od_client.media(loan["id"])
+            if not media_info:
+                with init_overdrive_client(args) as od_client:
+                    media_info = od_client.media(loan["id"])
             create_opf(
                 media_info,
                 cover_filename if keep_cover else None,
@@ -18,40 +18,66 @@
 
 import argparse
 import base64
+import binascii
 import datetime
+import importlib.util
+import io
 import json
 import logging
 import os
 import re
 import shutil
+import time
 import xml.etree.ElementTree as ET
-import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cmp_to_key
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 from urllib.parse import urlparse, urljoin
 
-import bs4.element
 import requests
 from bs4 import BeautifulSoup, Doctype, Tag
+from bs4.dammit import UnicodeDammit
 from termcolor import colored
 from tqdm import tqdm
 
+from .epub import EpubBuilder
 from .shared import (
+    init_overdrive_client,
     generate_names,
     build_opf_package,
     extract_isbn,
     extract_authors_from_openbook,
 )
 from ..errors import OdmpyRuntimeError
-from ..libby import USER_AGENT, LibbyClient, LibbyFormats, LibbyMediaTypes
-from ..overdrive import OverDriveClient
+from ..libby import LibbyClient, LibbyFormats, LibbyMediaTypes
 from ..utils import slugify, is_windows, guess_mimetype
 
 #
 # Main processing logic for libby direct ebook and magazine loans
 #
 
+# lxml is a lot faster than the builtin parser
+CONTENT_PAGE_PARSER = (
+    "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+)
+CONTENT_PAGE_PAYLOAD_RE = re.compile(
+    r"parent\.__bif_cfc0\(self,'(?P<base64_text>[^']+)'\)"
+)
+CONTENT_PAGE_BODY_RE = re.compile(r"<body\b.*</body\s*>", re.IGNORECASE | re.DOTALL)
+# the xml declaration, doctype and whitespace before the html element
+CONTENT_PAGE_PROLOG_RE = re.compile(r"^.*?(?=<html\b)", re.IGNORECASE | re.DOTALL)
+
 NAV_XHTMLTEMPLATE = """
 <!DOCTYPE html>
 <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
@@ -207,59 +233,177 @@ def _sanitise_opf_id(string_id: str) -> str:
     return string_id
 
 
-def _cleanup_soup(soup: BeautifulSoup, version: str = "2.0") -> None:
+def _decode_content_page(
+    page_text: str, parser: str = CONTENT_PAGE_PARSER
+) -> Tuple[BeautifulSoup, bool]:
+    """
+    Parse a book content page, replacing the obfuscated body with the
+    base64 encoded body in the page script.
+
+    The body is spliced into the page text before parsing, so that the page
+    is parsed only once.
+
+    :param page_text:
+    :param parser: BeautifulSoup parser
+    :return: The parsed page, and if the page had a body to decode
+    """
+    mobj = CONTENT_PAGE_PAYLOAD_RE.search(page_text)
+    body_text = None
+    if mobj:
+        try:
+            body_bytes = base64.b64decode(mobj.group("base64_text"))
+            try:
+                body_text = body_bytes.decode("utf-8")
+            except UnicodeDecodeError:
+                body_text = UnicodeDammit(body_bytes).unicode_markup
+        except (binascii.Error, ValueError):
+            body_text = None
+    if body_text is not None:
+        body_mobj = CONTENT_PAGE_BODY_RE.search(body_text)
+        body_text = body_mobj.group(0) if body_mobj else f"<body>{body_text}</body>"
+        page_text, replaced = CONTENT_PAGE_BODY_RE.subn(
+            lambda _: body_text or "", page_text, count=1
+        )
+        if not replaced:
+            body_text = None
+    prolog = ""
+    if parser != "html.parser":
+        # lxml turns the xml declaration into a comment and drops the
+        # whitespace around the doctype, so the prolog is parsed separately
+        # to keep the page serialised as it was
+        prolog_mobj = CONTENT_PAGE_PROLOG_RE.match(page_text)
+        if prolog_mobj:
+            prolog = prolog_mobj.group(0)
+            page_text = page_text[len(prolog) :]
+    soup = BeautifulSoup(page_text, features=parser)
+    if prolog:
+        for node in reversed(
+            list(BeautifulSoup(prolog, features="html.parser").contents)
+        ):
+            soup.insert(0, node.extract())
+    return soup, body_text is not None
+
+
+class PageFacts(NamedTuple):
+    """Details of a content page, collected while it is cleaned up."""
+
+    has_svg: bool = False
+    # has the epub:type="toc" nav
+    is_nav: bool = False
+    # src of the first img
+    first_img_src: Optional[str] = None
+
+
+# epub 2 is a lot pickier about the acceptable elements and attributes
+EPUB2_DOCTYPE = 'html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd"'
+EPUB2_REMOVE_ATTRIBUTES = (
+    # this list will not be complete, but we try
+    "aria-label",
+    "data-loc",
+    "data-epub-type",
+    "data-document-status",
+    "data-xml-lang",
+    "lang",
+    "role",
+    "epub:type",
+    "epub:prefix",
+)
+EPUB2_CONVERT_TAGS = ("nav", "section")  # this list will not be complete, but we try
+# known issues, this will not be complete
+CONVERT_TAGS = ("figcaption",)
+REMOVE_TAGS = ("base",)
+
+
+def _cleanup_soup(soup: BeautifulSoup, version: str = "2.0") -> PageFacts:
     """
     Tries to fix up book content pages to be epub-version compliant.
+    All the fixes are done in a single walk of the page, which also
+    collects the page details needed for the manifest.
 
     :param soup:
     :param version:
-    :return:
+    :return: Details of the cleaned up page
     """
-    if version == "2.0":
-        # v2 is a lot pickier about the acceptable elements and attributes
-        modified_doctype = 'html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd"'
+    is_epub2 = version == "2.0"
+    if is_epub2:
         for item in soup.contents:
             if isinstance(item, Doctype):
-                item.replace_with(Doctype(modified_doctype))
+                item.replace_with(Doctype(EPUB2_DOCTYPE))
                 break
-        remove_attributes = [
-            # this list will not be complete, but we try
-            "aria-label",
-            "data-loc",
-            "data-epub-type",
-            "data-document-status",
-            "data-xml-lang",
-            "lang",
-            "role",
-            "epub:type",
-            "epub:prefix",
-        ]
-        for attribute in remove_attributes:
-            for tag in soup.find_all(attrs={attribute: True}):
-                del tag[attribute]
-        convert_tags = ["nav", "section"]  # this list will not be complete, but we try
-        for tag in convert_tags:
-            for invalid_tag in soup.find_all(tag):
-                invalid_tag.name = "div"
-
-    # known issues, this will not be complete
-    for svg in soup.find_all("svg"):
-        if not svg.get("xmlns"):
-            svg["xmlns"] = "http://www.w3.org/2000/svg"
-        if not svg.get("xmlns:xlink"):
-            svg["xmlns:xlink"] = "http://www.w3.org/1999/xlink"
-    convert_tags = ["figcaption"]
-    for tag in convert_tags:
-        for invalid_tag in soup.find_all(tag):
-            invalid_tag.name = "div"
-    remove_tags = ["base"]
-    for tag in remove_tags:
-        for remove_tag in soup.find_all(tag):
-            remove_tag.decompose()
-
-    html_tag = soup.find("html")
-    if html_tag and isinstance(html_tag, bs4.element.Tag) and not html_tag.get("xmlns"):
-        html_tag["xmlns"] = "http://www.w3.org/1999/xhtml"
+
+    has_svg = False
+    is_nav = False
+    first_img_src = None
+    html_tag = None
+    for tag in soup.find_all(True):
+        if is_epub2:
+            for attribute in EPUB2_REMOVE_ATTRIBUTES:
+                if attribute in tag.attrs:
+                    del tag[attribute]
+            if tag.name in EPUB2_CONVERT_TAGS:
+                tag.name = "div"
+        elif not is_nav and tag.get("epub:type") == "toc":
+            is_nav = True
+
+        if tag.name == "svg":
+            has_svg = True
+            if not tag.get("xmlns"):
+                tag["xmlns"] = "http://www.w3.org/2000/svg"
+            if not tag.get("xmlns:xlink"):
+                tag["xmlns:xlink"] = "http://www.w3.org/1999/xlink"
+        elif tag.name in CONVERT_TAGS:
+            tag.name = "div"
+        elif tag.name in REMOVE_TAGS:
+            tag.decompose()
+        elif tag.name == "img" and first_img_src is None and tag.has_attr("src"):
+            first_img_src = tag["src"]
+        elif tag.name == "html" and html_tag is None:
+            html_tag = tag
+            if not tag.get("xmlns"):
+                tag["xmlns"] = "http://www.w3.org/1999/xhtml"
+
+    return PageFacts(has_svg=has_svg, is_nav=is_nav, first_img_src=first_img_src)
+
+
+def _xml_to_bytes(element: ET.Element) -> bytes:
+    """
+    Serialise an element as a utf-8 xml document.
+
+    :param element:
+    :return:
+    """
+    with io.BytesIO() as f:
+        ET.ElementTree(element).write(f, xml_declaration=True, encoding="utf-8")
+        return f.getvalue()
+
+
+def _patch_ncx_identifier(
+    ncx_contents: str, book_identifier: str, logger: logging.Logger
+) -> str:
+    """
+    Replace the identifier in the ncx if it does not match the one in the OPF.
+
+    :param ncx_contents:
+    :param book_identifier:
+    :param logger:
+    :return:
+    """
+    ncx_soup = BeautifulSoup(ncx_contents, features="xml")
+    meta_id = ncx_soup.find("meta", attrs={"name": "dtb:uid"})
+    if (
+        meta_id
+        and isinstance(meta_id, Tag)
+        and meta_id.get("content")
+        and meta_id["content"] != book_identifier
+    ):
+        logger.debug(
+            'Replacing ncx identifier: "%s" -> "%s"',
+            meta_id["content"],
+            book_identifier,
+        )
+        meta_id["content"] = book_identifier
+        return str(ncx_soup)
+    return ncx_contents
 
 
 def _sort_spine_entries(a: Dict, b: Dict, toc_pages: List[str]):
@@ -365,6 +509,59 @@ def _filter_content(entry: Dict, media_info: Dict, toc_pages: List[str]):
     return True
 
 
+def _iter_roster_downloads(
+    entries: List[Dict],
+    fetch: Callable[[str], requests.Response],
+    needs_download: Callable[[Dict], bool],
+    max_workers: int,
+) -> Iterator[Tuple[Dict, Optional["Future[requests.Response]"]]]:
+    """
+    Fetch roster entries concurrently but yield them in the order given,
+    so that the caller can still process them one after another.
+
+    Only up to `2 * max_workers` downloads are queued ahead of the entry being
+    processed, so that the responses of a whole roster are not held in memory.
+
+    :param entries: Roster entries, in processing order
+    :param fetch: Downloads an entry url
+    :param needs_download: Entries this returns False for are yielded without a download
+    :param max_workers: Maximum number of concurrent downloads
+    :return: Iterator of the entries and their pending downloads
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending: Deque[Tuple[Dict, Optional["Future[requests.Response]"]]] = deque()
+    entries_iter = iter(entries)
+
+    def queue_next() -> None:
+        entry = next(entries_iter, None)
+        if entry is not None:
+            pending.append(
+                (
+                    entry,
+                    executor.submit(fetch, entry["url"])
+                    if needs_download(entry)
+                    else None,
+                )
+            )
+
+    try:
+        for _ in range(2 * max_workers):
+            queue_next()
+        while pending:
+            # drop the reference here so that the response is released
+            # once the caller is done with it
+            entry, download = pending.popleft()
+            queue_next()
+            yield entry, download
+    finally:
+        # stop queued downloads if processing has stopped early
+        for _, download in pending:
+            if download:
+                download.cancel()
+        pending.clear()
+        executor.shutdown(wait=True)
+
+
 def process_ebook_loan(
     loan: Dict,
     cover_path: Optional[Path],
@@ -373,6 +570,8 @@ def process_ebook_loan(
     libby_client: LibbyClient,
     args: argparse.Namespace,
     logger: logging.Logger,
+    media_info: Optional[Dict] = None,
+    session: Optional[requests.Session] = None,
 ) -> None:
     """
     Generates and return an ebook loan directly from Libby.
@@ -384,6 +583,8 @@ def process_ebook_loan(
     :param libby_client:
     :param args:
     :param logger:
+    :param media_info: Prefetched OverDrive media record for the loan
+    :param session: Session the loan was prepared with. Defaults to `libby_client.libby_session`.
     :return:
     """
     book_folder, book_file_name = generate_names(
@@ -403,14 +604,10 @@ def process_ebook_loan(
     book_content_name = "OEBPS"
     book_meta_folder = book_folder.joinpath(book_meta_name)
     book_content_folder = book_folder.joinpath(book_content_name)
-    for d in (book_meta_folder, book_content_folder):
-        if not d.exists():
-            d.mkdir(parents=True, exist_ok=True)
 
-    od_client = OverDriveClient(
-        user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
-    )
-    media_info = od_client.media(loan["id"])
+    if not media_info:
+        with init_overdrive_client(args) as od_client:
+            media_info = od_client.media(loan["id"])
 
     if args.is_debug_mode:
         with book_folder.joinpath("media.json").open("w", encoding="utf-8") as f:
@@ -430,7 +627,6 @@ def process_ebook_loan(
     )
     headers = libby_client.default_headers()
     headers["Accept"] = "*/*"
-    contents_re = re.compile(r"parent\.__bif_cfc0\(self,'(?P<base64_text>.+)'\)")
 
     openbook_toc = openbook["nav"]["toc"]
     if len(openbook_toc) <= 1 and loan["type"]["id"] == LibbyMediaTypes.Magazine:
@@ -471,481 +667,498 @@ def process_ebook_loan(
     title_content_entries = sorted(
         title_content_entries, key=cmp_to_key(_sort_title_contents)  # type: ignore[misc]
     )
-    progress_bar = tqdm(title_content_entries, disable=args.hide_progress)
-    has_ncx = False
-    has_nav = False
-
-    # Used to patch magazine css that causes paged mode in calibre viewer to not work.
-    # This expression is used to strip `overflow-x: hidden` from the css definition
-    # for `#article-body`.
-    patch_magazine_css_overflow_re = re.compile(
-        r"(#article-body\s*\{[^{}]+?)overflow-x:\s*hidden;([^{}]+?})"
-    )
-    # This expression is used to strip `padding: Xem Xem;` from the css definition
-    # for `#article-body` to remove the extraneous padding
-    patch_magazine_css_padding_re = re.compile(
-        r"(#article-body\s*\{[^{}]+?)padding:\s*[^;]+;([^{}]+?})"
-    )
-    # This expression is used to patch the missing fonts-specified in magazine css
-    patch_magazine_css_font_re = re.compile(r"(font-family: '[^']+(Sans|Serif)[^']+';)")
-    # This expression is used to strip the missing font src in magazine css
-    patch_magazine_css_font_src_re = re.compile(
-        r"@font-face\s*\{[^{}]+?(src:\s*url\('(fonts/.+\.ttf)'\).+?;)[^{}]+?}"
-    )
 
-    # holds the manifest item ID for the image identified as the cover
-    cover_img_manifest_id = None
+    def roster_asset_path(entry: Dict) -> Path:
+        return book_content_folder.joinpath(urlparse(entry["url"]).path[1:])
+
+    def fetch_roster_asset(entry_url: str) -> requests.Response:
+        # use the session the loan was prepared with because the required
+        # auth cookies are set there
+        return libby_client.make_request(
+            entry_url,
+            headers=headers,
+            authenticated=False,
+            session=session,
+            return_res=True,
+        )
 
-    for entry in progress_bar:
-        entry_url = entry["url"]
-        parsed_entry_url = urlparse(entry_url)
-        title_content_path = Path(parsed_entry_url.path[1:])
-        media_type = guess_mimetype(title_content_path.name)
-        if not media_type:
-            logger.warning("Skipped roster entry: %s", title_content_path.name)
-            continue
-        asset_folder = book_content_folder.joinpath(title_content_path.parent)
-        if media_type == "application/x-dtbncx+xml":
-            has_ncx = True
-        manifest_entry = {
-            "href": parsed_entry_url.path[1:],
-            "id": "ncx"
-            if media_type == "application/x-dtbncx+xml"
-            else _sanitise_opf_id(parsed_entry_url.path[1:]),
-            "media-type": media_type,
-        }
-
-        # try to find cover image for magazines
-        if cover_toc_item and manifest_entry["id"] == _sanitise_opf_id(
-            cover_toc_item["featureImage"]
-        ):
-            # we assign it here to ensure that the image referenced in the
-            # toc actually exists
-            cover_img_manifest_id = manifest_entry["id"]
-
-        if not asset_folder.exists():
-            asset_folder.mkdir(parents=True, exist_ok=True)
-        asset_file_path = asset_folder.joinpath(Path(parsed_entry_url.path).name)
-
-        soup = None
-        if asset_file_path.exists():
-            progress_bar.set_description(f"Already saved {asset_file_path.name}")
-            if media_type in ("application/xhtml+xml", "text/html"):
-                with asset_file_path.open("r", encoding="utf-8") as f_asset:
-                    soup = BeautifulSoup(f_asset, features="html.parser")
-        else:
-            progress_bar.set_description(f"Downloading {asset_file_path.name}")
-            # use the libby client session because the required
-            # auth cookies are set there
-            res: requests.Response = libby_client.make_request(
-                entry_url, headers=headers, authenticated=False, return_res=True
+    # files are written straight into the epub, and only saved to disk
+    # (for resuming) if the download fails
+    # Assets are downloaded concurrently but processed in the sorted order,
+    # so that fonts are added before the css is patched, and the cover
+    # html is parsed before the cover image is processed.
+    with EpubBuilder(epub_file_path, book_folder, logger) as epub_builder, tqdm(
+        _iter_roster_downloads(
+            title_content_entries,
+            fetch=fetch_roster_asset,
+            needs_download=lambda e: bool(
+                guess_mimetype(Path(urlparse(e["url"]).path).name)
+                and not roster_asset_path(e).exists()
+            ),
+            max_workers=args.asset_jobs,
+        ),
+        total=len(title_content_entries),
+        disable=args.hide_progress,
+    ) as progress_bar:
+        has_ncx = False
+        has_nav = False
+
+        # Used to patch magazine css that causes paged mode in calibre viewer to not work.
+        # This expression is used to strip `overflow-x: hidden` from the css definition
+        # for `#article-body`.
+        patch_magazine_css_overflow_re = re.compile(
+            r"(#article-body\s*\{[^{}]+?)overflow-x:\s*hidden;([^{}]+?})"
+        )
+        # This expression is used to strip `padding: Xem Xem;` from the css definition
+        # for `#article-body` to remove the extraneous padding
+        patch_magazine_css_padding_re = re.compile(
+            r"(#article-body\s*\{[^{}]+?)padding:\s*[^;]+;([^{}]+?})"
+        )
+        # This expression is used to patch the missing fonts-specified in magazine css
+        patch_magazine_css_font_re = re.compile(
+            r"(font-family: '[^']+(Sans|Serif)[^']+';)"
+        )
+        # This expression is used to strip the missing font src in magazine css
+        patch_magazine_css_font_src_re = re.compile(
+            r"@font-face\s*\{[^{}]+?(src:\s*url\('(fonts/.+\.ttf)'\).+?;)[^{}]+?}"
+        )
+
+        # EPUB3 compliance: Ensure that the identifier in ncx matches the one in the OPF
+        # Mismatch due to the toc.ncx being supplied by publisher
+        expected_book_identifier = (
+            extract_isbn(
+                media_info["formats"],
+                format_types=[
+                    LibbyFormats.MagazineOverDrive
+                    if loan["type"]["id"] == LibbyMediaTypes.Magazine
+                    else LibbyFormats.EBookOverdrive
+                ],
             )
+            or media_info["id"]
+        )  # this is the summarised logic from build_opf_package
 
-            # patch magazine css to fix various rendering problems
-            if (
-                media_info["type"]["id"] == LibbyMediaTypes.Magazine
-                and media_type == "text/css"
+        # holds the manifest item ID for the image identified as the cover
+        cover_img_manifest_id = None
+        # time spent parsing and cleaning up content pages
+        pages_processing_time = 0.0
+
+        for entry, asset_download in progress_bar:
+            entry_url = entry["url"]
+            parsed_entry_url = urlparse(entry_url)
+            title_content_path = Path(parsed_entry_url.path[1:])
+            media_type = guess_mimetype(title_content_path.name)
+            if not media_type:
+                logger.warning("Skipped roster entry: %s", title_content_path.name)
+                continue
+            asset_folder = book_content_folder.joinpath(title_content_path.parent)
+            # using posix path because zipfile requires "/" separators
+            asset_archive_name = Path(book_content_name, title_content_path).as_posix()
+            if media_type == "application/x-dtbncx+xml":
+                has_ncx = True
+            manifest_entry = {
+                "href": parsed_entry_url.path[1:],
+                "id": "ncx"
+                if media_type == "application/x-dtbncx+xml"
+                else _sanitise_opf_id(parsed_entry_url.path[1:]),
+                "media-type": media_type,
+            }
+
+            # try to find cover image for magazines
+            if cover_toc_item and manifest_entry["id"] == _sanitise_opf_id(
+                cover_toc_item["featureImage"]
             ):
-                css_content = patch_magazine_css_overflow_re.sub(r"\1\2", res.text)
-                css_content = patch_magazine_css_padding_re.sub(r"\1\2", css_content)
-                if "#article-body" in css_content:
-                    # patch font-family declarations
-                    # libby declares these font-faces but does not supply them in the roster
-                    # nor are they actually available when viewed online (http 403)
-                    font_families = list(
-                        set(patch_magazine_css_font_re.findall(css_content))
-                    )
-                    for font_family, _ in font_families:
-                        new_font_css = font_family[:-1]
-                        if "Serif" in font_family:
-                            new_font_css += ',Charter,"Bitstream Charter","Sitka Text",Cambria,serif'
-                        elif "Sans" in font_family:
-                            new_font_css += ",system-ui,sans-serif"
-                        new_font_css += ";"
-                        if "-Bold" in font_family:
-                            new_font_css += " font-weight: 700;"
-                        elif "-SemiBold" in font_family:
-                            new_font_css += " font-weight: 600;"
-                        elif "-Light" in font_family:
-                            new_font_css += " font-weight: 300;"
-                        css_content = css_content.replace(font_family, new_font_css)
+                # we assign it here to ensure that the image referenced in the
+                # toc actually exists
+                cover_img_manifest_id = manifest_entry["id"]
+
+            asset_file_path = asset_folder.joinpath(Path(parsed_entry_url.path).name)
+
+            page_facts: Optional[PageFacts] = None
+            if not asset_download:
+                # resume from the file saved by an earlier, incomplete attempt
+                progress_bar.set_description(f"Already saved {asset_file_path.name}")
+                if media_type in ("application/xhtml+xml", "text/html"):
+                    with asset_file_path.open("r", encoding="utf-8") as f_asset:
+                        soup = BeautifulSoup(f_asset, features=CONTENT_PAGE_PARSER)
+                    # already cleaned up, this only collects the page details
+                    page_facts = _cleanup_soup(soup, version=epub_version)
+                if media_type == "application/x-dtbncx+xml":
+                    with asset_file_path.open("r", encoding="utf-8") as f_asset:
+                        epub_builder.write(
+                            asset_archive_name,
+                            _patch_ncx_identifier(
+                                f_asset.read(), expected_book_identifier, logger
+                            ),
+                        )
                 else:
-                    # patch font url declarations
-                    # since ttf/otf files are downloaded ahead of css, we can verify
-                    # if the font files are actually available
-                    try:
-                        font_sources = patch_magazine_css_font_src_re.findall(
-                            css_content
+                    epub_builder.write_file(asset_archive_name, asset_file_path)
+            else:
+                progress_bar.set_description(f"Downloading {asset_file_path.name}")
+                res: requests.Response = asset_download.result()
+
+                # patch magazine css to fix various rendering problems
+                if (
+                    media_info["type"]["id"] == LibbyMediaTypes.Magazine
+                    and media_type == "text/css"
+                ):
+                    css_content = patch_magazine_css_overflow_re.sub(r"\1\2", res.text)
+                    css_content = patch_magazine_css_padding_re.sub(
+                        r"\1\2", css_content
+                    )
+                    if "#article-body" in css_content:
+                        # patch font-family declarations
+                        # libby declares these font-faces but does not supply them in the roster
+                        # nor are they actually available when viewed online (http 403)
+                        font_families = list(
+                            set(patch_magazine_css_font_re.findall(css_content))
                         )
-                        for src_match, font_src in font_sources:
-                            asset_font_path = Path(
-                                urljoin(str(asset_file_path), font_src)
+                        for font_family, _ in font_families:
+                            new_font_css = font_family[:-1]
+                            if "Serif" in font_family:
+                                new_font_css += ',Charter,"Bitstream Charter","Sitka Text",Cambria,serif'
+                            elif "Sans" in font_family:
+                                new_font_css += ",system-ui,sans-serif"
+                            new_font_css += ";"
+                            if "-Bold" in font_family:
+                                new_font_css += " font-weight: 700;"
+                            elif "-SemiBold" in font_family:
+                                new_font_css += " font-weight: 600;"
+                            elif "-Light" in font_family:
+                                new_font_css += " font-weight: 300;"
+                            css_content = css_content.replace(font_family, new_font_css)
+                    else:
+                        # patch font url declarations
+                        # since ttf/otf files are downloaded ahead of css, we can verify
+                        # if the font files are actually available
+                        try:
+                            font_sources = patch_magazine_css_font_src_re.findall(
+                                css_content
                             )
-                            if not asset_font_path.exists():
-                                css_content = css_content.replace(src_match, "")
-                    except (
-                        Exception  # noqa, pylint: disable=broad-exception-caught
-                    ) as patch_err:
-                        logger.warning(
-                            "Error while patching font sources: %s", patch_err
-                        )
-                with open(asset_file_path, "w", encoding="utf-8") as f_out:
-                    f_out.write(css_content)
-            elif media_type in ("application/xhtml+xml", "text/html"):
-                soup = BeautifulSoup(res.text, features="html.parser")
-                script_ele = soup.find("script", attrs={"type": "text/javascript"})
-                if script_ele and hasattr(script_ele, "string"):
-                    mobj = contents_re.search(script_ele.string or "")
-                    if not mobj:
+                            for src_match, font_src in font_sources:
+                                if not epub_builder.has(
+                                    urljoin(asset_archive_name, font_src)
+                                ):
+                                    css_content = css_content.replace(src_match, "")
+                        except (
+                            Exception  # noqa, pylint: disable=broad-exception-caught
+                        ) as patch_err:
+                            logger.warning(
+                                "Error while patching font sources: %s", patch_err
+                            )
+                    epub_builder.write(asset_archive_name, css_content)
+                elif media_type in ("application/xhtml+xml", "text/html"):
+                    page_start = time.perf_counter()
+                    soup, is_decoded = _decode_content_page(res.text)
+                    if not is_decoded and "__bif_cfc0" in res.text:
                         logger.warning(
                             "Unable to extract content string for %s",
                             parsed_entry_url.path,
                         )
-                    else:
-                        new_soup = BeautifulSoup(
-                            base64.b64decode(mobj.group("base64_text")),
-                            features="html.parser",
-                        )
-                        soup.body.replace_with(new_soup.body)  # type: ignore[arg-type,union-attr]
-                _cleanup_soup(soup, version=epub_version)
-                if (
-                    cover_toc_item
-                    and cover_toc_item.get("featureImage")
-                    and manifest_entry["id"] == _sanitise_opf_id(cover_toc_item["path"])
-                ):
-                    img_src = os.path.relpath(
-                        book_content_folder.joinpath(cover_toc_item["featureImage"]),
-                        start=asset_folder,
+                    page_facts = _cleanup_soup(soup, version=epub_version)
+                    page_time = time.perf_counter() - page_start
+                    pages_processing_time += page_time
+                    logger.debug(
+                        "Parsed and cleaned up %s in %.1fms",
+                        parsed_entry_url.path,
+                        page_time * 1000,
                     )
-                    if is_windows():
-                        img_src = Path(img_src).as_posix()
-                    # patch the svg based cover for magazines
-                    cover_svg = soup.find("svg")
-                    if cover_svg:
-                        # replace the svg ele with a simple image tag
-                        cover_svg.decompose()  # type: ignore[union-attr]
-                        for c in soup.body.find_all(recursive=False):  # type: ignore[union-attr]
-                            c.decompose()
-                        soup.body.append(  # type: ignore[union-attr]
-                            soup.new_tag("img", attrs={"src": img_src, "alt": "Cover"})
+                    if (
+                        cover_toc_item
+                        and cover_toc_item.get("featureImage")
+                        and manifest_entry["id"]
+                        == _sanitise_opf_id(cover_toc_item["path"])
+                    ):
+                        img_src = os.path.relpath(
+                            book_content_folder.joinpath(
+                                cover_toc_item["featureImage"]
+                            ),
+                            start=asset_folder,
                         )
-                        style_ele = soup.new_tag("style")
-                        style_ele.append(
-                            "img { max-width: 100%; margin-left: auto; margin-right: auto; }"
-                        )
-                        soup.head.append(style_ele)  # type: ignore[union-attr]
-
-                with open(asset_file_path, "w", encoding="utf-8") as f_out:
-                    f_out.write(str(soup))
-            else:
-                with open(asset_file_path, "wb") as f_out:
-                    f_out.write(res.content)
+                        if is_windows():
+                            img_src = Path(img_src).as_posix()
+                        # patch the svg based cover for magazines
+                        cover_svg = soup.find("svg") if page_facts.has_svg else None
+                        if cover_svg:
+                            # replace the svg ele with a simple image tag
+                            cover_svg.decompose()  # type: ignore[union-attr]
+                            for c in soup.body.find_all(recursive=False):  # type: ignore[union-attr]
+                                c.decompose()
+                            soup.body.append(  # type: ignore[union-attr]
+                                soup.new_tag(
+                                    "img", attrs={"src": img_src, "alt": "Cover"}
+                                )
+                            )
+                            style_ele = soup.new_tag("style")
+                            style_ele.append(
+                                "img { max-width: 100%; margin-left: auto; margin-right: auto; }"
+                            )
+                            soup.head.append(style_ele)  # type: ignore[union-attr]
+                            page_facts = page_facts._replace(
+                                has_svg=False, first_img_src=img_src
+                            )
 
-        if soup:
-            # try to min. soup searches where possible
-            if (
-                (not cover_img_manifest_id)
-                and cover_page_landmark
-                and cover_page_landmark["path"] == parsed_entry_url.path[1:]
-            ):
-                # try to find cover image for the book from the cover html content
-                cover_image = soup.find("img", attrs={"src": True})
-                if cover_image:
-                    cover_img_manifest_id = _sanitise_opf_id(
-                        urljoin(cover_page_landmark["path"], cover_image["src"])  # type: ignore[index]
+                    epub_builder.write(asset_archive_name, str(soup))
+                elif media_type == "application/x-dtbncx+xml":
+                    epub_builder.write(
+                        asset_archive_name,
+                        _patch_ncx_identifier(
+                            res.text, expected_book_identifier, logger
+                        ),
                     )
-            elif (not has_nav) and soup.find(attrs={"epub:type": "toc"}):
-                # identify nav page
-                manifest_entry["properties"] = "nav"
-                has_nav = True
-            elif soup.find("svg"):
-                # page has svg
-                manifest_entry["properties"] = "svg"
-
-        if cover_img_manifest_id == manifest_entry["id"]:
-            manifest_entry["properties"] = "cover-image"
-        manifest_entries.append(manifest_entry)
-        if manifest_entry.get("properties") == "cover-image" and cover_path:
-            # replace the cover image already downloaded via the OD api, in case it is to be kept
-            shutil.copyfile(asset_file_path, cover_path)
-
-    if not has_nav:
-        # Generate nav - needed for magazines
-
-        # we give the nav an id-stamped file name to avoid accidentally overwriting
-        # an existing file name
-        nav_file_name = f'nav_{loan["id"]}.xhtml'
-
-        nav_soup = BeautifulSoup(NAV_XHTMLTEMPLATE, features="html.parser")
-        nav_soup.find("title").append(loan["title"])  # type: ignore[union-attr]
-        toc_ele = nav_soup.find(id="toc")
-
-        # sort toc into hierarchical sections
-        hierarchical_toc = _sort_toc(openbook_toc)
-        for item in hierarchical_toc:
-            li_ele = nav_soup.new_tag("li")
-            if not item.get("sectionName"):
-                a_ele = nav_soup.new_tag("a", attrs={"href": item["path"]})
-                a_ele.append(item["title"])
-                li_ele.append(a_ele)
-                toc_ele.append(li_ele)  # type: ignore[union-attr]
-                continue
-            # since we don't have a section content page, and this can cause problems,
-            # link section to first article path
-            a_ele = nav_soup.new_tag("a", attrs={"href": item["items"][0]["path"]})
-            a_ele.append(item["sectionName"])
-            li_ele.append(a_ele)
-            ol_ele = nav_soup.new_tag("ol", attrs={"type": "1"})
-            for section_item in item.get("items", []):
-                section_li_ele = nav_soup.new_tag("li")
-                section_item_a_ele = nav_soup.new_tag(
-                    "a", attrs={"href": section_item["path"]}
-                )
-                section_item_a_ele.append(section_item["title"])
-                section_li_ele.append(section_item_a_ele)
-                ol_ele.append(section_li_ele)
-                continue
-            li_ele.append(ol_ele)
-            toc_ele.append(li_ele)  # type: ignore[union-attr]
-
-        with book_content_folder.joinpath(nav_file_name).open(
-            "w", encoding="utf-8"
-        ) as f_nav:
-            f_nav.write(str(nav_soup).strip())
-        manifest_entries.append(
-            {
-                "href": nav_file_name,
-                "id": _sanitise_opf_id(nav_file_name),
-                "media-type": "application/xhtml+xml",
-                "properties": "nav",
-            }
-        )
+                else:
+                    epub_builder.write(asset_archive_name, res.content)
 
-    if not has_ncx:
-        # generate ncx for backward compat
-        ncx = _build_ncx(media_info, openbook, nav_file_name if not has_nav else "")
-        # we give the ncx an id-stamped file name to avoid accidentally overwriting
-        # an existing file name
-        toc_ncx_name = f'toc_{loan["id"]}.ncx'
-        tree = ET.ElementTree(ncx)
-        tree.write(
-            book_content_folder.joinpath(toc_ncx_name),
-            xml_declaration=True,
-            encoding="utf-8",
-        )
-        manifest_entries.append(
-            {
-                "href": toc_ncx_name,
-                "id": "ncx",
-                "media-type": "application/x-dtbncx+xml",
-            }
-        )
-        has_ncx = True
-    else:
-        # EPUB3 compliance: Ensure that the identifier in ncx matches the one in the OPF
-        # Mismatch due to the toc.ncx being supplied by publisher
-        ncx_manifest_entry = next(
-            iter([m for m in manifest_entries if m["id"] == "ncx"]), None
-        )
-        if ncx_manifest_entry:
-            expected_book_identifier = (
-                extract_isbn(
-                    media_info["formats"],
-                    format_types=[
-                        LibbyFormats.MagazineOverDrive
-                        if loan["type"]["id"] == LibbyMediaTypes.Magazine
-                        else LibbyFormats.EBookOverdrive
-                    ],
-                )
-                or media_info["id"]
-            )  # this is the summarised logic from build_opf_package
-            ncx_path = book_content_folder.joinpath(ncx_manifest_entry["href"])
-            new_ncx_contents = None
-            with ncx_path.open("r", encoding="utf-8") as ncx_f:
-                ncx_soup = BeautifulSoup(ncx_f, features="xml")
-                meta_id = ncx_soup.find("meta", attrs={"name": "dtb:uid"})
+            if page_facts:
                 if (
-                    meta_id
-                    and isinstance(meta_id, Tag)
-                    and meta_id.get("content")
-                    and meta_id["content"] != expected_book_identifier
+                    (not cover_img_manifest_id)
+                    and cover_page_landmark
+                    and cover_page_landmark["path"] == parsed_entry_url.path[1:]
                 ):
-                    logger.debug(
-                        'Replacing identifier in %s: "%s" -> "%s"',
-                        ncx_path.name,
-                        meta_id["content"],
-                        expected_book_identifier,
-                    )
-                    meta_id["content"] = expected_book_identifier
-                    new_ncx_contents = str(ncx_soup)
-            if new_ncx_contents:
-                with ncx_path.open("w", encoding="utf-8") as ncx_f:
-                    ncx_f.write(new_ncx_contents)
-
-    # create epub OPF
-    opf_file_name = "package.opf"
-    opf_file_path = book_content_folder.joinpath(opf_file_name)
-    package = build_opf_package(
-        media_info,
-        version=epub_version,
-        loan_format=LibbyFormats.MagazineOverDrive
-        if loan["type"]["id"] == LibbyMediaTypes.Magazine
-        else LibbyFormats.EBookOverdrive,
-    )
-    if args.generate_opf:
-        # save opf before the manifest and spine elements get added
-        # because those elements are meaningless outside an epub
-        export_opf_file = epub_file_path.with_suffix(".opf")
-        ET.ElementTree(package).write(
-            export_opf_file, xml_declaration=True, encoding="utf-8"
+                    # try to find cover image for the book from the cover html content
+                    if page_facts.first_img_src:
+                        cover_img_manifest_id = _sanitise_opf_id(
+                            urljoin(
+                                cover_page_landmark["path"], page_facts.first_img_src
+                            )
+                        )
+                elif (not has_nav) and page_facts.is_nav:
+                    # identify nav page
+                    manifest_entry["properties"] = "nav"
+                    has_nav = True
+                elif page_facts.has_svg:
+                    # page has svg
+                    manifest_entry["properties"] = "svg"
+
+            if cover_img_manifest_id == manifest_entry["id"]:
+                manifest_entry["properties"] = "cover-image"
+            manifest_entries.append(manifest_entry)
+            if manifest_entry.get("properties") == "cover-image" and cover_path:
+                # replace the cover image already downloaded via the OD api, in case it is to be kept
+                if not asset_download:
+                    shutil.copyfile(asset_file_path, cover_path)
+                else:
+                    with cover_path.open("wb") as f_cover:
+                        f_cover.write(res.content)
+
+        logger.debug(
+            "Parsed and cleaned up content pages in %.2fs", pages_processing_time
         )
-        logger.info('Saved "%s"', colored(str(export_opf_file), "magenta"))
 
-    # add manifest
-    manifest = ET.SubElement(package, "manifest")
-    for entry in manifest_entries:
-        ET.SubElement(manifest, "item", attrib=entry)
+        if not has_nav:
+            # Generate nav - needed for magazines
+
+            # we give the nav an id-stamped file name to avoid accidentally overwriting
+            # an existing file name
+            nav_file_name = f'nav_{loan["id"]}.xhtml'
+
+            nav_soup = BeautifulSoup(NAV_XHTMLTEMPLATE, features="html.parser")
+            nav_soup.find("title").append(loan["title"])  # type: ignore[union-attr]
+            toc_ele = nav_soup.find(id="toc")
+
+            # sort toc into hierarchical sections
+            hierarchical_toc = _sort_toc(openbook_toc)
+            for item in hierarchical_toc:
+                li_ele = nav_soup.new_tag("li")
+                if not item.get("sectionName"):
+                    a_ele = nav_soup.new_tag("a", attrs={"href": item["path"]})
+                    a_ele.append(item["title"])
+                    li_ele.append(a_ele)
+                    toc_ele.append(li_ele)  # type: ignore[union-attr]
+                    continue
+                # since we don't have a section content page, and this can cause problems,
+                # link section to first article path
+                a_ele = nav_soup.new_tag("a", attrs={"href": item["items"][0]["path"]})
+                a_ele.append(item["sectionName"])
+                li_ele.append(a_ele)
+                ol_ele = nav_soup.new_tag("ol", attrs={"type": "1"})
+                for section_item in item.get("items", []):
+                    section_li_ele = nav_soup.new_tag("li")
+                    section_item_a_ele = nav_soup.new_tag(
+                        "a", attrs={"href": section_item["path"]}
+                    )
+                    section_item_a_ele.append(section_item["title"])
+                    section_li_ele.append(section_item_a_ele)
+                    ol_ele.append(section_li_ele)
+                    continue
+                li_ele.append(ol_ele)
+                toc_ele.append(li_ele)  # type: ignore[union-attr]
 
-    cover_manifest_entry = next(
-        iter(
-            [
-                entry
-                for entry in manifest_entries
-                if entry.get("properties", "") == "cover-image"
-            ]
-        ),
-        None,
-    )
-    if not cover_manifest_entry:
-        cover_img_manifest_id = None
-    if cover_path and not cover_manifest_entry:
-        # add cover image separately since we can't identify which item is the cover
-        # we give the cover a timestamped file name to avoid accidentally overwriting
-        # an existing file name
-        cover_image_name = f"cover_{int(datetime.datetime.now().timestamp())}.jpg"
-        shutil.copyfile(cover_path, book_content_folder.joinpath(cover_image_name))
-        cover_img_manifest_id = "coverimage"
-        ET.SubElement(
-            manifest,
-            "item",
-            attrib={
-                "id": cover_img_manifest_id,
-                "href": cover_image_name,
-                "media-type": "image/jpeg",
-                "properties": "cover-image",
-            },
-        )
+            epub_builder.write(
+                Path(book_content_name, nav_file_name).as_posix(), str(nav_soup).strip()
+            )
+            manifest_entries.append(
+                {
+                    "href": nav_file_name,
+                    "id": _sanitise_opf_id(nav_file_name),
+                    "media-type": "application/xhtml+xml",
+                    "properties": "nav",
+                }
+            )
 
-    if cover_img_manifest_id:
-        metadata = package.find("metadata")
-        if metadata:
-            _ = ET.SubElement(
-                metadata,
-                "meta",
-                attrib={"name": "cover", "content": cover_img_manifest_id},
+        if not has_ncx:
+            # generate ncx for backward compat
+            ncx = _build_ncx(media_info, openbook, nav_file_name if not has_nav else "")
+            # we give the ncx an id-stamped file name to avoid accidentally overwriting
+            # an existing file name
+            toc_ncx_name = f'toc_{loan["id"]}.ncx'
+            epub_builder.write(
+                Path(book_content_name, toc_ncx_name).as_posix(), _xml_to_bytes(ncx)
+            )
+            manifest_entries.append(
+                {
+                    "href": toc_ncx_name,
+                    "id": "ncx",
+                    "media-type": "application/x-dtbncx+xml",
+                }
             )
+            has_ncx = True
 
-    # add spine
-    spine = ET.SubElement(package, "spine")
-    if has_ncx:
-        spine.set("toc", "ncx")
-    spine_entries = list(
-        filter(
-            lambda s: not (
-                media_info["type"]["id"] == LibbyMediaTypes.Magazine
-                and s["-odread-original-path"] not in toc_pages
+        # create epub OPF
+        opf_file_name = "package.opf"
+        opf_archive_name = Path(book_content_name, opf_file_name).as_posix()
+        package = build_opf_package(
+            media_info,
+            version=epub_version,
+            loan_format=LibbyFormats.MagazineOverDrive
+            if loan["type"]["id"] == LibbyMediaTypes.Magazine
+            else LibbyFormats.EBookOverdrive,
+        )
+        if args.generate_opf:
+            # save opf before the manifest and spine elements get added
+            # because those elements are meaningless outside an epub
+            export_opf_file = epub_file_path.with_suffix(".opf")
+            ET.ElementTree(package).write(
+                export_opf_file, xml_declaration=True, encoding="utf-8"
+            )
+            logger.info('Saved "%s"', colored(str(export_opf_file), "magenta"))
+
+        # add manifest
+        manifest = ET.SubElement(package, "manifest")
+        for entry in manifest_entries:
+            ET.SubElement(manifest, "item", attrib=entry)
+
+        cover_manifest_entry = next(
+            iter(
+                [
+                    entry
+                    for entry in manifest_entries
+                    if entry.get("properties", "") == "cover-image"
+                ]
             ),
-            openbook["spine"],
+            None,
         )
-    )
-
-    # Ignoring mypy error below because of https://github.com/python/mypy/issues/9372
-    spine_entries = sorted(
-        spine_entries, key=cmp_to_key(lambda a, b: _sort_spine_entries(a, b, toc_pages))  # type: ignore[misc]
-    )
-    for spine_idx, entry in enumerate(spine_entries):
-        if (
-            media_info["type"]["id"] == LibbyMediaTypes.Magazine
-            and entry["-odread-original-path"] not in toc_pages
-        ):
-            continue
-        item_ref = ET.SubElement(spine, "itemref")
-        item_ref.set("idref", _sanitise_opf_id(entry["-odread-original-path"]))
-        if spine_idx == 0 and not has_nav:
-            item_ref = ET.SubElement(spine, "itemref")
-            item_ref.set("idref", _sanitise_opf_id(nav_file_name))
-
-    # add guide
-    if openbook.get("nav", {}).get("landmarks"):
-        guide = ET.SubElement(package, "guide")
-        for landmark in openbook["nav"]["landmarks"]:
-            _ = ET.SubElement(
-                guide,
-                "reference",
+        if not cover_manifest_entry:
+            cover_img_manifest_id = None
+        if cover_path and not cover_manifest_entry:
+            # add cover image separately since we can't identify which item is the cover
+            # we give the cover a timestamped file name to avoid accidentally overwriting
+            # an existing file name
+            cover_image_name = f"cover_{int(datetime.datetime.now().timestamp())}.jpg"
+            epub_builder.write_file(
+                Path(book_content_name, cover_image_name).as_posix(), cover_path
+            )
+            cover_img_manifest_id = "coverimage"
+            ET.SubElement(
+                manifest,
+                "item",
                 attrib={
-                    "href": landmark["path"],
-                    "title": landmark["title"],
-                    "type": landmark["type"],
+                    "id": cover_img_manifest_id,
+                    "href": cover_image_name,
+                    "media-type": "image/jpeg",
+                    "properties": "cover-image",
                 },
             )
 
-    if args.is_debug_mode:
-        from xml.dom import minidom
+        if cover_img_manifest_id:
+            metadata = package.find("metadata")
+            if metadata:
+                _ = ET.SubElement(
+                    metadata,
+                    "meta",
+                    attrib={"name": "cover", "content": cover_img_manifest_id},
+                )
+
+        # add spine
+        spine = ET.SubElement(package, "spine")
+        if has_ncx:
+            spine.set("toc", "ncx")
+        spine_entries = list(
+            filter(
+                lambda s: not (
+                    media_info["type"]["id"] == LibbyMediaTypes.Magazine
+                    and s["-odread-original-path"] not in toc_pages
+                ),
+                openbook["spine"],
+            )
+        )
 
-        with opf_file_path.open("w", encoding="utf-8") as f:
-            f.write(
+        # Ignoring mypy error below because of https://github.com/python/mypy/issues/9372
+        spine_entries = sorted(
+            spine_entries, key=cmp_to_key(lambda a, b: _sort_spine_entries(a, b, toc_pages))  # type: ignore[misc]
+        )
+        for spine_idx, entry in enumerate(spine_entries):
+            if (
+                media_info["type"]["id"] == LibbyMediaTypes.Magazine
+                and entry["-odread-original-path"] not in toc_pages
+            ):
+                continue
+            item_ref = ET.SubElement(spine, "itemref")
+            item_ref.set("idref", _sanitise_opf_id(entry["-odread-original-path"]))
+            if spine_idx == 0 and not has_nav:
+                item_ref = ET.SubElement(spine, "itemref")
+                item_ref.set("idref", _sanitise_opf_id(nav_file_name))
+
+        # add guide
+        if openbook.get("nav", {}).get("landmarks"):
+            guide = ET.SubElement(package, "guide")
+            for landmark in openbook["nav"]["landmarks"]:
+                _ = ET.SubElement(
+                    guide,
+                    "reference",
+                    attrib={
+                        "href": landmark["path"],
+                        "title": landmark["title"],
+                        "type": landmark["type"],
+                    },
+                )
+
+        if args.is_debug_mode:
+            from xml.dom import minidom
+
+            epub_builder.write(
+                opf_archive_name,
                 minidom.parseString(ET.tostring(package, "utf-8")).toprettyxml(
                     indent="\t"
-                )
+                ),
             )
-    else:
-        tree = ET.ElementTree(package)
-        tree.write(opf_file_path, xml_declaration=True, encoding="utf-8")
-    logger.debug('Saved "%s"', opf_file_path)
-
-    # create container.xml
-    container_file_path = book_meta_folder.joinpath("container.xml")
-    container = ET.Element(
-        "container",
-        attrib={
-            "version": "1.0",
-            "xmlns": "urn:oasis:names:tc:opendocument:xmlns:container",
-        },
-    )
-    root_files = ET.SubElement(container, "rootfiles")
-    _ = ET.SubElement(
-        root_files,
-        "rootfile",
-        attrib={
-            # use posix path because zipFile requires "/"
-            "full-path": Path(book_content_name, opf_file_name).as_posix(),
-            "media-type": "application/oebps-package+xml",
-        },
-    )
-    tree = ET.ElementTree(container)
-    tree.write(container_file_path, xml_declaration=True, encoding="utf-8")
-    logger.debug('Saved "%s"', container_file_path)
-
-    # create epub zip
-    with zipfile.ZipFile(
-        epub_file_path, mode="w", compression=zipfile.ZIP_DEFLATED
-    ) as epub_zip:
-        epub_zip.writestr(
-            "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+        else:
+            epub_builder.write(opf_archive_name, _xml_to_bytes(package))
+
+        # create container.xml
+        container = ET.Element(
+            "container",
+            attrib={
+                "version": "1.0",
+                "xmlns": "urn:oasis:names:tc:opendocument:xmlns:container",
+            },
         )
-        for root_start in (book_meta_folder, book_content_folder):
-            for p in root_start.glob("**/*"):
-                if p.is_dir():
-                    continue
-                zip_archive_file = p.relative_to(book_folder)
-                # using posix path because zipfile requires "/" separators
-                # and may break on Windows otherwise
-                zip_archive_name = zip_archive_file.as_posix()
-                zip_target_file = book_folder.joinpath(zip_archive_file)
-                epub_zip.write(zip_target_file, zip_archive_name)
-                logger.debug(
-                    'epub: Added "%s" as "%s"', zip_target_file, zip_archive_name
-                )
+        root_files = ET.SubElement(container, "rootfiles")
+        _ = ET.SubElement(
+            root_files,
+            "rootfile",
+            attrib={
+                # use posix path because zipFile requires "/"
+                "full-path": opf_archive_name,
+                "media-type": "application/oebps-package+xml",
+            },
+        )
+        epub_builder.write(
+            Path(book_meta_name, "container.xml").as_posix(), _xml_to_bytes(container)
+        )
+
+    if args.is_debug_mode:
+        # keep the epub contents for inspection
+        epub_builder.spill()
     logger.info('Saved "%s"', colored(str(epub_file_path), "magenta", attrs=["bold"]))
 
     # clean up
@@ -0,0 +1,424 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Deque, List, NamedTuple, Optional, Set, Tuple, Union
+
+from ..utils import guess_mimetype
+
+#
+# Writes the epub archive as its files are generated
+#
+
+EPUB_MIMETYPE = "application/epub+zip"
+# media types that are already compressed, so deflating them is wasted effort
+STORED_MEDIA_TYPES = (
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "image/webp",
+    "font/woff",
+    "font/woff2",
+)
+DEFAULT_DEFLATE_WORKERS = min(4, os.cpu_count() or 1)
+
+# zip records, the same as written by zipfile (without zip64)
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+ZIP_END_RECORD = struct.Struct("<4s4H2LH")
+ZIP_VERSION = 20
+ZIP_UTF8_FLAG = 0x800
+ZIP_MAX_ENTRIES = 0xFFFF
+ZIP_MAX_SIZE = 0xFFFFFFFF
+
+
+def is_compressed_media(name: str) -> bool:
+    """
+    Check if a file is already compressed, from its name.
+
+    :param name:
+    :return:
+    """
+    media_type = guess_mimetype(name) or ""
+    return media_type in STORED_MEDIA_TYPES or media_type.startswith(
+        ("audio/", "video/")
+    )
+
+
+def _deflate(data: bytes) -> Tuple[bytes, int]:
+    """
+    Compress data the same way zipfile does for ZIP_DEFLATED.
+    zlib releases the GIL, so this can run in parallel in threads.
+
+    :param data:
+    :return: Compressed data and the crc of the uncompressed data
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data)
+
+
+def _dos_date_time(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+    """
+    Convert a local time to the zip (MS-DOS) date and time.
+
+    :param date_time: (year, month, day, hour, minute, second)
+    :return: Date, time
+    """
+    year, month, day, hour, minute, second = date_time[:6]
+    return (
+        (max(year, 1980) - 1980) << 9 | month << 5 | day,
+        hour << 11 | minute << 5 | second // 2,
+    )
+
+
+class _PendingFile(NamedTuple):
+    name: str
+    date_time: Tuple[int, ...]
+    data: bytes
+    deflated: Optional["Future[Tuple[bytes, int]]"]
+
+
+class EpubBuilder(object):
+    """
+    Writes files straight into an epub archive instead of staging them on disk.
+
+    The archive is written to a temporary file that replaces `epub_file_path`
+    only when the build completes. If the build fails, the files written so far
+    are extracted into `staging_folder` so that a later attempt can resume
+    from them, the same way it would from a staged download.
+
+    Already compressed media are stored as-is. Other files are deflated in a
+    thread pool and added to the archive in the order they were written.
+    zipfile cannot add data that is already deflated, so the zip records are
+    written here instead.
+    """
+
+    def __init__(
+        self,
+        epub_file_path: Path,
+        staging_folder: Path,
+        logger: Optional[logging.Logger] = None,
+        deflate_workers: int = DEFAULT_DEFLATE_WORKERS,
+    ) -> None:
+        """
+        :param epub_file_path:
+        :param staging_folder: Folder for resumable files, usually the book folder
+        :param logger:
+        :param deflate_workers: Number of files to compress concurrently. 1 to disable.
+        """
+        self.epub_file_path = epub_file_path
+        self.staging_folder = staging_folder
+        self.logger = logger or logging.getLogger(__name__)
+        self.tmp_file_path = epub_file_path.with_name(f"{epub_file_path.name}.tmp")
+        # time spent compressing and writing, excluding the time waiting for files
+        self.packaging_time = 0.0
+        self.stored_count = 0
+        self.deflated_count = 0
+        self._names: Set[str] = set()
+        self._pending: Deque[_PendingFile] = deque()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if deflate_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=deflate_workers)
+        # cap the compressed files held in memory
+        self._max_pending = deflate_workers * 4
+        self._central_directory: List[bytes] = []
+        self._file: Optional[BinaryIO] = self.tmp_file_path.open("wb")
+        # the mimetype must be the first file and uncompressed
+        self._write_entry(
+            "mimetype",
+            time.localtime()[:6],
+            EPUB_MIMETYPE.encode("ascii"),
+            compress_type=zipfile.ZIP_STORED,
+            crc=zlib.crc32(EPUB_MIMETYPE.encode("ascii")),
+            file_size=len(EPUB_MIMETYPE),
+        )
+
+    def has(self, name: str) -> bool:
+        """
+        Check if a file has been added to the archive.
+
+        :param name: Archive name
+        :return:
+        """
+        return name in self._names
+
+    def write(self, name: str, data: Union[str, bytes]) -> None:
+        """
+        Add a file to the archive.
+
+        :param name: Archive name, with "/" separators
+        :param data: File contents. `str` is encoded as utf-8.
+        :return:
+        """
+        if name in self._names:
+            self.logger.debug('epub: Skipped duplicate "%s"', name)
+            return
+        start = time.perf_counter()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        deflated = None
+        if is_compressed_media(name):
+            self.stored_count += 1
+        else:
+            self.deflated_count += 1
+            if self._executor:
+                deflated = self._executor.submit(_deflate, data)
+            else:
+                deflated = Future()
+                deflated.set_result(_deflate(data))
+        self._pending.append(_PendingFile(name, time.localtime()[:6], data, deflated))
+        self._names.add(name)
+        self._write_pending(wait=len(self._pending) > self._max_pending)
+        self.packaging_time += time.perf_counter() - start
+
+    def write_file(self, name: str, file_path: Path) -> None:
+        """
+        Add a file on disk to the archive.
+
+        :param name: Archive name, with "/" separators
+        :param file_path:
+        :return:
+        """
+        if name in self._names:
+            self.logger.debug('epub: Skipped duplicate "%s"', name)
+            return
+        self.write(name, file_path.read_bytes())
+        self.logger.debug('epub: Read "%s" for "%s"', file_path, name)
+
+    def _write_pending(self, wait: bool = False) -> None:
+        """
+        Add the pending files to the archive, in order, up to the first
+        file that is still being compressed.
+
+        :param wait: Wait for the first pending file to be compressed
+        :return:
+        """
+        while self._pending:
+            pending = self._pending[0]
+            if pending.deflated and not pending.deflated.done() and not wait:
+                return
+            self._pending.popleft()
+            wait = False
+            if not pending.deflated:
+                self._write_entry(
+                    pending.name,
+                    pending.date_time,
+                    pending.data,
+                    compress_type=zipfile.ZIP_STORED,
+                    crc=zlib.crc32(pending.data),
+                    file_size=len(pending.data),
+                )
+            else:
+                compressed, crc = pending.deflated.result()
+                self._write_entry(
+                    pending.name,
+                    pending.date_time,
+                    compressed,
+                    compress_type=zipfile.ZIP_DEFLATED,
+                    crc=crc,
+                    file_size=len(pending.data),
+                )
+            self.logger.debug(
+                'epub: Added "%s" (%s)',
+                pending.name,
+                "deflated" if pending.deflated else "stored",
+            )
+
+    def _write_entry(
+        self,
+        name: str,
+        date_time: Tuple[int, ...],
+        data: bytes,
+        compress_type: int,
+        crc: int,
+        file_size: int,
+    ) -> None:
+        """
+        Write a file's local header and data, and keep its central directory record.
+
+        :param name:
+        :param date_time: Modified time
+        :param data: Stored or deflated data
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :param crc: crc of the uncompressed data
+        :param file_size: Uncompressed size
+        :return:
+        """
+        if not self._file:
+            raise ValueError("Attempt to write to a closed epub")
+        header_offset = self._file.tell()
+        if (
+            len(self._central_directory) >= ZIP_MAX_ENTRIES
+            or max(header_offset, len(data), file_size) > ZIP_MAX_SIZE
+        ):
+            raise zipfile.LargeZipFile(f'"{self.epub_file_path}" is too large')
+        try:
+            encoded_name = name.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            encoded_name = name.encode("utf-8")
+            flags = ZIP_UTF8_FLAG
+        dos_date, dos_time = _dos_date_time(date_time)
+        self._file.write(
+            ZIP_LOCAL_HEADER.pack(
+                b"PK\x03\x04",
+                ZIP_VERSION,
+                0,
+                flags,
+                compress_type,
+                dos_time,
+                dos_date,
+                crc,
+                len(data),
+                file_size,
+                len(encoded_name),
+                0,
+            )
+        )
+        self._file.write(encoded_name)
+        self._file.write(data)
+        self._central_directory.append(
+            ZIP_CENTRAL_HEADER.pack(
+                b"PK\x01\x02",
+                ZIP_VERSION,
+                0 if os.name == "nt" else 3,
+                ZIP_VERSION,
+                0,
+                flags,
+                compress_type,
+                dos_time,
+                dos_date,
+                crc,
+                len(data),
+                file_size,
+                len(encoded_name),
+                0,
+                0,
+                0,
+                0,
+                0o600 << 16,
+                header_offset,
+            )
+            + encoded_name
+        )
+
+    def _close_archive(self) -> None:
+        """
+        Write the pending files and the central directory, and close the file.
+
+        :return:
+        """
+        if not self._file:
+            return
+        try:
+            while self._pending:
+                self._write_pending(wait=True)
+        finally:
+            self._shutdown_executor()
+            try:
+                central_directory_offset = self._file.tell()
+                for record in self._central_directory:
+                    self._file.write(record)
+                central_directory_size = self._file.tell() - central_directory_offset
+                self._file.write(
+                    ZIP_END_RECORD.pack(
+                        b"PK\x05\x06",
+                        0,
+                        0,
+                        len(self._central_directory),
+                        len(self._central_directory),
+                        central_directory_size,
+                        central_directory_offset,
+                        0,
+                    )
+                )
+            finally:
+                self._file.close()
+                self._file = None
+
+    def _shutdown_executor(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def spill(self) -> None:
+        """
+        Extract the files added so far into the staging folder.
+        The archive must be closed first.
+
+        :return:
+        """
+        file_path = self.tmp_file_path
+        if not file_path.exists():
+            # already completed
+            file_path = self.epub_file_path
+        with zipfile.ZipFile(file_path, mode="r") as epub_zip:
+            for name in epub_zip.namelist():
+                if name in self._names:
+                    epub_zip.extract(name, self.staging_folder)
+
+    def close(self) -> None:
+        """
+        Complete the archive and move it into place.
+
+        :return:
+        """
+        start = time.perf_counter()
+        self._close_archive()
+        self.tmp_file_path.replace(self.epub_file_path)
+        self.packaging_time += time.perf_counter() - start
+        self.logger.info(
+            'Packaged "%s" in %.2fs (%d deflated, %d stored)',
+            self.epub_file_path.name,
+            self.packaging_time,
+            self.deflated_count,
+            self.stored_count,
+        )
+
+    def abort(self) -> None:
+        """
+        Discard the archive, keeping the files added so far in the staging folder.
+
+        :return:
+        """
+        try:
+            # closing writes the central directory so that the files can be read back
+            self._close_archive()
+            self.spill()
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning("Unable to save the partial epub: %s", err)
+        finally:
+            if self.tmp_file_path.exists():
+                self.tmp_file_path.unlink()
+
+    def __enter__(self) -> "EpubBuilder":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
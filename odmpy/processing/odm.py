@@ -24,11 +24,10 @@ import json
 import logging
 import math
 import re
-import shutil
 import uuid
 import xml.etree.ElementTree as ET
 from collections import OrderedDict
-from functools import reduce
+from functools import partial, reduce
 from html import unescape as unescape_html
 from pathlib import Path
 from typing import Any, Union, Dict, List, Optional
@@ -37,23 +36,33 @@ import eyed3  # type: ignore[import]
 from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
 from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
 
 from .shared import (
+    init_overdrive_client,
+    download_part,
+    can_stream_remux,
+    stream_remux_part,
+    run_pipeline,
+    remux_workers,
+    PipelineStage,
+    ProgressPositions,
+    LoanScheduler,
     generate_names,
     write_tags,
     generate_cover,
     remux_mp3,
     merge_into_mp3,
     convert_to_m4b,
+    merge_into_m4b,
+    m4b_metadata_tags,
     create_opf,
     init_session,
 )
 from ..cli_utils import OdmpyCommands
 from ..constants import OMC, OS, UA, UNSUPPORTED_PARSER_ENTITIES, UA_LONG
 from ..errors import OdmpyRuntimeError
-from ..libby import USER_AGENT
-from ..overdrive import OverDriveClient
+from ..retries import RetryPolicy
+from ..transport import disable_retries
 from ..utils import (
     slugify,
     mp3_duration_ms,
@@ -86,12 +95,49 @@ def _patch_for_parse_error(text: str) -> str:
     )
 
 
+def _merge_file_markers(
+    file_tracks: List[Dict], audio_lengths_ms: List[int]
+) -> List[Dict[str, Union[str, int]]]:
+    """
+    Offset each part's markers by the length of the preceding parts.
+
+    :param file_tracks:
+    :param audio_lengths_ms:
+    :return:
+    """
+    merged_markers: List[Dict[str, Union[str, int]]] = []
+    for i, f in enumerate(file_tracks):
+        prev_tracks_len_ms = (
+            0 if i == 0 else reduce(lambda x, y: x + y, audio_lengths_ms[0:i])
+        )
+        this_track_endtime_ms = int(
+            reduce(lambda x, y: x + y, audio_lengths_ms[0 : i + 1])
+        )
+        file_markers = f["markers"]
+        for j, file_marker in enumerate(file_markers):
+            merged_markers.append(
+                {
+                    "id": file_marker[0],
+                    "text": str(file_marker[1]),
+                    "start_time": int(file_marker[2]) + prev_tracks_len_ms,
+                    "end_time": int(
+                        this_track_endtime_ms
+                        if j == (len(file_markers) - 1)
+                        else file_markers[j + 1][2] + prev_tracks_len_ms
+                    ),
+                }
+            )
+    return merged_markers
+
+
 def process_odm(
     odm_file: Optional[Path],
     loan: Dict,
     args: argparse.Namespace,
     logger: logging.Logger,
     cleanup_odm_license: bool = False,
+    scheduler: Optional[LoanScheduler] = None,
+    media_info: Optional[Dict] = None,
 ) -> None:
     """
     Download the audiobook loan using the specified odm file
@@ -101,8 +147,11 @@ def process_odm(
     :param args:
     :param logger:
     :param cleanup_odm_license:
+    :param scheduler: shared by the loans being downloaded together
+    :param media_info: Prefetched OverDrive media record for the loan
     :return:
     """
+    scheduler = scheduler or LoanScheduler()
     if not odm_file:
         logger.warning("No odm file specified.")
         return
@@ -400,12 +449,24 @@ def process_odm(
     with license_file.open("r", encoding="utf-8") as lic_file:
         lic_file_contents = lic_file.read()
 
-    track_count = 0
-    file_tracks: List[Dict] = []
+    # built once and shared read-only by all part downloads
+    part_download_headers = {
+        "User-Agent": UA,
+        "ClientID": license_client_id,
+        "License": lic_file_contents,
+    }
     keep_cover = args.always_keep_cover
-    audio_lengths_ms = []
-    audio_bitrate = 0
-    for p in download_parts:
+    progress_positions = ProgressPositions(args.parallel_downloads)
+    retry_policy = RetryPolicy(max_retries=args.retries, logger=logger)
+    # part downloads are retried by the policy only
+    disable_retries(session)
+
+    # Parts go through download -> remux -> tag as a pipeline so that the
+    # next part is downloading while the previous one is remuxed and tagged.
+    # Stages run on their own threads, so markers are collected unnumbered
+    # and chapter ids are only assigned once all parts are back in spine order.
+
+    def download_stage(p: Dict[str, str]) -> Dict[str, Any]:
         part_number = int(p["number"])
         part_filename = book_folder.joinpath(
             f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
@@ -414,187 +475,252 @@ def process_odm(
         part_file_size = int(p["filesize"])
         part_url_filename = p["filename"]
         part_download_url = f"{download_baseurl}/{part_url_filename}"
-        part_markers = []
+        part: Dict[str, Any] = {
+            "file": part_filename,
+            "number": part_number,
+            "is_new": False,
+            "is_remuxed": False,
+            "bitrate": None,
+            "length_ms": None,
+            "audiofile": None,
+            "markers": [],
+            "id3_error": False,
+        }
 
         if part_filename.exists():
             logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
-        else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": UA,
-                        "ClientID": license_client_id,
-                        "License": lic_file_contents,
-                        "Range": f"bytes={already_downloaded_len}-"
-                        if already_downloaded_len
-                        else None,
-                    },
-                    timeout=args.timeout,
-                    stream=True,
-                )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
-                remux_mp3(
-                    part_tmp_filename=part_tmp_filename,
-                    part_filename=part_filename,
-                    ffmpeg_loglevel=ffmpeg_loglevel,
-                    logger=logger,
-                )
+            return part
+
+        def fetch_part() -> None:
+            # a retry resumes from the partial download, if any
+            with progress_positions.acquire() as progress_position:
+                if can_stream_remux(args, part_tmp_filename, part_file_size):
+                    stream_remux_part(
+                        session=session,
+                        part_download_url=part_download_url,
+                        headers=part_download_headers,
+                        part_filename=part_filename,
+                        part_file_size=part_file_size,
+                        desc=f"Part {part_number:2d}",
+                        timeout=args.timeout,
+                        hide_progress=args.hide_progress,
+                        ffmpeg_loglevel=ffmpeg_loglevel,
+                        logger=logger,
+                        progress_position=progress_position,
+                    )
+                    part["is_remuxed"] = True
+                else:
+                    download_part(
+                        session=session,
+                        part_download_url=part_download_url,
+                        headers=part_download_headers,
+                        part_tmp_filename=part_tmp_filename,
+                        part_file_size=part_file_size,
+                        desc=f"Part {part_number:2d}",
+                        timeout=args.timeout,
+                        hide_progress=args.hide_progress,
+                        progress_position=progress_position,
+                        segments=args.download_segments,
+                        segment_min_size=args.segment_min_size_mb * 1024 * 1024,
+                    )
 
-            except HTTPError as he:
-                logger.error(f"HTTPError: {str(he)}")
-                logger.debug(he.response.content)
-                raise OdmpyRuntimeError("HTTP Error while downloading part file.")
+        try:
+            retry_policy.call(fetch_part, part_download_url)
+        except HTTPError as he:
+            logger.error(f"HTTPError: {str(he)}")
+            logger.debug(he.response.content)
+            raise OdmpyRuntimeError("HTTP Error while downloading part file.")
 
-            except ConnectionError as ce:
-                logger.error(f"ConnectionError: {str(ce)}")
-                raise OdmpyRuntimeError("Connection Error while downloading part file.")
+        except ConnectionError as ce:
+            logger.error(f"ConnectionError: {str(ce)}")
+            raise OdmpyRuntimeError("Connection Error while downloading part file.")
 
-            # Save id3 info only on new download, ref #42
-            # This also makes handling of part files consistent with merged files
-            try:
-                # Fill id3 info for mp3 part
-                audiofile: eyed3.core.AudioFile = eyed3.load(part_filename)
-                _, audio_bitrate = audiofile.info.bit_rate
-
-                write_tags(
-                    audiofile=audiofile,
-                    title=title,
-                    sub_title=sub_title,
-                    authors=authors,
-                    narrators=narrators,
-                    publisher=publisher,
-                    description=description,
-                    cover_bytes=cover_bytes,
-                    genres=subjects,
-                    languages=languages,
-                    published_date=None,  # odm does not contain date info
-                    series=series,
-                    part_number=part_number,
-                    total_parts=len(download_parts),
-                    overdrive_id=overdrive_media_id,
-                    always_overwrite=args.overwrite_tags,
-                    delimiter=args.tag_delimiter,
-                )
-                audiofile.tag.save(version=id3v2_version)
+        part["is_new"] = True
+        return part
 
-                # Notes: Can't switch over to using eyed3 (audiofile.info.time_secs)
-                # because it is completely off by about 10-20 seconds.
-                # Also, can't rely on `p["duration"]` because it is also often off
-                # by about 1 second.
-                audio_lengths_ms.append(mp3_duration_ms(part_filename))
-
-                # Extract OD chapter info from mp3s for use in merged file
-                for frame in audiofile.tag.frame_set.get(
-                    eyed3.id3.frames.USERTEXT_FID, []
-                ):
-                    if frame.description != "OverDrive MediaMarkers":
-                        continue
-                    if frame.text:
-                        frame_text = re.sub(r"\s&\s", " &amp; ", frame.text)
-                        try:
-                            tree = ET.fromstring(frame_text)
-                        except UnicodeEncodeError:
-                            tree = ET.fromstring(
-                                frame_text.encode("ascii", "ignore").decode("ascii")
-                            )
-                        except ET.ParseError:
-                            tree = ET.fromstring(_patch_for_parse_error(frame_text))
-
-                        for marker in tree.iter("Marker"):  # type: ET.Element
-                            marker_name = get_element_text(marker.find("Name")).strip()
-                            marker_timestamp = get_element_text(marker.find("Time"))
-
-                            # 2 timestamp formats found ("%M:%S.%f", "%H:%M:%S.%f")
-                            ts_mark = parse_duration_to_milliseconds(marker_timestamp)
-                            track_count += 1
-                            part_markers.append(
-                                (f"ch{track_count:02d}", marker_name, ts_mark)
-                            )
-                    break
-
-                if (
-                    args.add_chapters
-                    and not args.merge_output
-                    and (args.overwrite_tags or not audiofile.tag.table_of_contents)
-                ):
-                    # set the chapter marks
-                    generated_markers: List[Dict[str, Union[str, int]]] = []
-                    for j, file_marker in enumerate(part_markers):
-                        generated_markers.append(
-                            {
-                                "id": file_marker[0],
-                                "text": file_marker[1],
-                                "start_time": int(file_marker[2]),
-                                "end_time": int(
-                                    round(audiofile.info.time_secs * 1000)
-                                    if j == (len(part_markers) - 1)
-                                    else part_markers[j + 1][2]
-                                ),
-                            }
+    def remux_stage(part: Dict[str, Any]) -> Dict[str, Any]:
+        if part["is_new"] and not part["is_remuxed"]:
+            # try to remux file to remove mp3 lame tag errors
+            remux_mp3(
+                part_tmp_filename=part["file"].with_suffix(".part"),
+                part_filename=part["file"],
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                logger=logger,
+                always_remux=args.always_remux,
+            )
+        return part
+
+    def tag_stage(part: Dict[str, Any]) -> Dict[str, Any]:
+        if not part["is_new"]:
+            return part
+
+        part_filename = part["file"]
+        part_number = part["number"]
+        # Save id3 info only on new download, ref #42
+        # This also makes handling of part files consistent with merged files
+        try:
+            # Fill id3 info for mp3 part
+            audiofile: eyed3.core.AudioFile = eyed3.load(part_filename)
+            _, part["bitrate"] = audiofile.info.bit_rate
+
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=None,  # odm does not contain date info
+                series=series,
+                part_number=part_number,
+                total_parts=len(download_parts),
+                overdrive_id=overdrive_media_id,
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
+            audiofile.tag.save(version=id3v2_version)
+
+            # Notes: Can't switch over to using eyed3 (audiofile.info.time_secs)
+            # because it is completely off by about 10-20 seconds.
+            # Also, can't rely on `p["duration"]` because it is also often off
+            # by about 1 second.
+            part["length_ms"] = mp3_duration_ms(part_filename)
+
+            # Extract OD chapter info from mp3s for use in merged file
+            for frame in audiofile.tag.frame_set.get(eyed3.id3.frames.USERTEXT_FID, []):
+                if frame.description != "OverDrive MediaMarkers":
+                    continue
+                if frame.text:
+                    frame_text = re.sub(r"\s&\s", " &amp; ", frame.text)
+                    try:
+                        tree = ET.fromstring(frame_text)
+                    except UnicodeEncodeError:
+                        tree = ET.fromstring(
+                            frame_text.encode("ascii", "ignore").decode("ascii")
                         )
+                    except ET.ParseError:
+                        tree = ET.fromstring(_patch_for_parse_error(frame_text))
 
-                    if args.overwrite_tags and audiofile.tag.table_of_contents:
-                        # Clear existing toc to prevent "There may only be one top-level table of contents.
-                        # Toc 'b'toc'' is current top-level." error
-                        for f in list(audiofile.tag.table_of_contents):
-                            audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-                    toc = audiofile.tag.table_of_contents.set(
-                        "toc".encode("ascii"),
-                        toplevel=True,
-                        ordered=True,
-                        child_ids=[],
-                        description="Table of Contents",
+                    for marker in tree.iter("Marker"):  # type: ET.Element
+                        marker_name = get_element_text(marker.find("Name")).strip()
+                        marker_timestamp = get_element_text(marker.find("Time"))
+
+                        # 2 timestamp formats found ("%M:%S.%f", "%H:%M:%S.%f")
+                        ts_mark = parse_duration_to_milliseconds(marker_timestamp)
+                        part["markers"].append((marker_name, ts_mark))
+                break
+            part["audiofile"] = audiofile
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(
+                "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+            )
+            part["id3_error"] = True
+
+        logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
+        return part
+
+    track_count = 0
+    file_tracks: List[Dict] = []
+    audio_lengths_ms = []
+    audio_bitrate = 0
+    # Each part's markers come back in its own slot, so chapter numbering
+    # and lengths follow spine order no matter which part finished first
+    part_results = run_pipeline(
+        download_parts,
+        [
+            # only the downloads take up the loan's network slot
+            PipelineStage(
+                download_stage,
+                workers=args.parallel_downloads,
+                slot=partial(scheduler.network, progress_positions),
+            ),
+            PipelineStage(remux_stage, workers=remux_workers(args.parallel_downloads)),
+            # eyed3 is pure python so more threads would not help
+            PipelineStage(tag_stage, workers=1),
+        ],
+    )
+    for part_result in part_results:
+        part_filename = part_result["file"]
+        part_markers = []
+        for marker_name, ts_mark in part_result["markers"]:
+            track_count += 1
+            part_markers.append((f"ch{track_count:02d}", marker_name, ts_mark))
+        if part_result["bitrate"] is not None:
+            audio_bitrate = part_result["bitrate"]
+        if part_result["length_ms"] is not None:
+            audio_lengths_ms.append(part_result["length_ms"])
+        if part_result["id3_error"]:
+            keep_cover = True
+
+        audiofile = part_result["audiofile"]
+        if (
+            audiofile
+            and args.add_chapters
+            and not args.merge_output
+            and (args.overwrite_tags or not audiofile.tag.table_of_contents)
+        ):
+            try:
+                # set the chapter marks
+                generated_markers: List[Dict[str, Union[str, int]]] = []
+                for j, file_marker in enumerate(part_markers):
+                    generated_markers.append(
+                        {
+                            "id": file_marker[0],
+                            "text": file_marker[1],
+                            "start_time": int(file_marker[2]),
+                            "end_time": int(
+                                round(audiofile.info.time_secs * 1000)
+                                if j == (len(part_markers) - 1)
+                                else part_markers[j + 1][2]
+                            ),
+                        }
                     )
 
-                    for gm in generated_markers:
-                        title_frameset = eyed3.id3.frames.FrameSet()
-                        title_frameset.setTextFrame(
-                            eyed3.id3.frames.TITLE_FID, str(gm["text"])
-                        )
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
+                )
 
-                        chap = audiofile.tag.chapters.set(
-                            str(gm["id"]).encode("ascii"),
-                            times=(gm["start_time"], gm["end_time"]),
-                            sub_frames=title_frameset,
-                        )
-                        toc.child_ids.append(chap.element_id)
-                        start_time = datetime.timedelta(
-                            milliseconds=float(gm["start_time"])
-                        )
-                        end_time = datetime.timedelta(
-                            milliseconds=float(gm["end_time"])
-                        )
-                        logger.debug(
-                            'Added chap tag => %s: %s-%s "%s" to "%s"',
-                            colored(str(gm["id"]), "cyan"),
-                            start_time,
-                            end_time,
-                            colored(str(gm["text"]), "cyan"),
-                            colored(str(part_filename), "blue"),
-                        )
+                for gm in generated_markers:
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(
+                        eyed3.id3.frames.TITLE_FID, str(gm["text"])
+                    )
 
-                    audiofile.tag.save(version=id3v2_version)
+                    chap = audiofile.tag.chapters.set(
+                        str(gm["id"]).encode("ascii"),
+                        times=(gm["start_time"], gm["end_time"]),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(
+                        milliseconds=float(gm["start_time"])
+                    )
+                    end_time = datetime.timedelta(milliseconds=float(gm["end_time"]))
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(str(gm["id"]), "cyan"),
+                        start_time,
+                        end_time,
+                        colored(str(gm["text"]), "cyan"),
+                        colored(str(part_filename), "blue"),
+                    )
+
+                audiofile.tag.save(version=id3v2_version)
 
             except Exception as e:  # pylint: disable=broad-except
                 logger.warning(
@@ -602,15 +728,12 @@ def process_odm(
                 )
                 keep_cover = True
 
-            logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
-
         file_tracks.append(
             {
                 "file": part_filename,
                 "markers": part_markers,
             }
         )
-    # end loop: for p in download_parts:
 
     debug_meta["audio_lengths_ms"] = audio_lengths_ms
     debug_meta["file_tracks"] = [
@@ -626,124 +749,152 @@ def process_odm(
             ),
         )
 
-        merge_into_mp3(
-            book_filename=book_filename,
-            file_tracks=file_tracks,
-            audio_bitrate=audio_bitrate,
-            ffmpeg_loglevel=ffmpeg_loglevel,
-            hide_progress=args.hide_progress,
-            logger=logger,
-        )
-
-        audiofile = eyed3.load(book_filename)
-        write_tags(
-            audiofile=audiofile,
-            title=title,
-            sub_title=sub_title,
-            authors=authors,
-            narrators=narrators,
-            publisher=publisher,
-            description=description,
-            cover_bytes=cover_bytes,
-            genres=subjects,
-            languages=languages,
-            published_date=None,  # odm does not contain date info
-            series=series,
-            part_number=0,
-            total_parts=0,
-            overdrive_id=overdrive_media_id,
-            overwrite_title=True,
-            always_overwrite=args.overwrite_tags,
-            delimiter=args.tag_delimiter,
-        )
-
-        if args.add_chapters and (
-            args.overwrite_tags or not audiofile.tag.table_of_contents
-        ):
-            merged_markers: List[Dict[str, Union[str, int]]] = []
-            for i, f in enumerate(file_tracks):
-                prev_tracks_len_ms = (
-                    0 if i == 0 else reduce(lambda x, y: x + y, audio_lengths_ms[0:i])
+        if args.merge_format == "m4b" and args.direct_m4b:
+            merged_markers = (
+                _merge_file_markers(file_tracks, audio_lengths_ms)
+                if args.add_chapters
+                else []
+            )
+            debug_meta["merged_markers"] = merged_markers
+            with scheduler.cpu():
+                merge_into_m4b(
+                    book_m4b_filename=book_m4b_filename,
+                    file_tracks=file_tracks,
+                    tags=m4b_metadata_tags(
+                        title=title,
+                        authors=authors,
+                        narrators=narrators,
+                        publisher=publisher,
+                        description=description,
+                        genres=subjects,
+                        languages=languages,
+                        published_date=None,  # odm does not contain date info
+                        series=series,
+                        delimiter=args.tag_delimiter,
+                    ),
+                    chapters=[
+                        (str(mm["text"]), int(mm["start_time"]), int(mm["end_time"]))
+                        for mm in merged_markers
+                    ],
+                    cover_filename=cover_filename,
+                    merge_codec=args.merge_codec,
+                    audio_bitrate=audio_bitrate,
+                    ffmpeg_loglevel=ffmpeg_loglevel,
+                    hide_progress=args.hide_progress,
+                    logger=logger,
+                    jobs=args.merge_jobs,
                 )
-                this_track_endtime_ms = int(
-                    reduce(lambda x, y: x + y, audio_lengths_ms[0 : i + 1])
+        else:
+            with scheduler.cpu():
+                merge_into_mp3(
+                    book_filename=book_filename,
+                    file_tracks=file_tracks,
+                    audio_bitrate=audio_bitrate,
+                    ffmpeg_loglevel=ffmpeg_loglevel,
+                    hide_progress=args.hide_progress,
+                    logger=logger,
+                    # native merging is only used for mp3 output
+                    merge_engine=args.merge_engine
+                    if args.merge_format == "mp3"
+                    else "ffmpeg",
                 )
-                file_markers = f["markers"]
-                for j, file_marker in enumerate(file_markers):
-                    merged_markers.append(
-                        {
-                            "id": file_marker[0],
-                            "text": str(file_marker[1]),
-                            "start_time": int(file_marker[2]) + prev_tracks_len_ms,
-                            "end_time": int(
-                                this_track_endtime_ms
-                                if j == (len(file_markers) - 1)
-                                else file_markers[j + 1][2] + prev_tracks_len_ms
-                            ),
-                        }
-                    )
-            debug_meta["merged_markers"] = merged_markers
 
-            if args.overwrite_tags and audiofile.tag.table_of_contents:
-                # Clear existing toc to prevent "There may only be one top-level table of contents.
-                # Toc 'b'toc'' is current top-level." error
-                for f in list(audiofile.tag.table_of_contents):
-                    audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-            toc = audiofile.tag.table_of_contents.set(
-                "toc".encode("ascii"),
-                toplevel=True,
-                ordered=True,
-                child_ids=[],
-                description="Table of Contents",
+            audiofile = eyed3.load(book_filename)
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=None,  # odm does not contain date info
+                series=series,
+                part_number=0,
+                total_parts=0,
+                overdrive_id=overdrive_media_id,
+                overwrite_title=True,
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
             )
 
-            for mm in merged_markers:  # type: Dict[str, Union[str, int]]
-                title_frameset = eyed3.id3.frames.FrameSet()
-                title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, mm["text"])
-                chap = audiofile.tag.chapters.set(
-                    str(mm["id"]).encode("ascii"),
-                    times=(mm["start_time"], mm["end_time"]),
-                    sub_frames=title_frameset,
-                )
-                toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(milliseconds=float(mm["start_time"]))
-                end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(str(mm["id"]), "cyan"),
-                    start_time,
-                    end_time,
-                    colored(str(mm["text"]), "cyan"),
-                    colored(str(book_filename), "blue"),
+            if args.add_chapters and (
+                args.overwrite_tags or not audiofile.tag.table_of_contents
+            ):
+                merged_markers = _merge_file_markers(file_tracks, audio_lengths_ms)
+                debug_meta["merged_markers"] = merged_markers
+
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
                 )
 
-        audiofile.tag.save(version=id3v2_version)
+                for mm in merged_markers:  # type: Dict[str, Union[str, int]]
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, mm["text"])
+                    chap = audiofile.tag.chapters.set(
+                        str(mm["id"]).encode("ascii"),
+                        times=(mm["start_time"], mm["end_time"]),
+                        sub_frames=title_frameset,
+                    )
+                    toc.child_ids.append(chap.element_id)
+                    start_time = datetime.timedelta(
+                        milliseconds=float(mm["start_time"])
+                    )
+                    end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(str(mm["id"]), "cyan"),
+                        start_time,
+                        end_time,
+                        colored(str(mm["text"]), "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
 
-        if args.merge_format == "mp3":
-            logger.info(
-                'Merged files into "%s"',
-                colored(
-                    str(
-                        book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
+            audiofile.tag.save(version=id3v2_version)
+
+            if args.merge_format == "mp3":
+                logger.info(
+                    'Merged files into "%s"',
+                    colored(
+                        str(
+                            book_filename
+                            if args.merge_format == "mp3"
+                            else book_m4b_filename
+                        ),
+                        "magenta",
                     ),
-                    "magenta",
-                ),
-            )
+                )
 
-        if args.merge_format == "m4b":
-            convert_to_m4b(
-                book_filename=book_filename,
-                book_m4b_filename=book_m4b_filename,
-                cover_filename=cover_filename,
-                merge_codec=args.merge_codec,
-                audio_bitrate=audio_bitrate,
-                ffmpeg_loglevel=ffmpeg_loglevel,
-                hide_progress=args.hide_progress,
-                logger=logger,
-            )
+            if args.merge_format == "m4b":
+                with scheduler.cpu():
+                    convert_to_m4b(
+                        book_filename=book_filename,
+                        book_m4b_filename=book_m4b_filename,
+                        cover_filename=cover_filename,
+                        merge_codec=args.merge_codec,
+                        audio_bitrate=audio_bitrate,
+                        ffmpeg_loglevel=ffmpeg_loglevel,
+                        hide_progress=args.hide_progress,
+                        logger=logger,
+                        jobs=args.merge_jobs,
+                        split_points_ms=[
+                            int(mm["start_time"])
+                            for mm in _merge_file_markers(file_tracks, audio_lengths_ms)
+                        ],
+                    )
 
         if not args.keep_mp3:
             for f in file_tracks:
@@ -775,17 +926,17 @@ def process_odm(
             )
 
         if not opf_file_path.exists():
-            mobj = RESERVE_ID_RE.match(overdrive_media_id)
-            if not mobj:
-                logger.warning(
-                    f"Could not get a valid reserve ID: {overdrive_media_id}"
-                )
-            else:
-                reserve_id = mobj.group("reserve_id")
-                od_client = OverDriveClient(
-                    user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
-                )
-                media_info = od_client.media(reserve_id)
+            if not media_info:
+                mobj = RESERVE_ID_RE.match(overdrive_media_id)
+                if not mobj:
+                    logger.warning(
+                        f"Could not get a valid reserve ID: {overdrive_media_id}"
+                    )
+                else:
+                    reserve_id = mobj.group("reserve_id")
+                    with init_overdrive_client(args) as od_client:
+                        media_info = od_client.media(reserve_id)
+            if media_info:
                 create_opf(
                     media_info,
                     cover_filename if keep_cover else None,
@@ -805,8 +956,8 @@ def process_odm(
             logger.info("Already saved %s", colored(str(opf_file_path), "magenta"))
 
     if args.write_json:
-        with debug_filename.open("w", encoding="utf-8") as outfile:
-            json.dump(debug_meta, outfile, indent=2)
+        with debug_filename.open("w", encoding="utf-8") as debug_file:
+            json.dump(debug_meta, debug_file, indent=2)
 
 
 def process_odm_return(args: argparse.Namespace, logger: logging.Logger) -> None:
@@ -17,24 +17,55 @@
 #
 
 import argparse
+import json
 import logging
+import math
+import mmap
+import os
+import queue
+import re
 import subprocess
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple
+from typing import (
+    Any,
+    Optional,
+    Dict,
+    List,
+    Tuple,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    TypeVar,
+    NamedTuple,
+)
 from urllib.parse import urlparse
 
 import eyed3  # type: ignore[import]
 import requests
 from eyed3.utils import art  # type: ignore[import]
 from iso639 import Lang  # type: ignore[import]
-from requests.adapters import HTTPAdapter, Retry
 from termcolor import colored
+from tqdm import tqdm
 
 from ..constants import PERFORMER_FID, LANGUAGE_FID
 from ..errors import OdmpyRuntimeError
 from ..libby import USER_AGENT, LibbyFormats, LibbyClient
-from ..utils import slugify, sanitize_path, is_windows
+from ..overdrive import OverDriveClient
+from ..transport import new_session
+from ..utils import (
+    slugify,
+    sanitize_path,
+    is_windows,
+    repair_mp3_headers,
+    scan_mp3,
+    parse_mp3_frame_header,
+    build_xing_frame,
+)
 
 
 #
@@ -43,13 +74,515 @@ from ..utils import slugify, sanitize_path, is_windows
 
 
 def init_session(max_retries: int = 0) -> requests.Session:
-    session = requests.Session()
-    custom_adapter = HTTPAdapter(
-        max_retries=Retry(total=max_retries, backoff_factor=0.1)
+    return new_session(max_retries)
+
+
+THUNDER_CACHE_FILENAME = "thunder.sqlite"
+
+
+def init_overdrive_client(args: argparse.Namespace) -> OverDriveClient:
+    """
+    Create an OverDrive client. For the Libby commands, Thunder API responses
+    are cached in the settings folder.
+
+    :param args:
+    :return:
+    """
+    settings_folder = getattr(args, "settings_folder", "")
+    return OverDriveClient(
+        user_agent=USER_AGENT,
+        timeout=args.timeout,
+        retry=args.retries,
+        cache_file=Path(settings_folder, THUNDER_CACHE_FILENAME)
+        if settings_folder
+        else None,
     )
-    for prefix in ("http://", "https://"):
-        session.mount(prefix, custom_adapter)
-    return session
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def run_ordered(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int = 1
+) -> List[R]:
+    """
+    Run `func` over `items` with up to `max_workers` threads and return
+    the results in the same order as `items`.
+
+    If any call raises, the calls that have not started yet are cancelled
+    and the first exception (in `items` order) is re-raised.
+
+    :param func:
+    :param items:
+    :param max_workers:
+    :return:
+    """
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class PipelineStage(NamedTuple):
+    func: Callable[[Any], Any]
+    workers: int = 1
+    # held from the start of the pipeline until the stage has finished
+    slot: Optional[Callable[[], ContextManager[Any]]] = None
+
+
+def run_pipeline(items: Iterable[Any], stages: List[PipelineStage]) -> List[Any]:
+    """
+    Pass each item through `stages` in turn. Each stage has its own input
+    queue and `workers` threads, so different items can be in different
+    stages at the same time, e.g. one part is remuxed while the next
+    part is still downloading.
+
+    If a stage raises, items that have not entered the first stage yet are
+    dropped, items already past it are passed through the remaining stages,
+    and the first exception (in `items` order) is re-raised.
+
+    :param items:
+    :param stages:
+    :return: The results of the last stage, in the same order as `items`
+    """
+    items = list(items)
+    results: List[Any] = [None] * len(items)
+    errors: Dict[int, BaseException] = {}
+    has_failed = threading.Event()
+    stage_queues: List["queue.Queue[Optional[Tuple[int, Any]]]"] = [
+        queue.Queue() for _ in stages
+    ]
+
+    def stage_worker(stage_index: int) -> None:
+        stage = stages[stage_index]
+        while True:
+            job = stage_queues[stage_index].get()
+            if job is None:
+                return
+            if has_failed.is_set() and stage_index == 0:
+                continue
+            index, value = job
+            try:
+                value = stage.func(value)
+            except BaseException as e:  # pylint: disable=broad-except
+                errors[index] = e
+                has_failed.set()
+                continue
+            if stage_index + 1 < len(stages):
+                stage_queues[stage_index + 1].put((index, value))
+            else:
+                results[index] = value
+
+    stage_threads = [
+        [
+            threading.Thread(target=stage_worker, args=(i,), daemon=True)
+            for _ in range(max(1, stage.workers))
+        ]
+        for i, stage in enumerate(stages)
+    ]
+    stage_slots = [ExitStack() for _ in stages]
+    try:
+        for stage, slot in zip(stages, stage_slots):
+            if stage.slot:
+                slot.enter_context(stage.slot())
+        for threads in stage_threads:
+            for t in threads:
+                t.start()
+        for index, item in enumerate(items):
+            stage_queues[0].put((index, item))
+        # a stage is only told to stop once every stage before it has finished,
+        # so nothing can be queued for it after the stop signals
+        for i, threads in enumerate(stage_threads):
+            for _ in threads:
+                stage_queues[i].put(None)
+            for t in threads:
+                t.join()
+            stage_slots[i].close()
+    finally:
+        for slot in stage_slots:
+            slot.close()
+
+    if errors:
+        raise errors[min(errors)]
+    return results
+
+
+def remux_workers(parallel_downloads: int) -> int:
+    """
+    Number of concurrent ffmpeg remuxes to pair with `parallel_downloads`.
+
+    :param parallel_downloads:
+    :return:
+    """
+    return max(1, min(parallel_downloads, os.cpu_count() or 1))
+
+
+class ProgressPositions:
+    """
+    Hands out tqdm bar positions so that concurrent downloads
+    each get their own progress bar line.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        # start of the loan's range of positions, set when loans are
+        # downloaded concurrently, see `LoanScheduler.network`
+        self.offset: Optional[int] = None
+        self._available: "queue.Queue[int]" = queue.Queue()
+        for i in range(self.slots):
+            self._available.put(i)
+
+    @contextmanager
+    def acquire(self) -> Iterator[Optional[int]]:
+        """
+        Reserve a bar position. Yields None when there is only one slot
+        so that the serial case renders exactly as before.
+
+        :return:
+        """
+        if self.slots == 1 and self.offset is None:
+            yield None
+            return
+        position = self._available.get()
+        try:
+            yield (self.offset or 0) + position
+        finally:
+            self._available.put(position)
+
+
+class LoanScheduler:
+    """
+    Limits how many loans are downloading and how many are being merged or
+    converted at the same time, so that the next loan can download while
+    the previous one is still in ffmpeg.
+    """
+
+    def __init__(self, network_jobs: int = 1, cpu_jobs: int = 1):
+        self.network_jobs = max(1, network_jobs)
+        self.cpu_jobs = max(1, cpu_jobs)
+        self._network = threading.BoundedSemaphore(self.network_jobs)
+        self._cpu = threading.BoundedSemaphore(self.cpu_jobs)
+        # ranges of progress bar positions, one per network slot
+        self._progress_ranges: "queue.Queue[int]" = queue.Queue()
+        for i in range(self.network_jobs):
+            self._progress_ranges.put(i)
+
+    @contextmanager
+    def network(
+        self, progress_positions: Optional[ProgressPositions] = None
+    ) -> Iterator[None]:
+        """
+        Reserve a slot for network-bound work, e.g. downloading parts.
+
+        :param progress_positions: Moved to their own range of positions
+            while the slot is held, so that the progress bars of loans
+            downloading at the same time do not overlap
+        :return:
+        """
+        with self._network:
+            if progress_positions is None or self.network_jobs == 1:
+                yield
+                return
+            progress_range = self._progress_ranges.get()
+            progress_positions.offset = progress_range * progress_positions.slots
+            try:
+                yield
+            finally:
+                self._progress_ranges.put(progress_range)
+
+    @contextmanager
+    def cpu(self) -> Iterator[None]:
+        """
+        Reserve a slot for CPU-bound work, e.g. merging and encoding.
+
+        :return:
+        """
+        with self._cpu:
+            yield
+
+    def run(self, func: Callable[[T], R], loans: Iterable[T]) -> List[R]:
+        """
+        Run `func` over `loans` concurrently. `func` should do its work
+        inside the `network` and `cpu` slots.
+
+        :param func:
+        :param loans:
+        :return:
+        """
+        # enough loans in flight to keep every slot busy
+        return run_ordered(func, loans, max_workers=self.network_jobs + self.cpu_jobs)
+
+
+def download_part(
+    session: requests.Session,
+    part_download_url: str,
+    headers: Dict[str, str],
+    part_tmp_filename: Path,
+    part_file_size: int,
+    desc: str,
+    timeout: int,
+    hide_progress: bool,
+    progress_position: Optional[int] = None,
+    segments: int = 1,
+    segment_min_size: int = 0,
+) -> None:
+    """
+    Download a part file into `part_tmp_filename`, resuming from the
+    existing partial file if there is one.
+
+    Parts of at least `segment_min_size` bytes are fetched as `segments`
+    concurrent byte ranges if the server supports it.
+
+    :param session:
+    :param part_download_url:
+    :param headers: Request headers, excluding Range
+    :param part_tmp_filename:
+    :param part_file_size: Expected file size, for the progress bar
+    :param desc: Progress bar label
+    :param timeout:
+    :param hide_progress:
+    :param progress_position: tqdm position, when downloading concurrently
+    :param segments: Number of byte ranges to split the download into
+    :param segment_min_size: Minimum part size (bytes) before splitting
+    :return:
+    """
+    segments_state_filename = part_tmp_filename.with_suffix(".segments")
+    if (
+        segments > 1
+        # the size is needed to split the ranges
+        and part_file_size > 0
+        and part_file_size >= segment_min_size
+        # a .part without a state file is from a single stream download
+        and (segments_state_filename.exists() or not part_tmp_filename.exists())
+    ):
+        try:
+            _download_part_segments(
+                session=session,
+                part_download_url=part_download_url,
+                headers=headers,
+                part_tmp_filename=part_tmp_filename,
+                segments_state_filename=segments_state_filename,
+                part_file_size=part_file_size,
+                segments=segments,
+                desc=desc,
+                timeout=timeout,
+                hide_progress=hide_progress,
+                progress_position=progress_position,
+            )
+            return
+        except _RangeNotSupportedError:
+            # server does not do partial content, start over with a single stream
+            for f in (segments_state_filename, part_tmp_filename):
+                if f.exists():
+                    f.unlink()
+
+    already_downloaded_len = 0
+    if part_tmp_filename.exists():
+        already_downloaded_len = part_tmp_filename.stat().st_size
+        if part_file_size and already_downloaded_len == part_file_size:
+            # completed in an earlier run but not processed further
+            return
+
+    request_headers = dict(headers)
+    if already_downloaded_len:
+        request_headers["Range"] = f"bytes={already_downloaded_len}-"
+
+    part_download_res = session.get(
+        part_download_url,
+        headers=request_headers,
+        timeout=timeout,
+        stream=True,
+    )
+    part_download_res.raise_for_status()
+    if already_downloaded_len and part_download_res.status_code != 206:
+        # Range was ignored and the full file is being sent, start over
+        already_downloaded_len = 0
+
+    expected_len = 0
+    if part_download_res.headers.get("Content-Length") and not (
+        part_download_res.headers.get("Content-Encoding")
+    ):
+        expected_len = already_downloaded_len + int(
+            part_download_res.headers["Content-Length"]
+        )
+
+    with part_download_res, tqdm(
+        total=part_file_size,
+        initial=already_downloaded_len,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+        disable=hide_progress,
+        position=progress_position,
+        leave=progress_position is None,
+    ) as progress:
+        with part_tmp_filename.open(
+            "ab" if already_downloaded_len else "wb"
+        ) as outfile:
+            try:
+                for chunk in part_download_res.iter_content(chunk_size=64 * 1024):
+                    outfile.write(chunk)
+                    progress.update(len(chunk))
+            except requests.exceptions.ChunkedEncodingError as err:
+                # the connection dropped mid-body
+                raise requests.ConnectionError(
+                    f'Incomplete download of "{part_tmp_filename}": {err}'
+                ) from err
+
+    if expected_len and part_tmp_filename.stat().st_size != expected_len:
+        # a connection error so that it is retried, resuming from the partial file
+        raise requests.ConnectionError(
+            f'Incomplete download of "{part_tmp_filename}": '
+            f"{part_tmp_filename.stat().st_size} of {expected_len} bytes."
+        )
+
+
+class _RangeNotSupportedError(Exception):
+    pass
+
+
+# how often (in bytes downloaded per segment) to checkpoint the segments state
+_SEGMENTS_STATE_SAVE_INTERVAL = 1024 * 1024
+
+
+def _download_part_segments(
+    session: requests.Session,
+    part_download_url: str,
+    headers: Dict[str, str],
+    part_tmp_filename: Path,
+    segments_state_filename: Path,
+    part_file_size: int,
+    segments: int,
+    desc: str,
+    timeout: int,
+    hide_progress: bool,
+    progress_position: Optional[int] = None,
+) -> None:
+    """
+    Download a part as concurrent byte ranges into a preallocated file.
+
+    Progress for each range is checkpointed into `segments_state_filename`
+    so that an interrupted download resumes each range where it stopped.
+
+    :param session:
+    :param part_download_url:
+    :param headers:
+    :param part_tmp_filename:
+    :param segments_state_filename:
+    :param part_file_size:
+    :param segments:
+    :param desc:
+    :param timeout:
+    :param hide_progress:
+    :param progress_position:
+    :return:
+    """
+    state: Dict = {}
+    if segments_state_filename.exists() and part_tmp_filename.exists():
+        try:
+            with segments_state_filename.open("r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if state.get("size") != part_file_size:
+            state = {}
+
+    if not state:
+        segment_size = math.ceil(part_file_size / segments)
+        state = {
+            "size": part_file_size,
+            "segments": [
+                {
+                    "start": start,
+                    "end": min(start + segment_size, part_file_size) - 1,
+                    "done": 0,
+                }
+                for start in range(0, part_file_size, segment_size)
+            ],
+        }
+        with part_tmp_filename.open("wb") as outfile:
+            outfile.truncate(part_file_size)
+
+    state_lock = threading.Lock()
+
+    def save_state() -> None:
+        # only called with state_lock held
+        tmp_state_filename = segments_state_filename.with_suffix(".segments.tmp")
+        with tmp_state_filename.open("w", encoding="utf-8") as f:
+            json.dump(state, f)
+        tmp_state_filename.replace(segments_state_filename)
+
+    with state_lock:
+        save_state()
+
+    with tqdm(
+        total=part_file_size,
+        initial=sum(seg["done"] for seg in state["segments"]),
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+        disable=hide_progress,
+        position=progress_position,
+        leave=progress_position is None,
+    ) as progress:
+
+        def fetch_segment(segment: Dict[str, int]) -> None:
+            offset = segment["start"] + segment["done"]
+            if offset > segment["end"]:
+                return
+            res = session.get(
+                part_download_url,
+                headers=dict(headers, Range=f"bytes={offset}-{segment['end']}"),
+                timeout=timeout,
+                stream=True,
+            )
+            res.raise_for_status()
+            if res.status_code != 206:
+                res.close()
+                raise _RangeNotSupportedError(res.status_code)
+
+            unsaved_len = 0
+            with res, part_tmp_filename.open("r+b") as outfile:
+                outfile.seek(offset)
+                try:
+                    for chunk in res.iter_content(chunk_size=64 * 1024):
+                        remaining = segment["end"] + 1 - offset
+                        chunk = chunk[:remaining]
+                        outfile.write(chunk)
+                        offset += len(chunk)
+                        unsaved_len += len(chunk)
+                        progress.update(len(chunk))
+                        if unsaved_len >= _SEGMENTS_STATE_SAVE_INTERVAL:
+                            # flush first so the state never claims unwritten bytes
+                            outfile.flush()
+                            with state_lock:
+                                segment["done"] += unsaved_len
+                                save_state()
+                            unsaved_len = 0
+                        if offset > segment["end"]:
+                            break
+                finally:
+                    outfile.flush()
+                    with state_lock:
+                        segment["done"] += unsaved_len
+                        save_state()
+
+        run_ordered(fetch_segment, state["segments"], max_workers=segments)
+
+    incomplete = [
+        seg for seg in state["segments"] if seg["start"] + seg["done"] <= seg["end"]
+    ]
+    if incomplete or part_tmp_filename.stat().st_size != part_file_size:
+        # a connection error so that it is retried, resuming from the saved state
+        raise requests.ConnectionError(f'Incomplete download of "{part_tmp_filename}".')
+    segments_state_filename.unlink()
 
 
 def generate_names(
@@ -364,6 +897,157 @@ def generate_cover(
     return cover_filename, cover_bytes
 
 
+def _append_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> None:
+    """
+    Append `count` bytes at `offset` in `src_fd` to `dst_fd`, as a kernel-side
+    copy where the platform supports it.
+
+    :param src_fd:
+    :param dst_fd:
+    :param offset:
+    :param count:
+    :return:
+    """
+    use_kernel_copy = True
+    while count > 0:
+        copied = 0
+        if use_kernel_copy:
+            try:
+                if hasattr(os, "copy_file_range"):
+                    copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+                elif hasattr(os, "sendfile") and not is_windows():
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+            except OSError:
+                # e.g. not supported by the filesystem
+                pass
+        if not copied:
+            use_kernel_copy = False
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            data = os.read(src_fd, min(count, 1024 * 1024))
+            if not data:
+                raise OdmpyRuntimeError("Unexpected end of file while merging")
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst_fd, view) :]
+            copied = len(data)
+        offset += copied
+        count -= copied
+
+
+class _Mp3MergePart(NamedTuple):
+    file: Path
+    audio_offset: int
+    audio_length: int
+    frames_count: int
+
+
+def _merge_into_mp3_natively(
+    book_filename: Path,
+    file_tracks: List[Dict],
+    hide_progress: bool,
+    logger: logging.Logger,
+) -> bool:
+    """
+    Join the mp3 parts in-process by copying their MPEG frames, without
+    any ID3 tags or per-part Xing frames, behind one new Xing/Info frame.
+
+    :param book_filename:
+    :param file_tracks:
+    :param hide_progress:
+    :param logger:
+    :return: False if the parts cannot be joined this way
+    """
+    parts: List[_Mp3MergePart] = []
+    template_frame = None
+    bitrates = set()
+    is_vbr = False
+    for file_track in file_tracks:
+        with file_track["file"].open("rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            stream = scan_mp3(data)
+            if not stream:
+                logger.debug('Unable to read mp3 frames in "%s"', file_track["file"])
+                return False
+            first_audio_index = 1 if stream.has_xing_frame else 0
+            if first_audio_index >= len(stream.frame_offsets):
+                # no audio
+                continue
+            audio_offset = stream.frame_offsets[first_audio_index]
+            audio_frame = parse_mp3_frame_header(data[audio_offset : audio_offset + 4])
+        if not audio_frame:
+            return False
+        if not template_frame:
+            template_frame = audio_frame
+        elif (
+            audio_frame.version,
+            audio_frame.sample_rate,
+            audio_frame.channel_mode,
+        ) != (
+            template_frame.version,
+            template_frame.sample_rate,
+            template_frame.channel_mode,
+        ):
+            logger.debug('"%s" has a different mp3 format', file_track["file"])
+            return False
+        bitrates.add(audio_frame.bitrate)
+        is_vbr = is_vbr or stream.is_vbr
+        parts.append(
+            _Mp3MergePart(
+                file=file_track["file"],
+                audio_offset=audio_offset,
+                audio_length=stream.audio_end - audio_offset,
+                frames_count=len(stream.frame_offsets) - first_audio_index,
+            )
+        )
+    if not template_frame:
+        return False
+
+    frames_count = sum(p.frames_count for p in parts)
+    audio_length = sum(p.audio_length for p in parts)
+    # Seek table positions, assuming frames are evenly sized within each part
+    # so that we don't need to keep every frame offset of the whole book
+    toc_positions = []
+    for i in range(100):
+        target_frame = i * frames_count // 100
+        frames_before = bytes_before = 0
+        for p in parts:
+            if target_frame < frames_before + p.frames_count:
+                toc_positions.append(
+                    bytes_before
+                    + (target_frame - frames_before) * p.audio_length // p.frames_count
+                )
+                break
+            frames_before += p.frames_count
+            bytes_before += p.audio_length
+    xing_frame = build_xing_frame(
+        template=template_frame,
+        frames_count=frames_count,
+        audio_length=audio_length,
+        toc_positions=toc_positions,
+        is_vbr=is_vbr or len(bitrates) > 1,
+    )
+
+    temp_book_filename = book_filename.with_suffix(".part")
+    with temp_book_filename.open("wb", buffering=0) as outfile, tqdm(
+        total=audio_length,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc="Merging",
+        disable=hide_progress,
+    ) as progress:
+        outfile.write(xing_frame)
+        for p in parts:
+            with p.file.open("rb", buffering=0) as infile:
+                _append_file_range(
+                    infile.fileno(), outfile.fileno(), p.audio_offset, p.audio_length
+                )
+            progress.update(p.audio_length)
+    temp_book_filename.replace(book_filename)
+    return True
+
+
 def merge_into_mp3(
     book_filename: Path,
     file_tracks: List[Dict],
@@ -371,6 +1055,7 @@ def merge_into_mp3(
     ffmpeg_loglevel: str,
     hide_progress: bool,
     logger: logging.Logger,
+    merge_engine: str = "ffmpeg",
 ) -> None:
     """
     Merge the files into a single mp3
@@ -381,9 +1066,23 @@ def merge_into_mp3(
     :param ffmpeg_loglevel:
     :param hide_progress:
     :param logger:
+    :param merge_engine: "ffmpeg", or "native" to join the mp3 frames in-process, with ffmpeg as the fallback
     :return:
     """
 
+    if merge_engine == "native":
+        try:
+            if _merge_into_mp3_natively(
+                book_filename=book_filename,
+                file_tracks=file_tracks,
+                hide_progress=hide_progress,
+                logger=logger,
+            ):
+                return
+            logger.info("Unable to merge parts natively, using ffmpeg instead.")
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(f"Error merging parts natively: {str(e)}")
+
     # We can't directly generate a m4b here even if specified because eyed3 doesn't support m4b/mp4
     temp_book_filename = book_filename.with_suffix(".part")
     cmd = [
@@ -422,6 +1121,306 @@ def merge_into_mp3(
     temp_book_filename.replace(book_filename)
 
 
+def _ffconcat_file_line(filename: Path) -> str:
+    # https://ffmpeg.org/ffmpeg-formats.html#concat-1
+    escaped_path = str(filename.absolute()).replace("'", "'\\''")
+    return f"file '{escaped_path}'\n"
+
+
+# AAC frames are 1024 samples. Each segment is encoded with a couple of
+# frames of the neighbouring audio on either side so that the frames at a
+# join are encoded from the same audio as in a serial encode, and the
+# overlap frames are dropped again when the segments are joined.
+_AAC_FRAME_SAMPLES = 1024
+_AAC_SEGMENT_OVERLAP_SAMPLES = 2 * _AAC_FRAME_SAMPLES
+_AAC_SEGMENT_MIN_SECONDS = 60
+
+
+def _probe_audio_samples(filename: Path) -> Tuple[int, int]:
+    """
+    Decode the audio to get its exact length in samples.
+
+    :param filename:
+    :return: (number of samples, sample rate)
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-hide_banner",
+        "-nostats",
+        "-i",
+        str(filename),
+        "-map",
+        "0:a:0",
+        "-af",
+        "astats=measure_perchannel=none:measure_overall=Number_of_samples",
+        "-f",
+        "null",
+        "-",
+    ]
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        check=False,
+    )
+    sample_rate_match = re.search(r"Audio: .+?, (\d+) Hz", result.stderr)
+    samples_matches = re.findall(r"Number of samples: (\d+)", result.stderr)
+    if result.returncode or not (sample_rate_match and samples_matches):
+        raise OdmpyRuntimeError(f'Unable to get the audio length of "{filename}"')
+    return int(samples_matches[-1]), int(sample_rate_match.group(1))
+
+
+def _first_packet_time(filename: Path) -> str:
+    """
+    Timestamp of the first audio packet, i.e. minus the encoder delay that
+    the mp4 edit list trims off.
+
+    :param filename:
+    :return: seconds
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        str(filename),
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        "-frames:a",
+        "1",
+        "-f",
+        "framecrc",
+        "-",
+    ]
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        check=False,
+    )
+    time_base_match = re.search(r"^#tb 0: (\d+)/(\d+)$", result.stdout, re.MULTILINE)
+    packet_match = re.search(r"^0,\s*(-?\d+),", result.stdout, re.MULTILINE)
+    if result.returncode or not (time_base_match and packet_match):
+        raise OdmpyRuntimeError(f'Unable to read the start time of "{filename}"')
+    pts = (
+        int(packet_match.group(1))
+        * int(time_base_match.group(1))
+        / int(time_base_match.group(2))
+    )
+    return f"{pts:.6f}"
+
+
+def plan_aac_segments(
+    total_samples: int, sample_rate: int, jobs: int, split_points: List[int]
+) -> List[Tuple[int, int]]:
+    """
+    Split the audio into up to `jobs` roughly even segments, preferring to
+    split at a nearby `split_points`. Segments start on an AAC frame boundary.
+
+    :param total_samples:
+    :param sample_rate:
+    :param jobs:
+    :param split_points: sample offsets, e.g. of part or chapter starts
+    :return: (start, end) sample offsets of each segment
+    """
+    segments_count = min(
+        jobs, total_samples // (_AAC_SEGMENT_MIN_SECONDS * sample_rate)
+    )
+    if segments_count < 2:
+        return []
+    boundaries = [0]
+    for k in range(1, segments_count):
+        target = total_samples * k // segments_count
+        if split_points:
+            _, nearest = min((abs(p - target), p) for p in split_points)
+            # don't stray too far from an even split
+            if abs(nearest - target) <= total_samples // (4 * segments_count):
+                target = nearest
+        boundary = target // _AAC_FRAME_SAMPLES * _AAC_FRAME_SAMPLES
+        if boundaries[-1] < boundary < total_samples:
+            boundaries.append(boundary)
+    boundaries.append(total_samples)
+    if len(boundaries) < 3:
+        return []
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+@contextmanager
+def encoded_aac_segments(
+    sources: List[Path],
+    work_filename: Path,
+    merge_codec: str,
+    audio_bitrate: int,
+    jobs: int,
+    split_points_ms: List[int],
+    ffmpeg_loglevel: str,
+    hide_progress: bool,
+    logger: logging.Logger,
+) -> Iterator[Optional[List[str]]]:
+    """
+    Encode the audio of `sources` (joined in order) as segments with up to
+    `jobs` concurrent ffmpeg processes, and yield the ffmpeg input arguments
+    that join the encoded segments gaplessly for copying into the m4b.
+
+    Yields None if the audio should be encoded in a single pass instead.
+    The segment files are deleted on exit.
+
+    :param sources:
+    :param work_filename: base name for the segment files
+    :param merge_codec:
+    :param audio_bitrate:
+    :param jobs:
+    :param split_points_ms: preferred split points, e.g. chapter starts
+    :param ffmpeg_loglevel:
+    :param hide_progress:
+    :param logger:
+    :return:
+    """
+    if jobs <= 1:
+        yield None
+        return
+
+    temp_files: List[Path] = []
+    try:
+        probes = run_ordered(_probe_audio_samples, sources, max_workers=jobs)
+        sample_rates = {sample_rate for _, sample_rate in probes}
+        if len(sample_rates) != 1:
+            logger.warning(
+                "Audio has mixed sample rates, encoding in a single pass instead"
+            )
+            yield None
+            return
+        sample_rate = sample_rates.pop()
+        offsets = [0]
+        for samples, _ in probes:
+            offsets.append(offsets[-1] + samples)
+        total_samples = offsets[-1]
+        split_points = sorted(
+            set(offsets[1:-1])
+            | {ms * sample_rate // 1000 for ms in split_points_ms if ms > 0}
+        )
+        segments = plan_aac_segments(total_samples, sample_rate, jobs, split_points)
+        if not segments:
+            yield None
+            return
+
+        logger.info(
+            "Encoding %d segments with %d jobs...",
+            len(segments),
+            min(jobs, len(segments)),
+        )
+        progress = tqdm(
+            total=len(segments), unit="segment", disable=hide_progress, ncols=80
+        )
+
+        def encode_segment(index: int) -> Path:
+            start, end = segments[index]
+            encode_start = max(0, start - _AAC_SEGMENT_OVERLAP_SAMPLES)
+            encode_end = min(total_samples, end + _AAC_SEGMENT_OVERLAP_SAMPLES)
+            source_indices = [
+                i
+                for i in range(len(sources))
+                if offsets[i] < encode_end and offsets[i + 1] > encode_start
+            ]
+            base = offsets[source_indices[0]]
+            segment_filename = work_filename.with_suffix(f".seg{index:03d}.m4a")
+            temp_files.append(segment_filename)
+            cmd = [
+                "ffmpeg",
+                "-y",
+                "-nostdin",
+                "-hide_banner",
+                "-loglevel",
+                ffmpeg_loglevel,
+            ]
+            if len(source_indices) == 1:
+                cmd.extend(["-i", str(sources[source_indices[0]])])
+            else:
+                sources_list_filename = work_filename.with_suffix(
+                    f".seg{index:03d}.txt"
+                )
+                temp_files.append(sources_list_filename)
+                with sources_list_filename.open("w", encoding="utf-8") as f:
+                    for i in source_indices:
+                        f.write(_ffconcat_file_line(sources[i]))
+                cmd.extend(
+                    ["-f", "concat", "-safe", "0", "-i", str(sources_list_filename)]
+                )
+            cmd.extend(
+                [
+                    "-map",
+                    "0:a",
+                    "-af",
+                    f"atrim=start_sample={encode_start - base}"
+                    f":end_sample={encode_end - base},asetpts=N/SR/TB",
+                    "-c:a",
+                    merge_codec,
+                    "-b:a",
+                    f"{audio_bitrate}k" if audio_bitrate else "64k",
+                    "-f",
+                    "mp4",
+                    str(segment_filename),
+                ]
+            )
+            exit_code = subprocess.call(cmd)
+            if exit_code:
+                logger.error(f"ffmpeg exited with the code: {exit_code!s}")
+                logger.error(f"Command: {' '.join(cmd)!s}")
+                raise OdmpyRuntimeError("ffmpeg exited with a non-zero code")
+            progress.update(1)
+            return segment_filename
+
+        with progress:
+            segment_filenames = run_ordered(
+                encode_segment, range(len(segments)), max_workers=jobs
+            )
+
+        segments_list_filename = work_filename.with_suffix(".segments.txt")
+        temp_files.append(segments_list_filename)
+        with segments_list_filename.open("w", encoding="utf-8") as f:
+            for index, (segment_filename, (start, end)) in enumerate(
+                zip(segment_filenames, segments)
+            ):
+                # drop the overlap frames, timestamps are packet aligned
+                # so round inwards to keep the boundary frames
+                lead_samples = start - max(0, start - _AAC_SEGMENT_OVERLAP_SAMPLES)
+                f.write(_ffconcat_file_line(segment_filename))
+                if lead_samples:
+                    inpoint_us = -(-lead_samples * 1000000 // sample_rate)
+                    f.write(f"inpoint {inpoint_us}us\n")
+                if index < len(segments) - 1:
+                    outpoint_us = (lead_samples + end - start) * 1000000 // sample_rate
+                    f.write(f"outpoint {outpoint_us}us\n")
+        # the joined segments start at 0, shift them back by the encoder
+        # delay so that it is trimmed off like in a single pass encode
+        yield [
+            "-itsoffset",
+            _first_packet_time(segment_filenames[0]),
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            str(segments_list_filename),
+        ]
+    finally:
+        for temp_file in temp_files:
+            if temp_file.exists():
+                try:
+                    temp_file.unlink()
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.warning(f'Error deleting "{temp_file}": {str(e)}')
+
+
 def convert_to_m4b(
     book_filename: Path,
     book_m4b_filename: Path,
@@ -431,6 +1430,8 @@ def convert_to_m4b(
     ffmpeg_loglevel: str,
     hide_progress: str,
     logger: logging.Logger,
+    jobs: int = 1,
+    split_points_ms: Optional[List[int]] = None,
 ) -> None:
     """
     Converts the merged mp3 into a m4b
@@ -443,54 +1444,81 @@ def convert_to_m4b(
     :param ffmpeg_loglevel:
     :param hide_progress:
     :param logger:
+    :param jobs: number of segments to encode concurrently
+    :param split_points_ms: preferred segment split points, e.g. chapter starts
     :return:
     """
     temp_book_m4b_filename = book_m4b_filename.with_suffix(".part")
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-nostdin",
-        "-hide_banner",
-        "-loglevel",
-        ffmpeg_loglevel,
-    ]
-    if not hide_progress:
-        cmd.append("-stats")
-    cmd.extend(
-        [
-            "-i",
-            str(book_filename),
+    with encoded_aac_segments(
+        sources=[book_filename],
+        work_filename=book_m4b_filename,
+        merge_codec=merge_codec,
+        audio_bitrate=audio_bitrate,
+        jobs=jobs,
+        split_points_ms=split_points_ms or [],
+        ffmpeg_loglevel=ffmpeg_loglevel,
+        hide_progress=bool(hide_progress),
+        logger=logger,
+    ) as segments_input:
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-nostdin",
+            "-hide_banner",
+            "-loglevel",
+            ffmpeg_loglevel,
         ]
-    )
-    if cover_filename.exists():
-        cmd.extend(["-i", str(cover_filename)])
+        if not hide_progress:
+            cmd.append("-stats")
+        cmd.extend(
+            segments_input
+            or [
+                "-i",
+                str(book_filename),
+            ]
+        )
+        if cover_filename.exists():
+            cmd.extend(["-i", str(cover_filename)])
+        if segments_input:
+            # tags and chapters are still taken from the merged mp3
+            metadata_input = "2" if cover_filename.exists() else "1"
+            cmd.extend(
+                [
+                    "-i",
+                    str(book_filename),
+                    "-map_metadata",
+                    metadata_input,
+                    "-map_chapters",
+                    metadata_input,
+                ]
+            )
 
-    cmd.extend(
-        [
-            "-map",
-            "0:a",
-            "-c:a",
-            merge_codec,
-            "-b:a",
-            f"{audio_bitrate}k"
-            if audio_bitrate
-            else "64k",  # explicitly set audio bitrate
-        ]
-    )
-    if cover_filename.exists():
         cmd.extend(
             [
                 "-map",
-                "1:v",
-                "-c:v",
-                "copy",
-                "-disposition:v:0",
-                "attached_pic",
+                "0:a",
+                "-c:a",
+                "copy" if segments_input else merge_codec,
+                "-b:a",
+                f"{audio_bitrate}k"
+                if audio_bitrate
+                else "64k",  # explicitly set audio bitrate
             ]
         )
+        if cover_filename.exists():
+            cmd.extend(
+                [
+                    "-map",
+                    "1:v",
+                    "-c:v",
+                    "copy",
+                    "-disposition:v:0",
+                    "attached_pic",
+                ]
+            )
 
-    cmd.extend(["-f", "mp4", str(temp_book_m4b_filename)])
-    exit_code = subprocess.call(cmd)
+        cmd.extend(["-f", "mp4", str(temp_book_m4b_filename)])
+        exit_code = subprocess.call(cmd)
     if exit_code:
         logger.error(f"ffmpeg exited with the code: {exit_code!s}")
         logger.error(f"Command: {' '.join(cmd)!s}")
@@ -504,21 +1532,237 @@ def convert_to_m4b(
         logger.warning(f'Error deleting "{book_filename}": {str(e)}')
 
 
+def m4b_metadata_tags(
+    title: str,
+    authors: List[str],
+    narrators: Optional[List[str]],
+    publisher: str,
+    description: str,
+    genres: Optional[List[str]],
+    languages: Optional[List[str]],
+    published_date: Optional[str],
+    series: Optional[str],
+    delimiter: str = ";",
+) -> Dict[str, str]:
+    """
+    The merged file tags, as ffmpeg metadata keys, matching what `write_tags`
+    would have written into the merged mp3.
+
+    :param title:
+    :param authors:
+    :param narrators:
+    :param publisher:
+    :param description:
+    :param genres:
+    :param languages:
+    :param published_date:
+    :param series:
+    :param delimiter:
+    :return:
+    """
+    if not delimiter:
+        delimiter = ";"
+    tags = {"title": title, "album": title}
+    if authors:
+        tags["artist"] = delimiter.join(authors)
+        tags["album_artist"] = delimiter.join(authors)
+    if narrators:
+        tags["performer"] = delimiter.join(narrators)
+    if publisher:
+        tags["publisher"] = publisher
+    if description:
+        tags["comment"] = description
+    if genres:
+        tags["genre"] = delimiter.join(genres)
+    if languages:
+        try:
+            tags["language"] = delimiter.join([Lang(lang).pt2b for lang in languages])
+        except:  # noqa: E722, pylint: disable=bare-except
+            tags["language"] = delimiter.join(languages)
+    if published_date:
+        tags["date"] = published_date
+    if series:
+        # the mp4 muxer drops keys that it has no atom for, so the series
+        # goes into the grouping atom instead of a "Series" key
+        tags["grouping"] = series
+    return tags
+
+
+def _escape_ffmetadata(value: str) -> str:
+    # https://ffmpeg.org/ffmpeg-formats.html#Metadata-1
+    return re.sub(r"([=;#\\\n])", r"\\\1", value)
+
+
+def generate_ffmetadata(
+    tags: Dict[str, str], chapters: List[Tuple[str, int, int]]
+) -> str:
+    """
+    Generate a ffmetadata file
+
+    :param tags:
+    :param chapters: (title, start ms, end ms)
+    :return:
+    """
+    lines = [";FFMETADATA1"]
+    lines.extend(
+        f"{_escape_ffmetadata(k)}={_escape_ffmetadata(v)}" for k, v in tags.items()
+    )
+    for chapter_title, start_ms, end_ms in chapters:
+        lines.extend(
+            [
+                "[CHAPTER]",
+                "TIMEBASE=1/1000",
+                f"START={start_ms}",
+                f"END={end_ms}",
+                f"title={_escape_ffmetadata(chapter_title)}",
+            ]
+        )
+    return "\n".join(lines) + "\n"
+
+
+def merge_into_m4b(
+    book_m4b_filename: Path,
+    file_tracks: List[Dict],
+    tags: Dict[str, str],
+    chapters: List[Tuple[str, int, int]],
+    cover_filename: Path,
+    merge_codec: str,
+    audio_bitrate: int,
+    ffmpeg_loglevel: str,
+    hide_progress: bool,
+    logger: logging.Logger,
+    jobs: int = 1,
+) -> None:
+    """
+    Encode the parts straight into a m4b in a single ffmpeg pass, with tags
+    and chapters from a ffmetadata file, so that no merged mp3 is written.
+
+    :param book_m4b_filename:
+    :param file_tracks:
+    :param tags:
+    :param chapters: (title, start ms, end ms)
+    :param cover_filename:
+    :param merge_codec:
+    :param audio_bitrate:
+    :param ffmpeg_loglevel:
+    :param hide_progress:
+    :param logger:
+    :param jobs: number of segments to encode concurrently
+    :return:
+    """
+    temp_book_m4b_filename = book_m4b_filename.with_suffix(".part")
+    concat_list_filename = book_m4b_filename.with_suffix(".concat.txt")
+    metadata_filename = book_m4b_filename.with_suffix(".ffmetadata.txt")
+    with concat_list_filename.open("w", encoding="utf-8") as f:
+        for file_track in file_tracks:
+            f.write(_ffconcat_file_line(file_track["file"]))
+    with metadata_filename.open("w", encoding="utf-8") as f:
+        f.write(generate_ffmetadata(tags, chapters))
+
+    try:
+        with encoded_aac_segments(
+            sources=[file_track["file"] for file_track in file_tracks],
+            work_filename=book_m4b_filename,
+            merge_codec=merge_codec,
+            audio_bitrate=audio_bitrate,
+            jobs=jobs,
+            split_points_ms=[start_ms for _, start_ms, _ in chapters],
+            ffmpeg_loglevel=ffmpeg_loglevel,
+            hide_progress=hide_progress,
+            logger=logger,
+        ) as segments_input:
+            cmd = [
+                "ffmpeg",
+                "-y",
+                "-nostdin",
+                "-hide_banner",
+                "-loglevel",
+                ffmpeg_loglevel,
+            ]
+            if not hide_progress:
+                cmd.append("-stats")
+            cmd.extend(
+                segments_input
+                or ["-f", "concat", "-safe", "0", "-i", str(concat_list_filename)]
+            )
+            cmd.extend(["-i", str(metadata_filename)])
+            if cover_filename.exists():
+                cmd.extend(["-i", str(cover_filename)])
+
+            cmd.extend(
+                [
+                    "-map",
+                    "0:a",
+                    "-map_metadata",
+                    "1",
+                    "-map_chapters",
+                    "1",
+                    "-c:a",
+                    "copy" if segments_input else merge_codec,
+                    "-b:a",
+                    f"{audio_bitrate}k"
+                    if audio_bitrate
+                    else "64k",  # explicitly set audio bitrate
+                ]
+            )
+            if cover_filename.exists():
+                cmd.extend(
+                    [
+                        "-map",
+                        "2:v",
+                        "-c:v",
+                        "copy",
+                        "-disposition:v:0",
+                        "attached_pic",
+                    ]
+                )
+
+            cmd.extend(["-f", "mp4", str(temp_book_m4b_filename)])
+            exit_code = subprocess.call(cmd)
+    finally:
+        for f_path in (concat_list_filename, metadata_filename):
+            try:
+                f_path.unlink()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f'Error deleting "{f_path}": {str(e)}')
+    if exit_code:
+        logger.error(f"ffmpeg exited with the code: {exit_code!s}")
+        logger.error(f"Command: {' '.join(cmd)!s}")
+        raise OdmpyRuntimeError("ffmpeg exited with a non-zero code")
+
+    temp_book_m4b_filename.rename(book_m4b_filename)
+    logger.info('Merged files into "%s"', colored(str(book_m4b_filename), "magenta"))
+
+
 def remux_mp3(
     part_tmp_filename: Path,
     part_filename: Path,
     ffmpeg_loglevel: str,
     logger: logging.Logger,
+    always_remux: bool = False,
 ) -> None:
     """
     Try to remux file to remove mp3 lame tag errors
 
+    Unless `always_remux`, the Xing/LAME headers are first checked and fixed
+    in place, and ffmpeg is only run if that is not possible.
+
     :param part_tmp_filename:
     :param part_filename:
     :param ffmpeg_loglevel:
     :param logger:
+    :param always_remux:
     :return:
     """
+    if not always_remux:
+        try:
+            if repair_mp3_headers(part_tmp_filename):
+                part_tmp_filename.rename(part_filename)
+                return
+            logger.debug('Unable to repair "%s" in place, remuxing', part_tmp_filename)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug(f'Error repairing "{part_tmp_filename}": {str(e)}')
+
     cmd = [
         "ffmpeg",
         "-y",
@@ -547,6 +1791,180 @@ def remux_mp3(
         part_tmp_filename.rename(part_filename)
 
 
+def can_stream_remux(
+    args: argparse.Namespace, part_tmp_filename: Path, part_file_size: int
+) -> bool:
+    """
+    Whether a part can be downloaded with `stream_remux_part`.
+    Partial downloads are resumed and large parts fetched in segments
+    through the normal `.part` file instead.
+
+    :param args:
+    :param part_tmp_filename:
+    :param part_file_size:
+    :return:
+    """
+    return bool(
+        args.stream_remux
+        and not part_tmp_filename.exists()
+        and not (
+            args.download_segments > 1
+            and part_file_size >= args.segment_min_size_mb * 1024 * 1024
+        )
+    )
+
+
+def stream_remux_part(
+    session: requests.Session,
+    part_download_url: str,
+    headers: Dict[str, str],
+    part_filename: Path,
+    part_file_size: int,
+    desc: str,
+    timeout: int,
+    hide_progress: bool,
+    ffmpeg_loglevel: str,
+    logger: logging.Logger,
+    progress_position: Optional[int] = None,
+) -> None:
+    """
+    Download a part and remux it on the fly by piping the response body
+    into ffmpeg, so that the part is written to disk only once.
+
+    As with `remux_mp3`, the raw mp3 is saved instead if ffmpeg fails.
+
+    :param session:
+    :param part_download_url:
+    :param headers:
+    :param part_filename:
+    :param part_file_size:
+    :param desc:
+    :param timeout:
+    :param hide_progress:
+    :param ffmpeg_loglevel:
+    :param logger:
+    :param progress_position:
+    :return:
+    """
+    remux_tmp_filename = part_filename.with_suffix(".remux.mp3")
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        ffmpeg_loglevel,
+        "-f",
+        "mp3",
+        "-i",
+        "pipe:0",
+        "-c:a",
+        "copy",
+        "-c:v",
+        "copy",
+        "-f",
+        "mp3",
+        str(remux_tmp_filename),
+    ]
+
+    part_download_res = session.get(
+        part_download_url, headers=headers, timeout=timeout, stream=True
+    )
+    part_download_res.raise_for_status()
+    expected_len = 0
+    if part_download_res.headers.get("Content-Length") and not (
+        part_download_res.headers.get("Content-Encoding")
+    ):
+        expected_len = int(part_download_res.headers["Content-Length"])
+
+    try:
+        ffmpeg_proc: Optional[subprocess.Popen] = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE
+        )
+    except Exception as ffmpeg_ex:  # pylint: disable=broad-except
+        logger.warning(f"Error executing ffmpeg: {str(ffmpeg_ex)}")
+        ffmpeg_proc = None
+
+    def iter_body() -> Iterator[bytes]:
+        received_len = 0
+        try:
+            for chunk in part_download_res.iter_content(chunk_size=64 * 1024):
+                received_len += len(chunk)
+                yield chunk
+        except requests.exceptions.ChunkedEncodingError as err:
+            # the connection dropped mid-body
+            raise requests.ConnectionError(
+                f'Incomplete download of "{part_filename}": {err}'
+            ) from err
+        if expected_len and received_len != expected_len:
+            # a connection error so that it is retried
+            raise requests.ConnectionError(
+                f'Incomplete download of "{part_filename}": '
+                f"received {received_len} of {expected_len} bytes"
+            )
+
+    exit_code = 0
+    with part_download_res, tqdm(
+        total=part_file_size,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+        disable=hide_progress,
+        position=progress_position,
+        leave=progress_position is None,
+    ) as progress:
+        if not ffmpeg_proc or not ffmpeg_proc.stdin:
+            # no ffmpeg, save the raw stream, through the .part file
+            # so that an interrupted download is resumed instead of kept
+            part_tmp_filename = part_filename.with_suffix(".part")
+            with part_tmp_filename.open("wb") as outfile:
+                for chunk in iter_body():
+                    outfile.write(chunk)
+                    progress.update(len(chunk))
+            part_tmp_filename.replace(part_filename)
+            return
+
+        try:
+            for chunk in iter_body():
+                ffmpeg_proc.stdin.write(chunk)
+                progress.update(len(chunk))
+            ffmpeg_proc.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg has quit early, the exit code says why
+            pass
+        except BaseException:
+            ffmpeg_proc.kill()
+            ffmpeg_proc.wait()
+            if remux_tmp_filename.exists():
+                remux_tmp_filename.unlink()
+            raise
+        exit_code = ffmpeg_proc.wait()
+
+    if not exit_code:
+        remux_tmp_filename.replace(part_filename)
+        return
+
+    logger.warning(f"ffmpeg exited with the code: {exit_code!s}")
+    logger.warning(f"Command: {' '.join(cmd)!s}")
+    if remux_tmp_filename.exists():
+        remux_tmp_filename.unlink()
+    # ffmpeg has consumed the stream, so fetch the raw part again
+    part_tmp_filename = part_filename.with_suffix(".part")
+    download_part(
+        session=session,
+        part_download_url=part_download_url,
+        headers=headers,
+        part_tmp_filename=part_tmp_filename,
+        part_file_size=part_file_size,
+        desc=desc,
+        timeout=timeout,
+        hide_progress=hide_progress,
+        progress_position=progress_position,
+    )
+    part_tmp_filename.rename(part_filename)
+
+
 def extract_authors_from_openbook(openbook: Dict) -> List[str]:
     """
     Extract list of author names from openbook
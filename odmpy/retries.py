@@ -0,0 +1,254 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+import email.utils
+import logging
+import random
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, Dict, Optional, TypeVar, Tuple
+from urllib.error import HTTPError as UrllibHTTPError
+from urllib.parse import urlparse
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from .libby_errors import ClientError
+
+#
+# Application level retries for requests and (resumable) downloads
+#
+
+RETRY_STATUSES = (
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+)
+# statuses where the server may tell us how long to wait
+RETRY_AFTER_STATUSES = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised when requests to a host are paused after repeated failures."""
+
+    def __init__(self, host: str, retry_in: float):
+        self.host = host
+        self.retry_in = retry_in
+        super().__init__(
+            f"Requests to {host} are paused for {retry_in:.0f}s after repeated failures"
+        )
+
+
+class CircuitBreaker(object):
+    """
+    Tracks failures per host, shared by all the workers. After
+    `failure_threshold` consecutive failures, requests to the host are
+    refused for `cooldown` seconds. The next failure after that trips it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures: Dict[str, int] = {}
+        self._opened_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def check(self, host: str) -> None:
+        """
+        :param host:
+        :raises CircuitOpenError: if requests to the host are paused
+        :return:
+        """
+        with self._lock:
+            retry_in = self._opened_until.get(host, 0) - time.monotonic()
+        if retry_in > 0:
+            raise CircuitOpenError(host, retry_in)
+
+    def record_success(self, host: str) -> None:
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened_until.pop(host, None)
+
+    def record_failure(self, host: str) -> None:
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            if failures >= self.failure_threshold:
+                self._opened_until[host] = time.monotonic() + self.cooldown
+                # allow one trial request after the cooldown
+                failures = self.failure_threshold - 1
+            self._failures[host] = failures
+
+
+# shared so that concurrent workers back off from the same host together
+default_circuit_breaker = CircuitBreaker()
+
+
+def _error_status(err: Exception) -> Tuple[int, Optional[str]]:
+    """
+    Get the HTTP status and Retry-After header of a request error.
+
+    :param err:
+    :return:
+    """
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return err.response.status_code, err.response.headers.get("Retry-After")
+    if isinstance(err, UrllibHTTPError):
+        return err.code, err.headers.get("Retry-After") if err.headers else None
+    if isinstance(err, ClientError):
+        return err.http_status, None
+    return 0, None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header value, in seconds or as an HTTP date.
+
+    :param value:
+    :return: Seconds to wait
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RetryPolicy(object):
+    """
+    Retries a request or download with exponential backoff and full jitter,
+    honouring Retry-After on 429/503 responses. Failures are recorded in a
+    per-host `CircuitBreaker`.
+
+    Downloads retried with `call()` should pick up from the bytes already
+    written, e.g. `download_part()` resumes from the existing .part file.
+    Their session should not retry as well, see `transport.disable_retries()`.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 1,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 60.0,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """
+        :param max_retries: Number of retries after the first attempt
+        :param backoff_factor: Base delay (seconds), doubled on every retry
+        :param max_backoff: Maximum delay (seconds), including Retry-After
+        :param circuit_breaker: Defaults to the shared `default_circuit_breaker`
+        :param logger:
+        """
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.circuit_breaker = circuit_breaker or default_circuit_breaker
+        self.logger = logger or logging.getLogger(__name__)
+        self.sleep: Callable[[float], None] = time.sleep
+
+    @staticmethod
+    def is_retryable(err: Exception) -> bool:
+        """
+        Check if a request error is worth retrying.
+
+        :param err:
+        :return:
+        """
+        if isinstance(
+            err,
+            (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                # raised as-is when reading the raw response
+                ProtocolError,
+                ReadTimeoutError,
+            ),
+        ):
+            return True
+        status, _ = _error_status(err)
+        return status in RETRY_STATUSES
+
+    def get_delay(self, attempt: int, err: Exception) -> float:
+        """
+        Get the delay before the next attempt.
+
+        :param attempt: Number of attempts that have failed, less 1
+        :param err: The error from the failed attempt
+        :return:
+        """
+        if isinstance(err, CircuitOpenError):
+            return min(self.max_backoff, err.retry_in)
+        status, retry_after = _error_status(err)
+        retry_after_seconds = (
+            parse_retry_after(retry_after) if status in RETRY_AFTER_STATUSES else None
+        )
+        if retry_after_seconds is not None:
+            # a little jitter so that the workers do not all return at once
+            return min(
+                self.max_backoff,
+                retry_after_seconds + random.uniform(0, self.backoff_factor),
+            )
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff_factor * (2**attempt))
+        )
+
+    def call(self, func: Callable[[], T], url: str) -> T:
+        """
+        Call `func` with retries.
+
+        :param func: Makes the request(s) to `url`
+        :param url: For the per-host circuit breaker
+        :return: The result of `func`
+        """
+        host = urlparse(url).hostname or ""
+        attempt = 0
+        while True:
+            try:
+                self.circuit_breaker.check(host)
+                result = func()
+            except Exception as err:  # pylint: disable=broad-except
+                if not isinstance(err, CircuitOpenError):
+                    if not self.is_retryable(err):
+                        raise
+                    self.circuit_breaker.record_failure(host)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.get_delay(attempt, err)
+                attempt += 1
+                self.logger.warning(
+                    "%s. Retrying in %.1fs (%d/%d)...",
+                    err,
+                    delay,
+                    attempt,
+                    self.max_retries,
+                )
+                self.sleep(delay)
+                continue
+            self.circuit_breaker.record_success(host)
+            return result
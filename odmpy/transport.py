@@ -0,0 +1,132 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+#
+# Shared HTTP transport so that every session reuses the same
+# (kept-alive) connection pools
+#
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that is mounted on many sessions. Closing one of the
+    sessions does not close the connection pools used by the others.
+    """
+
+    def close(self) -> None:
+        pass
+
+    def close_pools(self) -> None:
+        super().close()
+
+
+_pool_settings = {
+    "pool_connections": DEFAULT_POOL_CONNECTIONS,
+    "pool_maxsize": DEFAULT_POOL_MAXSIZE,
+    "pool_block": False,
+}
+_adapters: Dict[Tuple[int, int], SharedHTTPAdapter] = {}
+_adapters_lock = threading.Lock()
+
+
+def configure_transport(
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    pool_block: bool = False,
+) -> None:
+    """
+    Set up the connection pools used by sessions created after this.
+
+    :param pool_connections: Number of hosts to keep a connection pool for
+    :param pool_maxsize: Number of connections to keep per host
+    :param pool_block: Make `pool_maxsize` a hard limit on the concurrent connections per host
+    :return:
+    """
+    with _adapters_lock:
+        _pool_settings.update(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        # sessions already created keep their adapters
+        _adapters.clear()
+
+
+def get_adapter(
+    max_retries: int = 0, pool_maxsize: Optional[int] = None
+) -> SharedHTTPAdapter:
+    """
+    Get the shared adapter for the retry setting.
+
+    :param max_retries:
+    :param pool_maxsize: Overrides the configured number of connections per host
+    :return:
+    """
+    with _adapters_lock:
+        maxsize = int(pool_maxsize or _pool_settings["pool_maxsize"])
+        adapter = _adapters.get((max_retries, maxsize))
+        if not adapter:
+            adapter = SharedHTTPAdapter(
+                pool_connections=int(_pool_settings["pool_connections"]),
+                pool_maxsize=maxsize,
+                pool_block=bool(_pool_settings["pool_block"]),
+                max_retries=Retry(total=max_retries, backoff_factor=0.1),
+            )
+            _adapters[(max_retries, maxsize)] = adapter
+        return adapter
+
+
+def new_session(
+    max_retries: int = 0, pool_maxsize: Optional[int] = None
+) -> requests.Session:
+    """
+    Create a session that uses the shared connection pools.
+    Cookies and headers are still per session.
+
+    :param max_retries:
+    :param pool_maxsize: Overrides the configured number of connections per host
+    :return:
+    """
+    session = requests.Session()
+    adapter = get_adapter(max_retries, pool_maxsize)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, adapter)
+    return session
+
+
+def disable_retries(session: requests.Session) -> None:
+    """
+    Switch a session to the shared connection pools without retries, for
+    requests that are retried by a `RetryPolicy` instead. Otherwise each
+    attempt of the policy would also be retried by urllib3.
+    Cookies and headers are kept.
+
+    :param session:
+    :return:
+    """
+    adapter = get_adapter(max_retries=0)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, adapter)
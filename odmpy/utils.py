@@ -16,6 +16,8 @@
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import logging
+import mmap
 import os
 import platform
 import re
@@ -23,8 +25,9 @@ import unicodedata
 import xml.etree.ElementTree as ET
 from mimetypes import guess_type
 from pathlib import Path
-from typing import Optional
+from typing import Optional, NamedTuple, Dict, List, Union
 
+import requests
 from mutagen.mp3 import MP3  # type: ignore[import]
 
 #
@@ -35,6 +38,8 @@ TIMESTAMP_RE = re.compile(
     r"^((?P<hr>[0-9]+):)?(?P<min>[0-9]+):(?P<sec>[0-9]+)(\.(?P<ms>[0-9]+))?$"
 )
 ILLEGAL_WIN_PATH_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+TEXT_CONTENT_TYPE_RE = re.compile(r"^text/|[/+](json|xml|javascript)\b")
+LOGGED_BODY_MAX_LENGTH = 2000
 MIMETYPE_MAP = {
     ".xhtml": "application/xhtml+xml",
     ".html": "text/html",
@@ -67,6 +72,37 @@ def guess_mimetype(url: str) -> Optional[str]:
     return mime_type
 
 
+def log_response_body(
+    logger: logging.Logger,
+    res: requests.Response,
+    max_length: int = LOGGED_BODY_MAX_LENGTH,
+) -> None:
+    """
+    Log a response body for debugging. Nothing is decoded unless debug logging
+    is enabled, binary bodies are only described, and long bodies are truncated.
+
+    :param logger:
+    :param res:
+    :param max_length: Maximum number of characters to log
+    :return:
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    content_type = res.headers.get("content-type", "")
+    if not TEXT_CONTENT_TYPE_RE.search(content_type):
+        logger.debug(
+            "body: <%s, %s bytes>",
+            content_type or "unknown content-type",
+            res.headers.get("content-length", "?"),
+        )
+        return
+    text = res.text
+    if len(text) > max_length:
+        logger.debug("body: %s... (%d chars)", text[:max_length], len(text))
+        return
+    logger.debug("body: %s", text)
+
+
 def is_windows() -> bool:
     """
     Returns True if running on Windows.
@@ -172,6 +208,302 @@ def mp3_duration_ms(filename: Path) -> int:
     return int(round(audio.info.length * 1000))
 
 
+#
+# MP3 frame and Xing/LAME header handling
+#
+
+# Layer III bitrates (kbps) by bitrate index, for MPEG-1 and MPEG-2/2.5
+_MP3_BITRATES = {
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by MPEG version bits, then sample rate index
+_MP3_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # MPEG-1
+    0b10: (22050, 24000, 16000),  # MPEG-2
+    0b00: (11025, 12000, 8000),  # MPEG-2.5
+}
+# Encoder strings that mark the start of a LAME tag
+_LAME_TAG_ENCODERS = (b"LAME", b"Lavf", b"Lavc")
+
+
+class Mp3FrameHeader(NamedTuple):
+    header: int
+    version: int
+    sample_rate: int
+    channel_mode: int
+    bitrate: int
+    frame_length: int
+    samples: int
+    side_info_size: int
+
+
+class Mp3Stream(NamedTuple):
+    audio_start: int  # after any ID3v2 tag
+    audio_end: int  # before any ID3v1 tag
+    first_frame: Mp3FrameHeader
+    frame_offsets: List[int]
+    has_xing_frame: bool  # if the first frame is a Xing/Info frame
+    is_vbr: bool
+
+
+def parse_mp3_frame_header(header: bytes) -> Optional[Mp3FrameHeader]:
+    """
+    Parse a 4-byte MPEG audio layer III frame header.
+
+    :param header:
+    :return: None if not a valid layer III frame header
+    """
+    if len(header) < 4:
+        return None
+    h = int.from_bytes(header[:4], "big")
+    if (h >> 21) & 0x7FF != 0x7FF:
+        return None
+    version = (h >> 19) & 0b11
+    layer = (h >> 17) & 0b11
+    bitrate_index = (h >> 12) & 0xF
+    sample_rate_index = (h >> 10) & 0b11
+    padding = (h >> 9) & 0b1
+    channel_mode = (h >> 6) & 0b11
+    is_mono = channel_mode == 0b11
+    if (
+        version == 0b01  # reserved
+        or layer != 0b01  # not layer III
+        or bitrate_index in (0, 15)  # free format or invalid
+        or sample_rate_index == 0b11  # reserved
+    ):
+        return None
+    is_mpeg1 = version == 0b11
+    samples = 1152 if is_mpeg1 else 576
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    bitrate = _MP3_BITRATES[is_mpeg1][bitrate_index] * 1000
+    if is_mpeg1:
+        side_info_size = 17 if is_mono else 32
+    else:
+        side_info_size = 9 if is_mono else 17
+    return Mp3FrameHeader(
+        header=h,
+        version=version,
+        sample_rate=sample_rate,
+        channel_mode=channel_mode,
+        bitrate=bitrate,
+        frame_length=(samples // 8) * bitrate // sample_rate + padding,
+        samples=samples,
+        side_info_size=side_info_size,
+    )
+
+
+def _crc16(data: bytes) -> int:
+    # CRC-16/ARC, as used for the LAME tag CRC
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def _id3v2_size(data: bytes) -> int:
+    # size of a leading ID3v2 tag (including header and footer), or 0
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    has_footer = data[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def xing_tag_offset(frame: Mp3FrameHeader) -> int:
+    """
+    Offset of the Xing/Info tag from the start of its frame.
+
+    :param frame:
+    :return:
+    """
+    return 4 + frame.side_info_size
+
+
+def scan_mp3(data: Union[bytes, mmap.mmap]) -> Optional[Mp3Stream]:
+    """
+    Walk the frames of an mp3.
+
+    :param data: The whole file contents, e.g. as a mmap
+    :return: None if the file has junk or truncated frames, or the format changes midway
+    """
+    audio_start = _id3v2_size(data[:10])
+    first_frame = parse_mp3_frame_header(data[audio_start : audio_start + 4])
+    if not first_frame:
+        return None
+
+    audio_end = len(data)
+    if (
+        audio_end - 128 >= audio_start
+        and data[audio_end - 128 : audio_end - 125] == b"TAG"
+    ):
+        # ID3v1 tag
+        audio_end -= 128
+
+    tag_start = audio_start + xing_tag_offset(first_frame)
+    has_xing_frame = data[tag_start : tag_start + 4] in (b"Xing", b"Info")
+    bitrates = set()
+    frame_offsets: List[int] = []
+    pos = audio_start
+    while pos < audio_end:
+        frame = parse_mp3_frame_header(data[pos : pos + 4])
+        if (
+            not frame
+            or frame.version != first_frame.version
+            or frame.sample_rate != first_frame.sample_rate
+            or pos + frame.frame_length > audio_end
+        ):
+            return None
+        if frame_offsets or not has_xing_frame:
+            bitrates.add(frame.bitrate)
+        frame_offsets.append(pos)
+        pos += frame.frame_length
+
+    return Mp3Stream(
+        audio_start=audio_start,
+        audio_end=audio_end,
+        first_frame=first_frame,
+        frame_offsets=frame_offsets,
+        has_xing_frame=has_xing_frame,
+        is_vbr=len(bitrates) > 1,
+    )
+
+
+def build_xing_frame(
+    template: Mp3FrameHeader,
+    frames_count: int,
+    audio_length: int,
+    toc_positions: List[int],
+    is_vbr: bool,
+) -> bytes:
+    """
+    Build a Xing (VBR) or Info (CBR) frame to put in front of a stream of
+    MPEG frames that are in the same format as `template`.
+
+    :param template: Any audio frame of the stream
+    :param frames_count: Number of audio frames, not counting the new frame
+    :param audio_length: Length in bytes of the audio frames
+    :param toc_positions: Byte offsets into the audio frames at each percent of the duration
+    :param is_vbr:
+    :return:
+    """
+    # no CRC, no padding
+    header = (template.header | (1 << 16)) & ~(1 << 9)
+    is_mpeg1 = template.version == 0b11
+    bitrate_index = (header >> 12) & 0xF
+    # tag, flags, frames count, bytes count, toc
+    min_frame_length = xing_tag_offset(template) + 4 + 4 + 4 + 4 + 100
+    frame: Optional[Mp3FrameHeader] = None
+    # use the stream bitrate if the frame can hold the tag, like LAME does
+    for i in [bitrate_index] + list(range(1, len(_MP3_BITRATES[is_mpeg1]))):
+        header = (header & ~(0xF << 12)) | (i << 12)
+        frame = parse_mp3_frame_header(header.to_bytes(4, "big"))
+        if frame and frame.frame_length >= min_frame_length:
+            break
+    if not frame or frame.frame_length < min_frame_length:
+        raise ValueError("Unable to fit a Xing tag into a frame")
+
+    stream_length = frame.frame_length + audio_length
+    data = bytearray(frame.frame_length)
+    data[0:4] = header.to_bytes(4, "big")
+    pos = xing_tag_offset(frame)
+    data[pos : pos + 4] = b"Xing" if is_vbr else b"Info"
+    data[pos + 4 : pos + 8] = (0x1 | 0x2 | 0x4).to_bytes(4, "big")
+    data[pos + 8 : pos + 12] = frames_count.to_bytes(4, "big")
+    data[pos + 12 : pos + 16] = stream_length.to_bytes(4, "big")
+    data[pos + 16 : pos + 116] = bytes(
+        min(255, (frame.frame_length + position) * 256 // stream_length)
+        for position in toc_positions
+    )
+    return bytes(data)
+
+
+def repair_mp3_headers(filename: Path) -> bool:
+    """
+    Check the Xing/Info and LAME headers of an mp3 against its actual
+    frames, and correct them in place if they are off.
+
+    The LAME music CRC is left as is because it is not checked by players
+    and would mean a pure python pass over all the audio.
+
+    :param filename:
+    :return: False if the file cannot be checked/fixed this way and should be remuxed
+    """
+    with filename.open("r+b") as f, mmap.mmap(f.fileno(), 0) as data:
+        stream = scan_mp3(data)
+        if not stream:
+            # junk, truncated frames or a format change: leave it to ffmpeg
+            return False
+        if not stream.has_xing_frame:
+            # no VBR header to be wrong
+            return True
+
+        audio_start = stream.audio_start
+        frame_offsets = stream.frame_offsets
+        xing_offset = audio_start + xing_tag_offset(stream.first_frame)
+
+        audio_frames_count = len(frame_offsets) - 1  # excludes the Xing frame
+        stream_length = stream.audio_end - audio_start
+        flags = int.from_bytes(data[xing_offset + 4 : xing_offset + 8], "big")
+        updates: Dict[int, bytes] = {}
+        field_offset = xing_offset + 8
+        toc_offset = 0
+        for flag, expected in ((0x1, audio_frames_count), (0x2, stream_length)):
+            if flags & flag:
+                value = expected.to_bytes(4, "big")
+                if data[field_offset : field_offset + 4] != value:
+                    updates[field_offset] = value
+                field_offset += 4
+        if flags & 0x4:
+            toc_offset = field_offset
+            field_offset += 100
+        if flags & 0x8:
+            field_offset += 4
+
+        if updates and toc_offset and audio_frames_count:
+            # the seek table is only rebuilt if the counts it is based on were wrong
+            toc = bytearray()
+            for i in range(100):
+                frame_offset = frame_offsets[1 + i * audio_frames_count // 100]
+                toc.append(
+                    min(255, (frame_offset - audio_start) * 256 // stream_length)
+                )
+            updates[toc_offset] = bytes(toc)
+
+        lame_offset = field_offset
+        lame_tag_crc_offset = lame_offset + 34
+        has_lame_tag = (
+            data[lame_offset : lame_offset + 4] in _LAME_TAG_ENCODERS
+            and lame_tag_crc_offset + 2 <= audio_start + stream.first_frame.frame_length
+        )
+        if has_lame_tag:
+            music_length = stream_length.to_bytes(4, "big")
+            if data[lame_offset + 28 : lame_offset + 32] != music_length:
+                updates[lame_offset + 28] = music_length
+
+        if not updates and not has_lame_tag:
+            return True
+
+        xing_frame = bytearray(data[audio_start : lame_tag_crc_offset + 2])
+        for offset, value in updates.items():
+            xing_frame[offset - audio_start : offset - audio_start + len(value)] = value
+        if has_lame_tag:
+            crc_start = lame_tag_crc_offset - audio_start
+            tag_crc = _crc16(bytes(xing_frame[:crc_start])).to_bytes(2, "big")
+            if xing_frame[crc_start : crc_start + 2] != tag_crc:
+                updates[lame_tag_crc_offset] = tag_crc
+
+        for offset, value in updates.items():
+            data[offset : offset + len(value)] = value
+        if updates:
+            data.flush()
+        return True
+
+
 # From django
 def slugify(value: str, allow_unicode: bool = False) -> str:
     """
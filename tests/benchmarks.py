@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the ebook content page parsing and cleanup, using the test data pages.
+
+Run with: python -m tests.benchmarks [ITERATIONS]
+"""
+
+import base64
+import re
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup, Doctype, Tag
+
+from odmpy.processing.ebook import (
+    CONTENT_PAGE_PARSER,
+    EPUB2_CONVERT_TAGS,
+    EPUB2_DOCTYPE,
+    EPUB2_REMOVE_ATTRIBUTES,
+    PageFacts,
+    _cleanup_soup,
+    _decode_content_page,
+)
+
+test_data_dir = Path(__file__).absolute().parent.joinpath("data")
+contents_re = re.compile(r"parent\.__bif_cfc0\(self,'(?P<base64_text>.+)'\)")
+
+
+def decode_content_page_double_parse(page_text: str) -> BeautifulSoup:
+    """The previous decoding: parse the page, then parse the decoded body again."""
+    soup = BeautifulSoup(page_text, features="html.parser")
+    script_ele = soup.find("script", attrs={"type": "text/javascript"})
+    if script_ele and hasattr(script_ele, "string"):
+        mobj = contents_re.search(script_ele.string or "")
+        if mobj:
+            new_soup = BeautifulSoup(
+                base64.b64decode(mobj.group("base64_text")), features="html.parser"
+            )
+            soup.body.replace_with(new_soup.body)  # type: ignore[arg-type,union-attr]
+    return soup
+
+
+def cleanup_soup_multi_pass(soup: BeautifulSoup, version: str = "2.0") -> PageFacts:
+    """The previous cleanup: a find_all() walk for each fix, then finds for the facts."""
+    if version == "2.0":
+        for item in soup.contents:
+            if isinstance(item, Doctype):
+                item.replace_with(Doctype(EPUB2_DOCTYPE))
+                break
+        for attribute in EPUB2_REMOVE_ATTRIBUTES:
+            for tag in soup.find_all(attrs={attribute: True}):
+                del tag[attribute]
+        for tag_name in EPUB2_CONVERT_TAGS:
+            for invalid_tag in soup.find_all(tag_name):
+                invalid_tag.name = "div"
+    for svg in soup.find_all("svg"):
+        if not svg.get("xmlns"):
+            svg["xmlns"] = "http://www.w3.org/2000/svg"
+        if not svg.get("xmlns:xlink"):
+            svg["xmlns:xlink"] = "http://www.w3.org/1999/xlink"
+    for invalid_tag in soup.find_all("figcaption"):
+        invalid_tag.name = "div"
+    for remove_tag in soup.find_all("base"):
+        remove_tag.decompose()
+    html_tag = soup.find("html")
+    if html_tag and isinstance(html_tag, Tag) and not html_tag.get("xmlns"):
+        html_tag["xmlns"] = "http://www.w3.org/1999/xhtml"
+
+    cover_image = soup.find("img", attrs={"src": True})
+    return PageFacts(
+        has_svg=bool(soup.find("svg")),
+        is_nav=bool(soup.find(attrs={"epub:type": "toc"})),
+        first_img_src=cover_image["src"] if cover_image else None,  # type: ignore[index,arg-type]
+    )
+
+
+def load_pages() -> List[str]:
+    pages = []
+    for book in ("ebook", "magazine"):
+        for page in sorted(test_data_dir.joinpath(book, "content").glob("**/*.xhtml")):
+            pages.append(page.read_text(encoding="utf-8"))
+    return pages
+
+
+def time_pages(
+    pages: List[str],
+    decode: Callable[[str], BeautifulSoup],
+    cleanup: Callable[[BeautifulSoup, str], PageFacts],
+    iterations: int,
+) -> float:
+    def process_pages() -> None:
+        for page in pages:
+            soup = decode(page)
+            cleanup(soup, "3.0")
+            str(soup)
+
+    return min(timeit.repeat(process_pages, number=iterations, repeat=3))
+
+
+def run(iterations: int) -> Dict[str, float]:
+    pages = load_pages()
+    benchmarks = {
+        "double parse, multi-pass cleanup": (
+            decode_content_page_double_parse,
+            cleanup_soup_multi_pass,
+        ),
+        "single parse (html.parser)": (
+            lambda p: _decode_content_page(p, parser="html.parser")[0],
+            cleanup_soup_multi_pass,
+        ),
+        f"single parse ({CONTENT_PAGE_PARSER})": (
+            lambda p: _decode_content_page(p)[0],
+            cleanup_soup_multi_pass,
+        ),
+        f"single parse ({CONTENT_PAGE_PARSER}), single-pass cleanup": (
+            lambda p: _decode_content_page(p)[0],
+            _cleanup_soup,
+        ),
+    }
+    timings: Dict[str, float] = {}
+    for name, (decode, cleanup) in benchmarks.items():
+        timings[name] = time_pages(pages, decode, cleanup, iterations)
+    baseline = timings["double parse, multi-pass cleanup"]
+    print(f"{len(pages)} pages x {iterations} iterations")
+    for name, timing in timings.items():
+        print(f"{name:50s} {timing:8.3f}s  {baseline / timing:5.2f}x")
+    return timings
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
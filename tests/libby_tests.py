@@ -1,9 +1,12 @@
+import json
 import logging
 import os
+import tempfile
 import unittest
 from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from http import HTTPStatus
+from pathlib import Path
 
 import responses
 from responses import matchers
@@ -445,6 +448,261 @@ class LibbyClientTests(BaseTestCase):
         self.assertEqual(context.exception.http_status, HTTPStatus.FORBIDDEN)
         self.assertEqual(context.exception.error_response, "")
 
+    @responses.activate
+    def test_libby_sync_cache(self):
+        sync_url = "https://sentry-read.svc.overdrive.com/chip/sync"
+        synced_state = {
+            "result": "synchronized",
+            "cards": [{"cardId": "99999"}],
+            "loans": [{"id": "123456", "cardId": "99999"}],
+            "holds": [],
+        }
+        responses.get(sync_url, json=synced_state)
+        responses.delete("https://sentry-read.svc.overdrive.com/card/99999/loan/123456")
+        with tempfile.TemporaryDirectory() as settings_folder:
+            client = LibbyClient(
+                settings_folder=settings_folder,
+                identity_token=".",
+                logger=self.logger,
+                sync_cache_ttl=60,
+            )
+            self.assertTrue(client.is_logged_in())
+            self.assertEqual(len(client.get_loans()), 1)
+            self.assertEqual(client.get_holds(), [])
+            responses.assert_call_count(sync_url, 1)
+
+            # state is reused by a new client within the ttl
+            other_client = LibbyClient(
+                settings_folder=settings_folder,
+                identity_token=".",
+                logger=self.logger,
+                sync_cache_ttl=60,
+            )
+            self.assertEqual(other_client.sync(), synced_state)
+            responses.assert_call_count(sync_url, 1)
+            other_client.libby_session.close()
+
+            # but not by a different identity
+            other_client = LibbyClient(
+                settings_folder=settings_folder,
+                identity_token="..",
+                logger=self.logger,
+                sync_cache_ttl=60,
+            )
+            other_client.sync()
+            responses.assert_call_count(sync_url, 2)
+            other_client.libby_session.close()
+
+            # mutating calls discard the cached state
+            client.return_loan(synced_state["loans"][0])
+            self.assertFalse(client.sync_cache_file.exists())
+            client.sync()
+            responses.assert_call_count(sync_url, 3)
+            client.sync(refresh=True)
+            responses.assert_call_count(sync_url, 4)
+            client.libby_session.close()
+
+    @responses.activate
+    def test_libby_prepare_loan_session(self):
+        loans = [
+            {"id": title_id, "cardId": "99999", "type": {"id": "ebook"}}
+            for title_id in ("123", "456")
+        ]
+        for loan in loans:
+            responses.get(
+                f'https://sentry-read.svc.overdrive.com/open/book/card/99999/title/{loan["id"]}',
+                json={
+                    "message": f'm{loan["id"]}',
+                    "urls": {
+                        "web": "http://localhost/mock",
+                        "openbook": f'http://localhost/mock/{loan["id"]}/openbook.json',
+                        "rosters": f'http://localhost/mock/{loan["id"]}/rosters.json',
+                    },
+                },
+            )
+            responses.head(
+                f'http://localhost/mock?m{loan["id"]}',
+                headers={"Set-Cookie": f'_sscl_d2={loan["id"]}; Path=/'},
+            )
+            responses.get(f'http://localhost/mock/{loan["id"]}/openbook.json', json={})
+            responses.get(f'http://localhost/mock/{loan["id"]}/rosters.json', json=[])
+
+        client = LibbyClient(logger=self.logger, identity_token=".")
+        # each session is created just before its loan is processed
+        for loan in loans:
+            session = client.new_session()
+            self.assertIsNone(session.cookies.get("_sscl_d2"))
+            client.process_ebook(loan, session=session)
+            # same cookie name and domain, but kept apart per loan
+            self.assertEqual(session.cookies.get("_sscl_d2"), loan["id"])
+            session.close()
+        head_calls = [c for c in responses.calls if c.request.method == "HEAD"]
+        self.assertEqual(len(head_calls), len(loans))
+        for head_call in head_calls:
+            self.assertNotIn("Cookie", head_call.request.headers)
+        self.assertIsNone(client.libby_session.cookies.get("_sscl_d2"))
+        client.libby_session.close()
+
+    @responses.activate
+    def test_libby_prepare_loan_saved_cookies(self):
+        loan = {"id": "123", "cardId": "99999", "type": {"id": "audiobook"}}
+        download_base = "https://dewey-123.listen.example.com/"
+        responses.get(
+            "https://sentry-read.svc.overdrive.com/open/audiobook/card/99999/title/123",
+            json={"message": "m123", "urls": {"web": download_base}},
+        )
+        head_url = f"{download_base}?m123"
+        responses.head(
+            head_url, headers={"Set-Cookie": "_sscl_d2=123; Path=/; Max-Age=3600"}
+        )
+        # another loan on the same host, with a session cookie
+        other_loan = {"id": "456", "cardId": "99999", "type": {"id": "audiobook"}}
+        other_download_base = "https://dewey-123.listen.example.com/456/"
+        responses.get(
+            "https://sentry-read.svc.overdrive.com/open/audiobook/card/99999/title/456",
+            json={"message": "m456", "urls": {"web": other_download_base}},
+        )
+        other_head_url = f"{other_download_base}?m456"
+        responses.head(other_head_url, headers={"Set-Cookie": "_sscl_d2=456; Path=/"})
+        with tempfile.TemporaryDirectory() as settings_folder:
+            client = LibbyClient(
+                settings_folder=settings_folder, identity_token=".", logger=self.logger
+            )
+            client.prepare_loan(loan)
+            responses.assert_call_count(head_url, 1)
+            self.assertTrue(client.cookies_file.exists())
+            client.libby_session.close()
+
+            # handshake is skipped while the saved cookie is valid
+            client = LibbyClient(
+                settings_folder=settings_folder, identity_token=".", logger=self.logger
+            )
+            session = client.new_session()
+            client.prepare_loan(loan, session=session)
+            responses.assert_call_count(head_url, 1)
+            self.assertEqual(session.cookies.get("_sscl_d2"), "123")
+            session.close()
+
+            # another loan does not get the saved cookie, and its session
+            # cookie is not carried over to later sessions
+            for _ in range(2):
+                session = client.new_session()
+                client.prepare_loan(other_loan, session=session)
+                self.assertEqual(session.cookies.get("_sscl_d2"), "456")
+                session.close()
+            responses.assert_call_count(other_head_url, 2)
+            for call in responses.calls:
+                if call.request.url == other_head_url:
+                    self.assertNotIn("Cookie", call.request.headers)
+
+            client.clear_settings()
+            self.assertFalse(client.cookies_file.exists())
+            session = client.new_session()
+            client.prepare_loan(loan, session=session)
+            responses.assert_call_count(head_url, 2)
+            session.close()
+            client.libby_session.close()
+
+    @responses.activate
+    def test_libby_prepare_loan_saved_cookies_rejected(self):
+        loan = {"id": "123", "cardId": "99999", "type": {"id": "audiobook"}}
+        download_base = "https://dewey-123.listen.example.com/"
+        responses.get(
+            "https://sentry-read.svc.overdrive.com/open/audiobook/card/99999/title/123",
+            json={"message": "m123", "urls": {"web": download_base}},
+        )
+        head_url = f"{download_base}?m123"
+        responses.head(
+            head_url, headers={"Set-Cookie": "_sscl_d2=old; Path=/; Max-Age=3600"}
+        )
+        part_url = f"{download_base}part1.mp3"
+        with tempfile.TemporaryDirectory() as settings_folder:
+            client = LibbyClient(
+                settings_folder=settings_folder, identity_token=".", logger=self.logger
+            )
+            client.prepare_loan(loan)
+            responses.assert_call_count(head_url, 1)
+            client.libby_session.close()
+
+            # the loan was returned and borrowed again, so the saved cookie
+            # is rejected and the handshake is done again
+            responses.replace(
+                responses.HEAD,
+                head_url,
+                headers={"Set-Cookie": "_sscl_d2=new; Path=/; Max-Age=3600"},
+            )
+            responses.get(
+                part_url,
+                status=403,
+                match=[matchers.header_matcher({"Cookie": "_sscl_d2=old"})],
+            )
+            responses.get(
+                part_url,
+                body=b"mp3",
+                match=[matchers.header_matcher({"Cookie": "_sscl_d2=new"})],
+            )
+            client = LibbyClient(
+                settings_folder=settings_folder, identity_token=".", logger=self.logger
+            )
+            session = client.new_session()
+            client.prepare_loan(loan, session=session)
+            responses.assert_call_count(head_url, 1)
+            res = session.get(part_url, timeout=10)
+            res.raise_for_status()
+            self.assertEqual(res.content, b"mp3")
+            responses.assert_call_count(head_url, 2)
+            self.assertEqual(session.cookies.get("_sscl_d2"), "new")
+            with client.cookies_file.open("r", encoding="utf-8") as f:
+                saved_cookies = json.load(f)
+            self.assertEqual(saved_cookies[download_base][0]["value"], "new")
+
+            # the renewed cookie is not rejected again
+            res = session.get(part_url, timeout=10)
+            self.assertEqual(res.content, b"mp3")
+            responses.assert_call_count(head_url, 2)
+            session.close()
+            client.libby_session.close()
+
+    @responses.activate
+    def test_libby_fulfill_loan_file_to(self):
+        fulfill_url = "https://sentry-read.svc.overdrive.com/card/99999/loan/123/fulfill/audiobook-mp3"
+        contents = b"<OverDriveMedia>" + b"x" * 200_000 + b"</OverDriveMedia>"
+        responses.get(
+            fulfill_url,
+            body=contents[1000:],
+            status=206,
+            match=[matchers.header_matcher({"Range": "bytes=1000-"})],
+        )
+        responses.get(
+            fulfill_url,
+            body=contents,
+            headers={"Content-Length": str(len(contents))},
+        )
+        client = LibbyClient(logger=self.logger, identity_token=".")
+        with tempfile.TemporaryDirectory() as download_folder:
+            file_path = Path(download_folder, "book.odm")
+            progress = []
+            client.fulfill_loan_file_to(
+                "123",
+                "99999",
+                "audiobook-mp3",
+                file_path,
+                progress=lambda written, total: progress.append((written, total)),
+            )
+            self.assertEqual(file_path.read_bytes(), contents)
+            self.assertEqual(progress[-1], (len(contents), len(contents)))
+            self.assertFalse(Path(download_folder, "book.odm.part").exists())
+
+            # resume an interrupted download
+            file_path.unlink()
+            Path(download_folder, "book.odm.part").write_bytes(contents[:1000])
+            client.fulfill_loan_file_to("123", "99999", "audiobook-mp3", file_path)
+            self.assertEqual(file_path.read_bytes(), contents)
+            self.assertEqual(
+                responses.calls[-1].request.headers.get("Range"), "bytes=1000-"
+            )
+        client.libby_session.close()
+
     @responses.activate
     def test_libby_borrow_hold(self):
         hold = {"id": "123456", "type": {"id": "ebook"}, "cardId": "99999"}
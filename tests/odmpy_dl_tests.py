@@ -165,6 +165,57 @@ class OdmpyDlTests(BaseTestCase):
                             markers[test_odm_file][j + i - 1],
                         )
 
+    @responses.activate
+    def test_add_chapters_parallel(self):
+        """
+        `odmpy dl test.odm --chapters --parallel 3 --streamremux`
+        """
+        for test_odm_file in self.test_odms:
+            # clear remnant downloads
+            if self.test_downloads_dir.exists():
+                shutil.rmtree(self.test_downloads_dir, ignore_errors=True)
+
+            with self.subTest(odm=test_odm_file):
+                expected_result = get_expected_result(
+                    self.test_downloads_dir, test_odm_file
+                )
+                self._setup_common_responses()
+
+                run(
+                    [
+                        "--noversioncheck",
+                        "dl",
+                        str(self.test_data_dir.joinpath(test_odm_file)),
+                        "--downloaddir",
+                        str(self.test_downloads_dir),
+                        "--chapters",
+                        "--parallel",
+                        "3",
+                        "--streamremux",
+                        "--hideprogress",
+                    ],
+                    be_quiet=True,
+                )
+                # chapter ids and titles must follow part order
+                # regardless of which part finished downloading first
+                track_count = 0
+                for i in range(1, expected_result.total_parts + 1):
+                    book_file = expected_result.book_folder.joinpath(
+                        expected_result.mp3_name_format.format(i)
+                    )
+                    audio_file = MP3(book_file)
+                    self.assertEqual(audio_file.tags["TRCK"], str(i))
+                    for chap_id in audio_file.tags["CTOC:toc"].child_element_ids:
+                        self.assertEqual(chap_id, f"ch{track_count + 1:02d}")
+                        self.assertEqual(
+                            audio_file.tags[f"CHAP:{chap_id}"]
+                            .sub_frames["TIT2"]
+                            .text[0],
+                            markers[test_odm_file][track_count],
+                        )
+                        track_count += 1
+                self.assertEqual(track_count, expected_result.total_chapters)
+
     @responses.activate
     def test_merge_formats(self):
         """
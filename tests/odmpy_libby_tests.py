@@ -1,7 +1,11 @@
+import argparse
 import json
 import os.path
+import subprocess
+import threading
 import time
 import unittest
+from collections import OrderedDict
 from datetime import datetime
 from http import HTTPStatus
 from typing import Dict
@@ -14,11 +18,13 @@ from ebooklib import epub
 from lxml import etree  # type: ignore[import]
 from mutagen.id3 import ID3
 from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
 from responses import matchers
 
 from odmpy.errors import LibbyNotConfiguredError, OdmpyRuntimeError
 from odmpy.libby import LibbyClient, LibbyFormats
-from odmpy.odm import run
+from odmpy import odm
+from odmpy.odm import PreparedLoan, run
 from .base import BaseTestCase
 
 
@@ -517,9 +523,10 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.test_data_dir.joinpath("ebook", "media.json").open(
             "r", encoding="utf-8"
         ) as m:
+            # media is prefetched in bulk
             responses.get(
-                "https://thunder.api.overdrive.com/v2/media/9999999?x-client-id=dewey",
-                json=json.load(m),
+                "https://thunder.api.overdrive.com/v2/media/bulk?x-client-id=dewey&titleIds=9999999",
+                json=[json.load(m)],
             )
         with self.test_data_dir.joinpath("ebook", "cover.jpg").open("rb") as c:
             # this is the cover from OD API
@@ -645,7 +652,8 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.test_data_dir.joinpath("ebook", "dummy.epub").open("rb") as a:
             opener_open = MagicMock()
             opener_open.getcode.return_value = 200
-            opener_open.read.return_value = a.read()
+            opener_open.headers = {}
+            opener_open.read.side_effect = [a.read(), b""]
             mock_opener.return_value = opener_open
 
             test_folder = "test"
@@ -900,6 +908,103 @@ class OdmpyLibbyTests(BaseTestCase):
         for f in ("loan.json", "openbook.json", "debug.json"):
             self.assertTrue(self.test_downloads_dir.joinpath(test_folder, f).exists())
 
+    def test_download_loans_prepare_ahead(self):
+        selected_loans = [
+            {"id": str(i), "cardId": "1", "title": f"Loan {i}"} for i in range(6)
+        ]
+        prepared: Dict[str, PreparedLoan] = {}
+        prepared_lock = threading.Lock()
+        next_loan_prepared = threading.Event()
+
+        def prepare_loan(_, selected_loan, __):
+            with prepared_lock:
+                prepared_loan = PreparedLoan(MagicMock(), {}, OrderedDict(), [])
+                prepared[selected_loan["id"]] = prepared_loan
+                if selected_loan["id"] == "1":
+                    next_loan_prepared.set()
+            return prepared_loan
+
+        def process_audiobook_loan(selected_loan, *_, **__):
+            if selected_loan["id"] == "0":
+                # the next loan is prepared while this one is downloading
+                self.assertTrue(next_loan_prepared.wait(timeout=5))
+            if selected_loan["id"] == "1":
+                raise OdmpyRuntimeError("failed")
+
+        libby_client = MagicMock()
+        libby_client.is_downloadable_audiobook_loan.return_value = True
+        args = argparse.Namespace(network_jobs=None, cpu_jobs=None)
+        with patch.object(odm, "prefetch_media", return_value={}), patch.object(
+            odm, "prepare_loan", side_effect=prepare_loan
+        ), patch.object(
+            odm, "process_audiobook_loan", side_effect=process_audiobook_loan
+        ), patch.object(
+            odm, "extract_bundled_contents"
+        ):
+            with self.assertRaises(OdmpyRuntimeError):
+                odm.download_loans(libby_client, MagicMock(), selected_loans, [], args)
+        # only a few loans are prepared ahead of the failed loan, the rest
+        # are cancelled
+        self.assertLessEqual({"0", "1"}, set(prepared.keys()))
+        self.assertLessEqual(set(prepared.keys()), {"0", "1", "2", "3"})
+        # including the loans that were prepared but never downloaded
+        for prepared_loan in prepared.values():
+            prepared_loan.session.close.assert_called_once()
+
+    @responses.activate
+    def test_mock_libby_download_audiobook_direct_parallel(self):
+        settings_folder = self._generate_fake_settings()
+        self._setup_audiobook_direct_responses()
+        test_folder = "test"
+
+        run_command = [
+            "libby",
+            "--settings",
+            str(settings_folder),
+            "--downloaddir",
+            str(self.test_downloads_dir),
+            "--bookfolderformat",
+            test_folder,
+            "--bookfileformat",
+            "ebook",
+            "--direct",
+            "--select",
+            "1",
+            "--chapters",
+            "--overwritetags",
+            "--parallel",
+            "2",
+            "--hideprogress",
+        ]
+        if self.is_verbose:
+            run_command.insert(0, "--verbose")
+        run(run_command, be_quiet=not self.is_verbose)
+        part_files = sorted(
+            self.test_downloads_dir.joinpath(test_folder).glob("*part-*.mp3")
+        )
+        self.assertTrue(part_files)
+
+        with self.test_data_dir.joinpath("audiobook", "sync.json").open(
+            "r", encoding="utf-8"
+        ) as f:
+            loan = json.load(f)["loans"][0]
+
+        with self.test_data_dir.joinpath("audiobook", "openbook.json").open(
+            "r", encoding="utf-8"
+        ) as o:
+            openbook = json.load(o)
+            markers = [toc["title"] for toc in openbook["nav"]["toc"]]
+
+        for part_file in part_files:
+            audio_file = MP3(part_file, ID3=ID3)
+            self.assertEqual(audio_file.tags["TIT2"].text[0], loan["title"])
+            self.assertEqual(audio_file.tags["TPE1"].text[0], loan["firstCreatorName"])
+            self.assertTrue(audio_file.tags["CTOC:toc"])
+            for i, chap_id in enumerate(audio_file.tags["CTOC:toc"].child_element_ids):
+                self.assertEqual(chap_id, f"ch{i:02d}")
+                chapter = audio_file.tags[f"CHAP:{chap_id}"]
+                self.assertEqual(chapter.sub_frames["TIT2"].text[0], markers[i])
+
     @responses.activate
     def test_mock_libby_download_audiobook_direct_merge(self):
         settings_folder = self._generate_fake_settings()
@@ -976,6 +1081,61 @@ class OdmpyLibbyTests(BaseTestCase):
             if i > 0:
                 self.assertGreater(chapter.start_time, chapters[i - 1].start_time)
 
+    @responses.activate
+    def test_mock_libby_download_audiobook_direct_merge_jobs(self):
+        settings_folder = self._generate_fake_settings()
+        self._setup_audiobook_direct_responses()
+        test_folder = "test"
+
+        run_command = [
+            "libby",
+            "--settings",
+            str(settings_folder),
+            "--downloaddir",
+            str(self.test_downloads_dir),
+            "--bookfolderformat",
+            test_folder,
+            "--bookfileformat",
+            "ebook",
+            "--direct",
+            "--select",
+            "1",
+            "--merge",
+            "--chapters",
+            "--overwritetags",
+            "--netjobs",
+            "2",
+            "--cpujobs",
+            "2",
+            "--hideprogress",
+        ]
+        if self.is_verbose:
+            run_command.insert(0, "--verbose")
+        run(run_command, be_quiet=not self.is_verbose)
+        mp3_filepath = self.test_downloads_dir.joinpath(test_folder, "ebook.mp3")
+        self.assertTrue(mp3_filepath.exists())
+        self.assertFalse(
+            list(self.test_downloads_dir.joinpath(test_folder).glob("*part-*.mp3"))
+        )
+
+        with self.test_data_dir.joinpath("audiobook", "sync.json").open(
+            "r", encoding="utf-8"
+        ) as f:
+            loan = json.load(f)["loans"][0]
+
+        with self.test_data_dir.joinpath("audiobook", "openbook.json").open(
+            "r", encoding="utf-8"
+        ) as o:
+            openbook = json.load(o)
+            markers = [toc["title"] for toc in openbook["nav"]["toc"]]
+
+        audio_file = MP3(mp3_filepath, ID3=ID3)
+        self.assertEqual(audio_file.tags["TIT2"].text[0], loan["title"])
+        self.assertTrue(audio_file.tags["CTOC:toc"])
+        for i, chap_id in enumerate(audio_file.tags["CTOC:toc"].child_element_ids):
+            chapter = audio_file.tags[f"CHAP:{chap_id}"]
+            self.assertEqual(chapter.sub_frames["TIT2"].text[0], markers[i])
+
     @responses.activate
     def test_mock_libby_download_audiobook_direct_merge_m4b(self):
         settings_folder = self._generate_fake_settings()
@@ -1014,6 +1174,81 @@ class OdmpyLibbyTests(BaseTestCase):
             self.test_downloads_dir.joinpath(test_folder, "ebook.opf").exists()
         )
 
+    @responses.activate
+    def test_mock_libby_download_audiobook_direct_merge_m4b_single_pass(self):
+        settings_folder = self._generate_fake_settings()
+        self._setup_audiobook_direct_responses()
+
+        test_folder = "test"
+
+        run_command = [
+            "libby",
+            "--settings",
+            str(settings_folder),
+            "--downloaddir",
+            str(self.test_downloads_dir),
+            "--bookfolderformat",
+            test_folder,
+            "--bookfileformat",
+            "ebook",
+            "--direct",
+            "--select",
+            "1",
+            "--merge",
+            "--mergeformat",
+            "m4b",
+            "--directm4b",
+            "--chapters",
+            "--hideprogress",
+        ]
+        if self.is_verbose:
+            run_command.insert(0, "--verbose")
+        run(run_command, be_quiet=not self.is_verbose)
+        m4b_filepath = self.test_downloads_dir.joinpath(test_folder, "ebook.m4b")
+        self.assertTrue(m4b_filepath.exists())
+        # no intermediate merged mp3
+        self.assertFalse(
+            self.test_downloads_dir.joinpath(test_folder, "ebook.mp3").exists()
+        )
+
+        with self.test_data_dir.joinpath("audiobook", "sync.json").open(
+            "r", encoding="utf-8"
+        ) as f:
+            loan = json.load(f)["loans"][0]
+        with self.test_data_dir.joinpath("audiobook", "openbook.json").open(
+            "r", encoding="utf-8"
+        ) as o:
+            openbook = json.load(o)
+            markers = [toc["title"] for toc in openbook["nav"]["toc"]]
+
+        audio_file = MP4(m4b_filepath)
+        self.assertEqual(audio_file.tags["\xa9nam"][0], loan["title"])
+        self.assertEqual(audio_file.tags["\xa9alb"][0], loan["title"])
+        self.assertEqual(audio_file.tags["\xa9ART"][0], loan["firstCreatorName"])
+        self.assertEqual(audio_file.tags["\xa9grp"][0], loan["series"])
+        self.assertEqual(
+            [c.title for c in audio_file.chapters],  # type: ignore[union-attr]
+            markers,
+        )
+        ffprobe_cmd = [
+            "ffprobe",
+            "-v",
+            "quiet",
+            "-print_format",
+            "json",
+            "-show_format",
+            str(m4b_filepath),
+        ]
+        cmd_result = subprocess.run(
+            ffprobe_cmd,
+            capture_output=True,
+            text=True,
+            check=True,
+            encoding="utf-8",
+        )
+        meta = json.loads(str(cmd_result.stdout))
+        self.assertEqual(meta["format"]["tags"]["grouping"], loan["series"])
+
     @responses.activate
     def test_mock_libby_exportloans(self):
         """
@@ -1,8 +1,33 @@
 import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
 from functools import cmp_to_key
 
+import eyed3  # type: ignore[import]
+import requests
+import responses
+from bs4 import BeautifulSoup
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
+from urllib3.exceptions import ProtocolError
+
+from odmpy import retries, utils
 from odmpy.processing import shared
-from odmpy.processing.ebook import _sort_title_contents
+from odmpy.processing.ebook import (
+    PageFacts,
+    _cleanup_soup,
+    _decode_content_page,
+    _iter_roster_downloads,
+    _sort_title_contents,
+)
+from odmpy.processing.epub import EpubBuilder
 from tests.base import BaseTestCase
 
 
@@ -141,3 +166,911 @@ class ProcessingSharedTests(BaseTestCase):
                 {"url": "http://localhost/assets/4.css"},
             ],
         )
+
+    def test_iter_roster_downloads(self):
+        entries = [{"url": f"http://localhost/pages/{i:02d}.xhtml"} for i in range(20)]
+        lock = threading.Lock()
+        active = [0]
+        max_active = [0]
+        fetched = []
+
+        def fetch(url: str) -> str:
+            with lock:
+                fetched.append(url)
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            # later entries finish first
+            time.sleep((6 - int(url[-7]) % 6) * 0.01)
+            with lock:
+                active[0] -= 1
+            return url
+
+        results = []
+        for i, (entry, download) in enumerate(
+            _iter_roster_downloads(
+                entries,
+                fetch=fetch,  # type: ignore[arg-type]
+                needs_download=lambda e: not e["url"].endswith("03.xhtml"),
+                max_workers=3,
+            )
+        ):
+            # only a bounded window of downloads is queued ahead
+            with lock:
+                self.assertLessEqual(len(fetched), i + 1 + 2 * 3)
+            results.append((entry["url"], download.result() if download else None))
+        # yielded in the given order, skipped entries have no download
+        self.assertEqual([url for url, _ in results], [e["url"] for e in entries])
+        self.assertEqual(
+            [res for _, res in results],
+            [e["url"] if i != 3 else None for i, e in enumerate(entries)],
+        )
+        self.assertGreater(max_active[0], 1)
+        self.assertLessEqual(max_active[0], 3)
+
+    def test_epub_builder(self):
+        epub_file_path = self.test_downloads_dir.joinpath("book.epub")
+
+        # an interrupted build keeps the files written so far for resuming
+        with self.assertRaises(ValueError):
+            with EpubBuilder(epub_file_path, self.test_downloads_dir) as epub_builder:
+                epub_builder.write("OEBPS/pages/1.xhtml", "<html></html>")
+                epub_builder.write("OEBPS/assets/1.jpg", b"\xff\xd8")
+                self.assertTrue(epub_builder.has("OEBPS/assets/1.jpg"))
+                raise ValueError("interrupted")
+        self.assertFalse(epub_file_path.exists())
+        self.assertFalse(epub_builder.tmp_file_path.exists())
+        staged_file = self.test_downloads_dir.joinpath("OEBPS", "assets", "1.jpg")
+        self.assertEqual(staged_file.read_bytes(), b"\xff\xd8")
+
+        with EpubBuilder(epub_file_path, self.test_downloads_dir) as epub_builder:
+            epub_builder.write_file("OEBPS/assets/1.jpg", staged_file)
+            epub_builder.write("OEBPS/pages/1.xhtml", "<html></html>")
+            epub_builder.write("OEBPS/pages/1.xhtml", "duplicate")
+        with zipfile.ZipFile(epub_file_path) as epub_zip:
+            infos = epub_zip.infolist()
+            self.assertEqual(infos[0].filename, "mimetype")
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(epub_zip.read("mimetype"), b"application/epub+zip")
+            self.assertEqual(
+                [i.filename for i in infos[1:]],
+                ["OEBPS/assets/1.jpg", "OEBPS/pages/1.xhtml"],
+            )
+            self.assertEqual(epub_zip.read("OEBPS/pages/1.xhtml"), b"<html></html>")
+            # images are not compressed again
+            self.assertEqual(infos[1].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos[2].compress_type, zipfile.ZIP_DEFLATED)
+
+        # files are added in order and the archive is valid
+        contents = {
+            f"OEBPS/pages/{i}.xhtml": f"<p>{i}</p>".encode("utf-8") * (i * 500 + 1)
+            for i in range(20)
+        }
+        contents["OEBPS/assets/cover.jpg"] = bytes(range(256)) * 10
+        contents["OEBPS/pages/café.xhtml"] = "<p>café</p>".encode("utf-8")
+        for deflate_workers in (1, 4):
+            with self.subTest(deflate_workers=deflate_workers), self.assertLogs(
+                self.logger, level="INFO"
+            ) as logs:
+                with EpubBuilder(
+                    epub_file_path,
+                    self.test_downloads_dir,
+                    self.logger,
+                    deflate_workers=deflate_workers,
+                ) as epub_builder:
+                    for name, data in contents.items():
+                        epub_builder.write(name, data)
+                self.assertEqual(epub_builder.deflated_count, 21)
+                self.assertEqual(epub_builder.stored_count, 1)
+                self.assertGreater(epub_builder.packaging_time, 0)
+                # the packaging time is reported
+                self.assertIn('Packaged "book.epub"', logs.output[-1])
+                with zipfile.ZipFile(epub_file_path) as epub_zip:
+                    self.assertIsNone(epub_zip.testzip())
+                    self.assertEqual(epub_zip.namelist()[1:], list(contents.keys()))
+                    for name, data in contents.items():
+                        self.assertEqual(epub_zip.read(name), data)
+                        self.assertEqual(
+                            epub_zip.getinfo(name).compress_type,
+                            zipfile.ZIP_STORED
+                            if name.endswith(".jpg")
+                            else zipfile.ZIP_DEFLATED,
+                        )
+
+    def test_decode_content_page(self):
+        from tests.benchmarks import (
+            cleanup_soup_multi_pass,
+            decode_content_page_double_parse,
+            load_pages,
+        )
+
+        pages = load_pages()
+        # pages served with an xml declaration
+        pages += [f'<?xml version="1.0" encoding="utf-8"?>\n{p}' for p in pages]
+        for page_text in pages:
+            for parser in ("html.parser", "lxml"):
+                with self.subTest(parser=parser):
+                    expected = decode_content_page_double_parse(page_text)
+                    soup, is_decoded = _decode_content_page(page_text, parser=parser)
+                    self.assertTrue(is_decoded)
+                    self.assertFalse(soup.find("script"))
+                    self.assertEqual(str(soup), str(expected))
+                    # and the same page once cleaned up
+                    for version in ("2.0", "3.0"):
+                        expected = decode_content_page_double_parse(page_text)
+                        expected_facts = cleanup_soup_multi_pass(expected, version)
+                        soup, _ = _decode_content_page(page_text, parser=parser)
+                        facts = _cleanup_soup(soup, version)
+                        self.assertEqual(str(soup), str(expected))
+                        self.assertEqual(facts, expected_facts)
+
+        page_text = "<html><body><p>plain</p></body></html>"
+        soup, is_decoded = _decode_content_page(page_text)
+        self.assertFalse(is_decoded)
+        self.assertEqual(soup.find("p").text, "plain")  # type: ignore[union-attr]
+        page_text = (
+            '<html><body><script type="text/javascript">'
+            "parent.__bif_cfc0(self,'not base64!')</script></body></html>"
+        )
+        soup, is_decoded = _decode_content_page(page_text)
+        self.assertFalse(is_decoded)
+        self.assertTrue(soup.find("script"))
+
+    def test_cleanup_soup(self):
+        from tests.benchmarks import cleanup_soup_multi_pass, load_pages
+
+        page_text = """<!DOCTYPE html>
+<html lang="en"><head><base href="http://localhost/"/><title>T</title></head>
+<body role="main">
+<nav epub:type="toc" aria-label="Contents"><ol><li>1</li></ol></nav>
+<section data-loc="1"><figure><img alt="" src="../assets/1.jpg"/>
+<figcaption>Caption</figcaption></figure><img src="../assets/2.jpg"/></section>
+<svg viewBox="0 0 10 10"><image xlink:href="../assets/3.jpg"/></svg>
+</body></html>"""
+        for page in load_pages() + [page_text]:
+            for version in ("2.0", "3.0"):
+                with self.subTest(version=version):
+                    expected_soup = BeautifulSoup(page, features="lxml")
+                    expected_facts = cleanup_soup_multi_pass(expected_soup, version)
+                    soup = BeautifulSoup(page, features="lxml")
+                    facts = _cleanup_soup(soup, version)
+                    self.assertEqual(str(soup), str(expected_soup))
+                    self.assertEqual(facts, expected_facts)
+
+        soup = BeautifulSoup(page_text, features="lxml")
+        facts = _cleanup_soup(soup, "3.0")
+        self.assertEqual(
+            facts,
+            PageFacts(has_svg=True, is_nav=True, first_img_src="../assets/1.jpg"),
+        )
+        self.assertFalse(soup.find("base"))
+        self.assertFalse(soup.find("figcaption"))
+        self.assertEqual(soup.find("svg")["xmlns"], "http://www.w3.org/2000/svg")  # type: ignore[index]
+        soup = BeautifulSoup(page_text, features="lxml")
+        # epub:type is removed for epub 2
+        self.assertFalse(_cleanup_soup(soup, "2.0").is_nav)
+        self.assertFalse(soup.find("nav") or soup.find("section"))
+        self.assertFalse(soup.find(attrs={"lang": True}))
+
+    def test_run_ordered(self):
+        def delayed_square(n: int) -> int:
+            # later items finish first
+            time.sleep((5 - n) * 0.01)
+            return n * n
+
+        self.assertEqual(
+            shared.run_ordered(delayed_square, range(5), max_workers=3),
+            [0, 1, 4, 9, 16],
+        )
+
+        def fail_on_two(n: int) -> int:
+            if n == 2:
+                raise ValueError(n)
+            return n
+
+        with self.assertRaises(ValueError):
+            shared.run_ordered(fail_on_two, range(5), max_workers=2)
+
+    def test_run_pipeline(self):
+        stage_log = []
+
+        def download(n: int) -> int:
+            # later items finish first
+            time.sleep((5 - n) * 0.02)
+            stage_log.append(("download", n))
+            return n
+
+        def remux(n: int) -> int:
+            stage_log.append(("remux", n))
+            return n * 10
+
+        def tag(n: int) -> str:
+            return f"part{n}"
+
+        self.assertEqual(
+            shared.run_pipeline(
+                range(5),
+                [
+                    shared.PipelineStage(download, workers=2),
+                    shared.PipelineStage(remux, workers=2),
+                    shared.PipelineStage(tag),
+                ],
+            ),
+            ["part0", "part10", "part20", "part30", "part40"],
+        )
+        # remuxing starts before all downloads are done
+        self.assertLess(stage_log.index(("remux", 0)), stage_log.index(("download", 4)))
+
+        def fail_on_three(n: int) -> int:
+            if n == 3:
+                raise ValueError(n)
+            return n
+
+        with self.assertRaises(ValueError):
+            shared.run_pipeline(
+                range(5),
+                [shared.PipelineStage(download), shared.PipelineStage(fail_on_three)],
+            )
+
+        # items already past the failed stage are still finished
+        stage_log.clear()
+        with self.assertRaises(ValueError):
+            shared.run_pipeline(
+                range(5),
+                [shared.PipelineStage(fail_on_three), shared.PipelineStage(remux)],
+            )
+        self.assertEqual(stage_log, [("remux", 0), ("remux", 1), ("remux", 2)])
+
+        # a stage's slot is released once the stage is done
+        slot_log = []
+
+        @contextmanager
+        def slot():
+            slot_log.append("acquired")
+            yield
+            slot_log.append("released")
+
+        def slow_remux(n: int) -> int:
+            time.sleep(0.02)
+            slot_log.append(f"remux {n}")
+            return n
+
+        shared.run_pipeline(
+            range(5),
+            [
+                shared.PipelineStage(lambda n: n, slot=slot),
+                shared.PipelineStage(slow_remux),
+            ],
+        )
+        self.assertEqual(slot_log[0], "acquired")
+        self.assertLess(slot_log.index("released"), slot_log.index("remux 4"))
+
+    @staticmethod
+    def _range_callback(body: bytes, requested_ranges: list):
+        def callback(request):
+            mobj = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+            if not mobj:
+                return 200, {}, body
+            start = int(mobj.group(1))
+            end = int(mobj.group(2)) if mobj.group(2) else len(body) - 1
+            requested_ranges.append((start, end))
+            return (
+                206,
+                {"Content-Range": f"bytes {start}-{end}/{len(body)}"},
+                body[start : end + 1],
+            )
+
+        return callback
+
+    @responses.activate
+    def test_download_part_segments(self):
+        body = bytes(range(256)) * 1000
+        url = "http://localhost/segmented.mp3"
+        requested_ranges: list = []
+        responses.add_callback(
+            responses.GET, url, callback=self._range_callback(body, requested_ranges)
+        )
+        part_tmp_filename = self.test_downloads_dir.joinpath("segmented.part")
+        shared.download_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            segments=4,
+            segment_min_size=1,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        self.assertEqual(len(requested_ranges), 4)
+        self.assertFalse(part_tmp_filename.with_suffix(".segments").exists())
+
+        # resume an interrupted download: only the unfinished ranges are fetched
+        half = len(body) // 2
+        with part_tmp_filename.open("wb") as f:
+            f.write(body[:half])
+            f.truncate(len(body))
+        with part_tmp_filename.with_suffix(".segments").open(
+            "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {
+                    "size": len(body),
+                    "segments": [
+                        {"start": 0, "end": half - 1, "done": half},
+                        {"start": half, "end": len(body) - 1, "done": 10},
+                    ],
+                },
+                f,
+            )
+        requested_ranges.clear()
+        shared.download_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            segments=2,
+            segment_min_size=1,
+        )
+        # segment data before the resume point was already on disk
+        self.assertEqual(requested_ranges, [(half + 10, len(body) - 1)])
+        self.assertEqual(part_tmp_filename.read_bytes()[half + 10 :], body[half + 10 :])
+        self.assertEqual(len(part_tmp_filename.read_bytes()), len(body))
+
+    @responses.activate
+    def test_download_part_segments_unsupported(self):
+        body = b"0123456789" * 100
+        url = "http://localhost/unsegmented.mp3"
+        # server ignores Range
+        responses.get(url, body=body)
+        part_tmp_filename = self.test_downloads_dir.joinpath("unsegmented.part")
+        shared.download_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            segments=4,
+            segment_min_size=1,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        self.assertFalse(part_tmp_filename.with_suffix(".segments").exists())
+
+    @responses.activate
+    def test_download_part_segments_incomplete(self):
+        body = bytes(range(256)) * 100
+        url = "http://localhost/incomplete.mp3"
+        requested_ranges: list = []
+        range_callback = self._range_callback(body, requested_ranges)
+
+        def short_callback(request):
+            status, headers, content = range_callback(request)
+            return status, headers, content[:100]
+
+        responses.add_callback(responses.GET, url, callback=short_callback)
+        part_tmp_filename = self.test_downloads_dir.joinpath("incomplete.part")
+        download_args = dict(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            segments=2,
+            segment_min_size=1,
+        )
+        with self.assertRaises(requests.ConnectionError) as context:
+            shared.download_part(part_file_size=len(body), **download_args)  # type: ignore[arg-type]
+        self.assertTrue(retries.RetryPolicy.is_retryable(context.exception))
+
+        # the retry resumes each range, the ranges are requested concurrently
+        requested_ranges.clear()
+        responses.reset()
+        responses.add_callback(responses.GET, url, callback=range_callback)
+        shared.download_part(part_file_size=len(body), **download_args)  # type: ignore[arg-type]
+        self.assertEqual(
+            sorted(requested_ranges),
+            [(100, len(body) // 2 - 1), (len(body) // 2 + 100, len(body) - 1)],
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # unknown size: not split
+        part_tmp_filename.unlink()
+        requested_ranges.clear()
+        responses.replace(responses.GET, url, body=body)
+        shared.download_part(part_file_size=0, **download_args)  # type: ignore[arg-type]
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+        self.assertFalse(part_tmp_filename.with_suffix(".segments").exists())
+
+    @responses.activate
+    def test_download_part_retry_resume(self):
+        body = bytes(range(256)) * 10
+        url = "http://localhost/retried.mp3"
+        half = len(body) // 2
+        part_tmp_filename = self.test_downloads_dir.joinpath("retried.part")
+        # bytes written by an earlier, failed attempt
+        part_tmp_filename.write_bytes(body[:half])
+
+        requested_ranges: list = []
+        responses.get(url, status=503, headers={"Retry-After": "3"})
+        responses.add_callback(
+            responses.GET, url, callback=self._range_callback(body, requested_ranges)
+        )
+        delays: list = []
+        retry_policy = retries.RetryPolicy(
+            max_retries=2, circuit_breaker=retries.CircuitBreaker()
+        )
+        retry_policy.sleep = delays.append
+        retry_policy.call(
+            lambda: shared.download_part(
+                session=requests.Session(),
+                part_download_url=url,
+                headers={},
+                part_tmp_filename=part_tmp_filename,
+                part_file_size=len(body),
+                desc="Part 1",
+                timeout=10,
+                hide_progress=True,
+            ),
+            url,
+        )
+        self.assertEqual(len(delays), 1)
+        self.assertGreaterEqual(delays[0], 3)
+        self.assertEqual(requested_ranges, [(half, len(body) - 1)])
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # the connection drops mid-body: the retry resumes from the partial file
+        body = bytes(range(256)) * 800
+        part_tmp_filename.unlink()
+        requested_ranges.clear()
+        responses.reset()
+        responses.get(
+            url,
+            body=body[:100000],
+            headers={"Content-Length": str(len(body))},
+            auto_calculate_content_length=False,
+        )
+        responses.add_callback(
+            responses.GET, url, callback=self._range_callback(body, requested_ranges)
+        )
+        delays.clear()
+        retry_policy.call(
+            lambda: shared.download_part(
+                session=requests.Session(),
+                part_download_url=url,
+                headers={},
+                part_tmp_filename=part_tmp_filename,
+                part_file_size=len(body),
+                desc="Part 1",
+                timeout=10,
+                hide_progress=True,
+            ),
+            url,
+        )
+        self.assertEqual(len(delays), 1)
+        # only the bytes received before the drop are kept
+        self.assertEqual(len(requested_ranges), 1)
+        self.assertGreater(requested_ranges[0][0], 0)
+        self.assertLessEqual(requested_ranges[0][0], 100000)
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # a part completed in an earlier run is not requested again
+        responses.reset()
+        shared.download_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+        )
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+        # server ignores Range, the partial file is overwritten
+        part_tmp_filename.write_bytes(body[:half])
+        responses.get(url, body=body)
+        shared.download_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_tmp_filename=part_tmp_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), body)
+
+    def test_retry_policy(self):
+        breaker = retries.CircuitBreaker(failure_threshold=3, cooldown=60)
+        retry_policy = retries.RetryPolicy(
+            max_retries=5, backoff_factor=1, max_backoff=10, circuit_breaker=breaker
+        )
+        delays: list = []
+        retry_policy.sleep = delays.append
+
+        # jittered exponential backoff
+        for attempt in range(6):
+            delay = retry_policy.get_delay(attempt, requests.ConnectionError())
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10, 2**attempt))
+
+        # Retry-After, in seconds or as a date, capped at max_backoff
+        res = requests.Response()
+        res.status_code = 429
+        res.headers["Retry-After"] = "5"
+        err = requests.HTTPError(response=res)
+        self.assertTrue(retry_policy.is_retryable(err))
+        self.assertGreaterEqual(retry_policy.get_delay(0, err), 5)
+        self.assertLessEqual(retry_policy.get_delay(0, err), 6)
+        res.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertLessEqual(retry_policy.get_delay(0, err), 1)
+        res.headers["Retry-After"] = "3600"
+        self.assertEqual(retry_policy.get_delay(0, err), 10)
+        res.status_code = 404
+        self.assertFalse(retry_policy.is_retryable(err))
+        # raw urllib3 errors from a dropped connection
+        self.assertTrue(retry_policy.is_retryable(ProtocolError("Connection broken")))
+
+        # errors that are not retryable are raised immediately
+        calls: list = []
+
+        def not_found():
+            calls.append(1)
+            raise requests.HTTPError(response=res)
+
+        with self.assertRaises(requests.HTTPError):
+            retry_policy.call(not_found, "http://localhost/x")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(delays, [])
+
+        # repeated failures open the circuit for the host
+        def unavailable():
+            calls.append(1)
+            raise requests.ConnectionError("unavailable")
+
+        calls.clear()
+        delays.clear()
+        retry_policy.max_retries = 3
+        with self.assertRaises(retries.CircuitOpenError):
+            retry_policy.call(unavailable, "http://localhost/y")
+        # the 3rd failure trips the breaker, the 4th attempt is not made
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(delays), 3)
+        with self.assertRaises(retries.CircuitOpenError):
+            breaker.check("localhost")
+        # other hosts are not affected
+        breaker.check("example.com")
+        self.assertEqual(
+            retries.RetryPolicy(circuit_breaker=breaker).call(
+                lambda: "ok", "http://example.com/"
+            ),
+            "ok",
+        )
+        breaker.record_success("localhost")
+        breaker.check("localhost")
+
+    @responses.activate
+    def test_stream_remux_part(self):
+        with self.test_data_dir.joinpath("audiobook", "book.mp3").open("rb") as f:
+            mp3_body = f.read()
+        url = "http://localhost/book.mp3"
+        part_filename = self.test_downloads_dir.joinpath("book.mp3")
+        stream_remux_args = dict(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_filename=part_filename,
+            part_file_size=len(mp3_body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            ffmpeg_loglevel="fatal",
+            logger=self.logger,
+        )
+        # the connection drops mid-body, a truncated part is not kept
+        responses.get(
+            url,
+            body=mp3_body[: len(mp3_body) // 2],
+            headers={"Content-Length": str(len(mp3_body))},
+            auto_calculate_content_length=False,
+        )
+        with self.assertRaises(requests.ConnectionError):
+            shared.stream_remux_part(**stream_remux_args)  # type: ignore[arg-type]
+        self.assertFalse(part_filename.exists())
+        self.assertFalse(part_filename.with_suffix(".remux.mp3").exists())
+
+        responses.reset()
+        responses.get(url, body=mp3_body)
+        shared.stream_remux_part(**stream_remux_args)  # type: ignore[arg-type]
+        self.assertTrue(MP3(part_filename).info.length)
+        self.assertFalse(part_filename.with_suffix(".part").exists())
+        self.assertFalse(part_filename.with_suffix(".remux.mp3").exists())
+
+    @responses.activate
+    def test_stream_remux_part_ffmpeg_fail(self):
+        # not an mp3, so ffmpeg fails and the raw stream is kept
+        body = b"0123456789" * 100
+        url = "http://localhost/notmp3.mp3"
+        responses.get(url, body=body)
+        part_filename = self.test_downloads_dir.joinpath("notmp3.mp3")
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.ERROR)
+        shared.stream_remux_part(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_filename=part_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            ffmpeg_loglevel="quiet",
+            logger=logger,
+        )
+        self.assertEqual(part_filename.read_bytes(), body)
+        self.assertFalse(part_filename.with_suffix(".part").exists())
+
+    @responses.activate
+    def test_stream_remux_part_no_ffmpeg(self):
+        body = bytes(range(256)) * 800
+        url = "http://localhost/noffmpeg.mp3"
+        # the connection drops mid-body
+        responses.get(
+            url,
+            body=body[:100000],
+            headers={"Content-Length": str(len(body))},
+            auto_calculate_content_length=False,
+        )
+        part_filename = self.test_downloads_dir.joinpath("noffmpeg.mp3")
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.ERROR)
+        stream_remux_args = dict(
+            session=requests.Session(),
+            part_download_url=url,
+            headers={},
+            part_filename=part_filename,
+            part_file_size=len(body),
+            desc="Part 1",
+            timeout=10,
+            hide_progress=True,
+            ffmpeg_loglevel="quiet",
+            logger=logger,
+        )
+        path = os.environ.get("PATH", "")
+        os.environ["PATH"] = ""
+        try:
+            with self.assertRaises(requests.ConnectionError):
+                shared.stream_remux_part(**stream_remux_args)  # type: ignore[arg-type]
+            # the partial download is left to be resumed, not saved as the part
+            self.assertFalse(part_filename.exists())
+            self.assertTrue(part_filename.with_suffix(".part").exists())
+
+            part_filename.with_suffix(".part").unlink()
+            responses.replace(responses.GET, url, body=body)
+            shared.stream_remux_part(**stream_remux_args)  # type: ignore[arg-type]
+        finally:
+            os.environ["PATH"] = path
+        self.assertEqual(part_filename.read_bytes(), body)
+        self.assertFalse(part_filename.with_suffix(".part").exists())
+
+    def test_merge_into_mp3_native(self):
+        part_files = sorted(
+            self.test_data_dir.joinpath("audiobook", "odm", "book1").glob("*.mp3")
+        )
+        merged_files = {}
+        for merge_engine in ("native", "ffmpeg"):
+            with self.subTest(merge_engine=merge_engine):
+                merged_file = self.test_downloads_dir.joinpath(f"{merge_engine}.mp3")
+                shared.merge_into_mp3(
+                    book_filename=merged_file,
+                    file_tracks=[{"file": f} for f in part_files],
+                    audio_bitrate=64,
+                    ffmpeg_loglevel="fatal",
+                    hide_progress=True,
+                    logger=self.logger,
+                    merge_engine=merge_engine,
+                )
+                self.assertTrue(merged_file.exists())
+                self.assertFalse(merged_file.with_suffix(".part").exists())
+                merged_files[merge_engine] = merged_file
+
+        merged = merged_files["native"].read_bytes()
+        # part tags are stripped and the per-part Info frames are
+        # replaced by one for the whole file
+        self.assertFalse(merged.startswith(b"ID3"))
+        self.assertEqual(merged.count(b"Info"), 1)
+        parts_frames_count = 0
+        for part_file in part_files:
+            stream = utils.scan_mp3(part_file.read_bytes())
+            parts_frames_count += len(stream.frame_offsets) - 1
+        stream = utils.scan_mp3(merged)
+        self.assertEqual(len(stream.frame_offsets) - 1, parts_frames_count)
+        info_offset = merged.find(b"Info")
+        self.assertEqual(
+            int.from_bytes(merged[info_offset + 8 : info_offset + 12], "big"),
+            parts_frames_count,
+        )
+        self.assertEqual(
+            int.from_bytes(merged[info_offset + 12 : info_offset + 16], "big"),
+            len(merged),
+        )
+        # within a frame or so of the ffmpeg concat
+        self.assertAlmostEqual(
+            MP3(merged_files["native"]).info.length,
+            MP3(merged_files["ffmpeg"]).info.length,
+            delta=0.1,
+        )
+
+    def test_generate_ffmetadata(self):
+        ffmetadata = shared.generate_ffmetadata(
+            {"title": "A=B; #1\\2", "comment": "line 1\nline 2"},
+            [("Chapter 1", 0, 1500), ("Chapter = 2", 1500, 3000)],
+        )
+        self.assertEqual(
+            ffmetadata,
+            ";FFMETADATA1\n"
+            "title=A\\=B\\; \\#1\\\\2\n"
+            "comment=line 1\\\nline 2\n"
+            "[CHAPTER]\nTIMEBASE=1/1000\nSTART=0\nEND=1500\ntitle=Chapter 1\n"
+            "[CHAPTER]\nTIMEBASE=1/1000\nSTART=1500\nEND=3000\ntitle=Chapter \\= 2\n",
+        )
+
+    def test_plan_aac_segments(self):
+        sample_rate = 22050
+        total_samples = 10 * 60 * sample_rate
+        segments = shared.plan_aac_segments(total_samples, sample_rate, 4, [])
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(segments[0][0], 0)
+        self.assertEqual(segments[-1][1], total_samples)
+        for (_, end), (start, _) in zip(segments, segments[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(start % 1024, 0)
+
+        # split at a nearby chapter
+        chapter_start = total_samples // 2 + 5 * sample_rate
+        segments = shared.plan_aac_segments(
+            total_samples, sample_rate, 2, [chapter_start]
+        )
+        self.assertEqual(segments[1][0], chapter_start // 1024 * 1024)
+
+        # too short to be worth splitting
+        self.assertEqual(
+            shared.plan_aac_segments(30 * sample_rate, sample_rate, 4, []), []
+        )
+
+    def test_convert_to_m4b_jobs(self):
+        part_files = sorted(
+            self.test_data_dir.joinpath("audiobook", "odm", "book1").glob("*.mp3")
+        )
+        merged_file = self.test_downloads_dir.joinpath("merged.mp3")
+        shared.merge_into_mp3(
+            book_filename=merged_file,
+            file_tracks=[{"file": f} for f in part_files],
+            audio_bitrate=64,
+            ffmpeg_loglevel="fatal",
+            hide_progress=True,
+            logger=self.logger,
+            merge_engine="native",
+        )
+        audiofile = eyed3.load(merged_file)
+        audiofile.initTag()
+        audiofile.tag.title = "Merged"
+        toc = audiofile.tag.table_of_contents.set(
+            b"toc", toplevel=True, ordered=True, child_ids=[]
+        )
+        for i, times in enumerate([(0, 100000), (100000, 190000)]):
+            title_frameset = eyed3.id3.frames.FrameSet()
+            title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, f"Chapter {i}")
+            chap = audiofile.tag.chapters.set(
+                f"ch{i}".encode("ascii"), times=times, sub_frames=title_frameset
+            )
+            toc.child_ids.append(chap.element_id)
+        audiofile.tag.save()
+        m4b_files = {}
+        for jobs in (1, 3):
+            with self.subTest(jobs=jobs):
+                book_filename = self.test_downloads_dir.joinpath(f"jobs{jobs}.mp3")
+                shutil.copy(merged_file, book_filename)
+                m4b_file = book_filename.with_suffix(".m4b")
+                shared.convert_to_m4b(
+                    book_filename=book_filename,
+                    book_m4b_filename=m4b_file,
+                    cover_filename=self.test_downloads_dir.joinpath("cover.jpg"),
+                    merge_codec="aac",
+                    audio_bitrate=64,
+                    ffmpeg_loglevel="fatal",
+                    hide_progress=True,
+                    logger=self.logger,
+                    jobs=jobs,
+                )
+                self.assertTrue(m4b_file.exists())
+                m4b_files[jobs] = m4b_file
+
+        # segment files are cleaned up
+        self.assertEqual(
+            sorted(f.name for f in self.test_downloads_dir.iterdir()),
+            ["jobs1.m4b", "jobs3.m4b", "merged.mp3"],
+        )
+        for m4b_file in m4b_files.values():
+            audiofile = MP4(m4b_file)
+            self.assertEqual(audiofile.tags["\xa9nam"], ["Merged"])
+            self.assertEqual(
+                [c.title for c in audiofile.chapters],  # type: ignore[union-attr]
+                ["Chapter 0", "Chapter 1"],
+            )
+        # same length as the single pass encode, no gaps at the joins
+        self.assertAlmostEqual(
+            MP4(m4b_files[3]).info.length, MP4(m4b_files[1]).info.length, delta=0.01
+        )
+
+    def test_loan_scheduler(self):
+        scheduler = shared.LoanScheduler(network_jobs=1, cpu_jobs=1)
+        first_loan_converting = threading.Event()
+        second_loan_downloaded = threading.Event()
+        lock = threading.Lock()
+        active = {"network": 0, "cpu": 0}
+        max_active = {"network": 0, "cpu": 0}
+
+        def track(kind: str, delta: int) -> None:
+            with lock:
+                active[kind] += delta
+                max_active[kind] = max(max_active[kind], active[kind])
+
+        def process_loan(loan: int) -> int:
+            with scheduler.network():
+                track("network", 1)
+                if loan == 2:
+                    # only gets here while loan 1 is still converting
+                    self.assertTrue(first_loan_converting.wait(5))
+                    second_loan_downloaded.set()
+                time.sleep(0.01)
+                track("network", -1)
+            with scheduler.cpu():
+                track("cpu", 1)
+                if loan == 1:
+                    first_loan_converting.set()
+                    self.assertTrue(second_loan_downloaded.wait(5))
+                time.sleep(0.01)
+                track("cpu", -1)
+            return loan
+
+        self.assertEqual(scheduler.run(process_loan, [1, 2, 3, 4]), [1, 2, 3, 4])
+        self.assertEqual(max_active, {"network": 1, "cpu": 1})
+
+    def test_loan_scheduler_progress_positions(self):
+        # serial: bars are not positioned
+        progress_positions = shared.ProgressPositions(1)
+        with shared.LoanScheduler().network(progress_positions):
+            with progress_positions.acquire() as position:
+                self.assertIsNone(position)
+
+        # loans downloading at the same time each get their own range
+        scheduler = shared.LoanScheduler(network_jobs=2)
+        loans_downloading = threading.Barrier(2, timeout=5)
+        loan_positions: dict = {}
+
+        def download_loan(loan: int) -> int:
+            progress_positions = shared.ProgressPositions(2)
+            with scheduler.network(progress_positions):
+                loans_downloading.wait()
+                with progress_positions.acquire() as first:
+                    with progress_positions.acquire() as second:
+                        loan_positions[loan] = [first, second]
+                loans_downloading.wait()
+            return loan
+
+        scheduler.run(download_loan, [1, 2])
+        self.assertEqual(sorted(loan_positions.values()), [[0, 1], [2, 3]])
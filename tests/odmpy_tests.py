@@ -321,7 +321,7 @@ class OdmpyTests(BaseTestCase):
 
             finally:
                 # close this to prevent "ResourceWarning: unclosed socket" error
-                od.session.close()
+                od.close()
 
     @responses.activate
     def test_odm_return(self):
@@ -1,8 +1,12 @@
 import logging
+import tempfile
+from pathlib import Path
 
 import requests
+import responses
+from responses import matchers
 
-from odmpy.overdrive import OverDriveClient
+from odmpy.overdrive import OverDriveClient, ResponseCache
 from tests.base import BaseTestCase
 
 test_logger = logging.getLogger(__name__)
@@ -21,7 +25,7 @@ class OverDriveClientTests(BaseTestCase):
 
     def tearDown(self) -> None:
         super().tearDown()
-        self.client.session.close()
+        self.client.close()
 
     def test_media(self):
         item = self.client.media("284716")
@@ -180,3 +184,71 @@ class OverDriveClientTests(BaseTestCase):
         ):
             with self.subTest(key=k):
                 self.assertIn(k, media, msg=f'"{k}" not found')
+
+    @responses.activate
+    def test_response_cache(self):
+        media = {"id": "284716", "title": "Test"}
+        media_url = "https://thunder.api.overdrive.com/v2/media/284716"
+        bulk_url = "https://thunder.api.overdrive.com/v2/media/bulk"
+        responses.get(
+            media_url,
+            body="",
+            headers={"Cache-Control": "max-age=0", "ETag": '"v1"'},
+            match=[matchers.header_matcher({"If-None-Match": '"v1"'})],
+            status=304,
+        )
+        responses.get(
+            media_url,
+            json=media,
+            headers={"Cache-Control": "max-age=0", "ETag": '"v1"'},
+        )
+        responses.get(
+            bulk_url, json=[media], headers={"Cache-Control": "public, max-age=600"}
+        )
+        with tempfile.TemporaryDirectory() as cache_folder:
+            cache_file = Path(cache_folder, "thunder.sqlite")
+            client = OverDriveClient(cache_file=cache_file)
+            self.assertEqual(client.media_bulk(["284716"]), [media])
+            self.assertEqual(client.media_bulk(["284716"]), [media])
+            responses.assert_call_count(
+                f"{bulk_url}?x-client-id=dewey&titleIds=284716", 1
+            )
+
+            # stale responses are revalidated with the ETag
+            self.assertEqual(client.media("284716"), media)
+            self.assertEqual(client.media("284716"), media)
+            self.assertEqual(responses.calls[-1].response.status_code, 304)
+            client.close()
+
+            # cache persists across clients
+            client = OverDriveClient(cache_file=cache_file)
+            self.assertEqual(client.media_bulk(["284716"]), [media])
+            responses.assert_call_count(
+                f"{bulk_url}?x-client-id=dewey&titleIds=284716", 1
+            )
+
+            # least recently used entries are evicted
+            responses.get(
+                "https://thunder.api.overdrive.com/v2/media/5704038",
+                json={"id": "5704038", "title": "Test"},
+                headers={"Cache-Control": "max-age=600"},
+            )
+            client.cache.max_size = 40  # type: ignore[union-attr]
+            client.media("5704038")
+            self.assertIsNone(
+                client.cache.get(  # type: ignore[union-attr]
+                    f"{bulk_url}?x-client-id=dewey&titleIds=284716"
+                )
+            )
+            client.close()
+
+    def test_response_cache_freshness_lifetime(self):
+        for headers, expected in (
+            ({"cache-control": "max-age=60"}, 60),
+            ({"cache-control": "max-age=60", "age": "10"}, 50),
+            ({"cache-control": "no-store, max-age=60"}, None),
+            ({"cache-control": "no-cache"}, 0),
+            ({}, 0),
+        ):
+            with self.subTest(headers=headers):
+                self.assertEqual(ResponseCache.freshness_lifetime(headers), expected)
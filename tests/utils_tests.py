@@ -1,11 +1,16 @@
 import argparse
+import logging
+import shutil
 import string
+import tempfile
 import unittest
 from datetime import datetime
 from pathlib import Path
 from random import choices
+from unittest.mock import MagicMock, PropertyMock
 
 from odmpy import cli_utils
+from odmpy import transport
 from odmpy import utils
 from tests.base import is_windows
 
@@ -125,3 +130,112 @@ class UtilsTests(unittest.TestCase):
             with self.subTest(file_name=f):
                 mime_type = utils.guess_mimetype(f)
                 self.assertIsNotNone(mime_type, f"Unable to guess mimetype for {f}")
+
+    def test_log_response_body(self):
+        logger = logging.getLogger(f"{__name__}.log_response_body")
+        for content_type, body, expected in (
+            ("application/json; charset=utf-8", '{"a": 1}', 'body: {"a": 1}'),
+            (
+                "application/xhtml+xml",
+                "x" * 3000,
+                "body: " + "x" * 2000 + "... (3000 chars)",
+            ),
+            ("image/jpeg", "", "body: <image/jpeg, 12345 bytes>"),
+        ):
+            with self.subTest(content_type=content_type):
+                res = MagicMock()
+                res.headers = {"content-type": content_type, "content-length": "12345"}
+                text = PropertyMock(return_value=body)
+                type(res).text = text
+
+                logger.setLevel(logging.INFO)
+                utils.log_response_body(logger, res)
+                text.assert_not_called()
+
+                logger.setLevel(logging.DEBUG)
+                with self.assertLogs(logger, level=logging.DEBUG) as context:
+                    utils.log_response_body(logger, res)
+                self.assertEqual(context.records[0].getMessage(), expected)
+                if content_type == "image/jpeg":
+                    text.assert_not_called()
+
+    def test_shared_transport(self):
+        session_a = transport.new_session(max_retries=1)
+        session_b = transport.new_session(max_retries=1)
+        adapter = session_a.get_adapter("https://example.com")
+        # connection pools are shared, cookies are not
+        self.assertIs(adapter, session_b.get_adapter("https://example.com"))
+        self.assertIsNot(session_a.cookies, session_b.cookies)
+        pool = adapter.poolmanager.connection_from_url("https://example.com")
+        session_a.close()
+        self.assertIs(
+            pool, adapter.poolmanager.connection_from_url("https://example.com")
+        )
+        session_b.close()
+
+        try:
+            transport.configure_transport(pool_maxsize=32)
+            session = transport.new_session(max_retries=1)
+            new_adapter = session.get_adapter("https://example.com")
+            self.assertIsNot(new_adapter, adapter)
+            self.assertEqual(
+                new_adapter.poolmanager.connection_pool_kw["maxsize"], 32  # type: ignore[attr-defined]
+            )
+            self.assertEqual(
+                transport.new_session(pool_maxsize=4)
+                .get_adapter("https://example.com")
+                .poolmanager.connection_pool_kw["maxsize"],  # type: ignore[attr-defined]
+                4,
+            )
+        finally:
+            transport.configure_transport()
+
+        # requests retried by a RetryPolicy are not retried by urllib3 as well
+        session = transport.new_session(max_retries=3)
+        session.cookies.set("a", "1")
+        transport.disable_retries(session)
+        for url in ("https://example.com", "http://example.com"):
+            self.assertEqual(session.get_adapter(url).max_retries.total, 0)  # type: ignore[attr-defined]
+        self.assertEqual(session.cookies.get("a"), "1")
+        session.close()
+
+    def test_repair_mp3_headers(self):
+        test_mp3 = (
+            Path(__file__).absolute().parent.joinpath("data", "audiobook", "book.mp3")
+        )
+        with test_mp3.open("rb") as f:
+            original = f.read()
+        expected_duration = utils.mp3_duration_ms(test_mp3)
+        info_offset = original.find(b"Info")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_file = Path(temp_dir, "test.mp3")
+            shutil.copyfile(test_mp3, test_file)
+            # an intact header is left as is
+            self.assertTrue(utils.repair_mp3_headers(test_file))
+            self.assertEqual(test_file.read_bytes(), original)
+
+            # wrong frame and byte counts are corrected
+            broken = bytearray(original)
+            broken[info_offset + 8 : info_offset + 16] = (5).to_bytes(4, "big") * 2
+            test_file.write_bytes(broken)
+            self.assertNotEqual(utils.mp3_duration_ms(test_file), expected_duration)
+            self.assertTrue(utils.repair_mp3_headers(test_file))
+            repaired = test_file.read_bytes()
+            self.assertEqual(
+                repaired[info_offset + 8 : info_offset + 16],
+                original[info_offset + 8 : info_offset + 16],
+            )
+            self.assertEqual(utils.mp3_duration_ms(test_file), expected_duration)
+            # LAME tag CRC covers the first 190 bytes of the Info frame
+            frame_start = info_offset - 36
+            crc16 = utils._crc16  # pylint: disable=protected-access
+            self.assertEqual(
+                crc16(repaired[frame_start : frame_start + 190]),
+                int.from_bytes(repaired[frame_start + 190 : frame_start + 192], "big"),
+            )
+            self.assertTrue(utils.repair_mp3_headers(test_file))
+            self.assertEqual(test_file.read_bytes(), repaired)
+
+            # junk between frames needs a proper remux
+            test_file.write_bytes(original[:-2000] + b"\x00" * 500 + original[-2000:])
+            self.assertFalse(utils.repair_mp3_headers(test_file))